@@ -1,17 +1,4 @@
-import ollama
-import openai
 import streamlit as st
-
-from llama_index.core import VectorStoreIndex, Settings, SimpleDirectoryReader
-from llama_index.core import load_index_from_storage, StorageContext
-from llama_index.core.storage.docstore import SimpleDocumentStore
-from llama_index.core.vector_stores import SimpleVectorStore
-from llama_index.core.storage.index_store import SimpleIndexStore
-from llama_index.llms.ollama import Ollama
-from llama_index.core.memory import ChatMemoryBuffer
-from llama_index.embeddings.ollama import OllamaEmbedding
-from llama_index.embeddings.openai import OpenAIEmbedding
-from PIL import Image
 import time
 
 import logging
@@ -21,37 +8,61 @@ logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
 import utils.func 
 import utils.constants as const
+import utils.index_cache
+import utils.answer_cache
+import utils.metrics
+import utils.ollama_models
+import utils.download_status
+import utils.context_budget
+import utils.async_generation
+import utils.ollama_scheduler
+# llama_index (and the modules built on it) is imported on first use, only when RAG or the answer cache is on
 
 # App title
 st.set_page_config(page_title="Jetson Copilot", menu_items=None)
 
-AVATAR_AI   = Image.open('./images/jetson-soc.png')
-AVATAR_USER = Image.open('./images/user-purple.png')
+@st.cache_resource
+def load_avatars():
+    from PIL import Image
+    return Image.open('./images/jetson-soc.png'), Image.open('./images/user-purple.png')
+
+AVATAR_AI, AVATAR_USER = load_avatars()
+
+utils.metrics.start_metrics_server()
 
 def find_saved_indexes():
     return utils.func.list_directories(const.INDEX_ROOT_PATH)
 
+@st.cache_resource
+def get_embed_model():
+    from llama_index.embeddings.ollama import OllamaEmbedding
+    import utils.embed_cache
+    utils.metrics.install_llama_index_handler()
+    return utils.embed_cache.cached(OllamaEmbedding(const.DEFAULT_EMBED_MODEL, base_url=const.OLLAMA_BASE_URL)) ##TODO
+
 def load_index(index_name):
-    Settings.embed_model = OllamaEmbedding("mxbai-embed-large:latest") ##TODO
+    from llama_index.core import Settings, load_index_from_storage
+    import utils.vector_store
+    Settings.embed_model = get_embed_model()
     dir = f"{const.INDEX_ROOT_PATH}/{index_name}"
-    storage_context = StorageContext.from_defaults(persist_dir=dir)
-    index = load_index_from_storage(storage_context)
+    with utils.metrics.span("index_load", index=index_name):
+        storage_context = utils.vector_store.load_storage_context(dir)
+        index = load_index_from_storage(storage_context)
     return index
 
+# Missing models are pulled in the background; the page stays usable meanwhile
+utils.ollama_models.ensure_models()
 
-models = [model["name"] for model in ollama.list()["models"]]
-
-if 'llama3:latest' not in models:
-    with st.spinner('Downloaing llama3 model ...'):
-        ollama.pull('llama3')
-        logging.info(" ### Downloaing llama3 completed.")
+MODEL_STATE_ICONS = {'loaded': '🟢', 'loading': '⏳', 'failed': '🔴', 'unloaded': '⚪'}
 
-if 'mxbai-embed-large:latest' not in models:
-    with st.spinner('Downloaing mxbai-embed-large model ...'):
-        ollama.pull('mxbai-embed-large')
-        logging.info(" ### Downloaing mxbai-embed-large completed.")
+@st.experimental_fragment(run_every=2)
+def show_model_states(names):
+    lines = []
+    for name in names:
+        state, size = utils.ollama_models.model_state(name)
+        lines.append(f"{MODEL_STATE_ICONS[state]} `{name}` {state}" + (f" ({size / 2**30:.1f} GiB)" if size else ""))
+    st.caption("  \n".join(lines))
 
-old_index_name = ''
 # Side bar
 with st.sidebar:        
     # # Add css to make text smaller
@@ -62,39 +73,59 @@ with st.sidebar:
     st.title(":airplane: Jetson Copilot")
     st.subheader('Your local AI assistant on Jetson', divider='rainbow')
 
-    models = [model["name"] for model in ollama.list()["models"]]
+    utils.download_status.show_downloads()
+    models = utils.ollama_models.list_model_names()
     col3, col4 = st.columns([5,1])
     with col3:
-        st.session_state["model"] = st.selectbox("Choose your LLM", models, index=models.index("llama3:latest"))
+        st.session_state["model"] = st.selectbox("Choose your LLM", models, index=models.index(const.DEFAULT_LLM) if const.DEFAULT_LLM in models else 0)
         logging.info(f"> st.session_state[\"model\"] = {st.session_state.model}")
     with col4:
         st.markdown('')
         # st.button('➕', key='btn_add_llm')
     st.page_link("pages/download_model.py", label=" Download a new LLM", icon="➕")
-    Settings.llm = Ollama(model=st.session_state["model"], request_timeout=300.0)
+    if st.session_state["model"] is not None:
+        # Load the selected model while the user types, instead of on the first question
+        utils.ollama_models.warm(st.session_state["model"])
+    token_budget = st.slider("Prompt token budget", 512, 8192, utils.context_budget.token_budget(st.session_state["model"]), step=256,
+                             key=f"token_budget_{st.session_state['model']}",
+                             help="Older turns and retrieved documents are compacted to fit. A smaller budget shortens the time to the first token.")
 
-    use_index = st.toggle("Use RAG", value=False)
+    embed_model_ready = const.DEFAULT_EMBED_MODEL in models
+    use_index = st.toggle("Use RAG", value=False, disabled=not embed_model_ready,
+                          help=None if embed_model_ready else f"Waiting for {const.DEFAULT_EMBED_MODEL} to be downloaded.")
     if use_index:
+        utils.ollama_models.warm(const.DEFAULT_EMBED_MODEL, kind='embed')
+        from llama_index.core import Settings
+        from llama_index.core.llms import ChatMessage
+        import utils.chat_context
+        Settings.llm = utils.chat_context.AsyncOllama(model=st.session_state["model"], base_url=const.OLLAMA_BASE_URL, request_timeout=300.0)
         # col1, col2 = st.columns([5,1], vertical_alignment="bottom") ### https://github.com/streamlit/streamlit/issues/3052
         col1, col2 = st.columns([5,1])
         saved_index_list = find_saved_indexes()
         with col1:
-            index = next((i for i, item in enumerate(saved_index_list) if item.startswith('_')), None)
-            index_name = st.selectbox("Index", saved_index_list, index)
-            logging.info(f"> index_name = {index_name}")
+            default_indexes = [item for item in saved_index_list if item.startswith('_')][:1]
+            index_names = st.multiselect("Indexes", saved_index_list, default_indexes,
+                                         help="Select several indexes to ask across all of them at once.")
+            logging.info(f"> index_names = {index_names}")
         with col2:
             st.markdown('')
             # st.link_button('➕', url='pages/build_index.py')
-        if old_index_name != index_name:
-            old_index_name = index_name
-            logging.info(f"> old_index_name = {old_index_name}")
-            if index_name != None:
-                with st.spinner('Loading Index...'):
-                    st.session_state.index = load_index(index_name)
+        # Shared by all sessions; a plain lookup unless the index changed on disk
+        st.session_state.indexes = {}
+        for index_name in index_names:
+            if utils.index_cache.registry.contains(index_name):
+                st.session_state.indexes[index_name] = utils.index_cache.registry.get(index_name, load_index)
+            else:
+                with st.spinner(f'Loading Index {index_name}...'):
+                    st.session_state.indexes[index_name] = utils.index_cache.registry.get(index_name, load_index)
                     logging.info(f" ### Loading Index '{index_name}' completed.")
         st.page_link("pages/build_index.py", label=" Build a new index", icon="➕")
+        st.page_link("pages/compact_index.py", label=" Compact an index", icon="🗜️")
+        import utils.embed_cache
+        embed_cache_stats = utils.embed_cache.get_cache().stats()
+        st.caption(f"Embedding cache: {embed_cache_stats['hits']} hits / {embed_cache_stats['hits'] + embed_cache_stats['misses']} lookups ({embed_cache_stats['hit_rate']:.0%})")
 
-        if index_name != None:
+        if index_names:
             context_prompt = st.text_area("System prompt with context", 
 """You are a chatbot, able to have normal interactions, as well as talk about NVIDIA Jetson embedded AI computer.
 Here are the relevant documents for the context:\n
@@ -102,14 +133,80 @@ Here are the relevant documents for the context:\n
 \nInstruction: Use the previous chat history, or the context above, to interact and help the user.""", height=240)
             logging.info(f"> context_prompt = {context_prompt}")
 
-            # init models
-            st.session_state.chat_engine = st.session_state.index.as_chat_engine(
-                chat_mode="context", 
-                streaming=True,
-                memory=ChatMemoryBuffer.from_defaults(token_limit=4096),
-                llm=Settings.llm,
-                context_prompt=(context_prompt),
-                verbose=True)
+            index_weights = {}
+            if len(index_names) > 1:
+                with st.expander("Index weights"):
+                    for index_name in index_names:
+                        index_weights[index_name] = st.slider(index_name, 0.0, 2.0, 1.0, 0.1, key=f"index_weight_{index_name}",
+                                                              help="Scores of this index are multiplied by its weight before merging.")
+
+            vector_store_kwargs = {index_name: {} for index_name in index_names}
+            ivf_stores = {index_name: index.vector_store for index_name, index in st.session_state.indexes.items()
+                          if getattr(index.vector_store, "ann_backend", "exact") == "ivf"}
+            if ivf_stores:
+                nprobe = st.slider("IVF lists probed per query", 1, 128, max(store.ann_nprobe for store in ivf_stores.values()),
+                                   help="Higher values raise recall at the cost of latency.")
+                for index_name in ivf_stores:
+                    vector_store_kwargs[index_name]["nprobe"] = nprobe
+
+            import utils.bm25
+            keyword_indexes = {index_name: utils.bm25.get_keyword_index(f"{const.INDEX_ROOT_PATH}/{index_name}") for index_name in index_names}
+            hybrid_ready = all(keyword_index is not None for keyword_index in keyword_indexes.values())
+            use_hybrid = st.toggle("Hybrid search (keywords + vectors)", value=True, disabled=not hybrid_ready,
+                                   help="Also match exact terms such as error codes and command names." if hybrid_ready
+                                        else "An index has no keyword index; rebuild it with \"Build a keyword index\" checked.")
+            use_hybrid = use_hybrid and hybrid_ready
+
+            # init models, only when the model, the indexes or the prompt changed
+            fingerprint = utils.func.make_fingerprint(st.session_state["model"], [(index_name, id(index)) for index_name, index in st.session_state.indexes.items()],
+                                                      context_prompt, vector_store_kwargs, index_weights, use_hybrid,
+                                                      [id(keyword_index) for keyword_index in keyword_indexes.values()], token_budget)
+            if st.session_state.get("chat_engine_fingerprint") != fingerprint:
+                logging.info(f" ### Building chat engine (model: {st.session_state['model']}, indexes: {index_names})")
+                # Seed the memory with the conversation so far, so a rebuild keeps the context
+                chat_history = [ChatMessage(role=message["role"], content=message["content"]) for message in st.session_state.get("messages", [])]
+                from llama_index.core.chat_engine import ContextChatEngine
+                retrievers = {}
+                for index_name, index in st.session_state.indexes.items():
+                    if use_hybrid:
+                        # Fuse a wider vector candidate list with the keyword hits, then keep the default top k
+                        retrievers[index_name] = utils.bm25.HybridRetriever(
+                            index.as_retriever(similarity_top_k=const.HYBRID_CANDIDATES, vector_store_kwargs=vector_store_kwargs[index_name]),
+                            keyword_indexes[index_name],
+                            index.docstore)
+                    else:
+                        retrievers[index_name] = index.as_retriever(vector_store_kwargs=vector_store_kwargs[index_name])
+                if len(retrievers) == 1:
+                    retriever = next(iter(retrievers.values()))
+                else:
+                    import utils.federated
+                    retriever = utils.federated.FederatedRetriever(retrievers, index_weights, embed_model=get_embed_model())
+                # Kept apart: the chat engine does not expose its memory
+                st.session_state.chat_memory = utils.chat_context.CompactingChatMemory.from_history(chat_history, token_budget)
+                st.session_state.chat_engine = ContextChatEngine.from_defaults(
+                    # Answers are generated asynchronously; retrieval runs in a worker thread rather than on the event loop
+                    retriever=utils.chat_context.ThreadedRetriever(retriever),
+                    memory=st.session_state.chat_memory,
+                    node_postprocessors=[utils.chat_context.BudgetNodePostprocessor(
+                        token_budget=token_budget, reserved_tokens=utils.context_budget.count_tokens(context_prompt))],
+                    llm=Settings.llm,
+                    context_template=context_prompt,
+                    verbose=True)
+                st.session_state.chat_engine_fingerprint = fingerprint
+    else:
+        # Turns made without RAG are not in the engine memory; rebuild when RAG is back on
+        st.session_state.pop("chat_engine_fingerprint", None)
+
+    use_answer_cache = st.toggle("Reuse answers to similar questions", value=False, disabled=not embed_model_ready,
+                                 help="Answer a question asked before (with the same model, index and system prompt) instantly from the cache. "
+                                      "Only the first question of a conversation is looked up, as follow-ups depend on what came before.")
+    if use_answer_cache:
+        utils.ollama_models.warm(const.DEFAULT_EMBED_MODEL, kind='embed')
+        answer_cache_stats = utils.answer_cache.get_cache().stats()
+        st.caption(f"Answer cache: {answer_cache_stats['hits']} hits / {answer_cache_stats['hits'] + answer_cache_stats['misses']} lookups ({answer_cache_stats['hit_rate']:.0%}), {answer_cache_stats['entries']} answers stored")
+    if st.session_state["model"] is not None:
+        show_model_states([st.session_state["model"]] + ([const.DEFAULT_EMBED_MODEL] if use_index or use_answer_cache else []))
+    st.page_link("pages/diagnostics.py", label=" Diagnostics", icon="📊")
 
 # initialize history
 if "messages" not in st.session_state.keys():
@@ -117,38 +214,142 @@ if "messages" not in st.session_state.keys():
         {"role": "assistant", "content": "Ask me any question about NVIDIA Jetson embedded AI computer!", "avatar": AVATAR_AI}
     ]
 
-def model_res_generator(prompt=""):
+def answer_cache_key():
+    if use_index and index_names:
+        index_fingerprints = [utils.index_cache.index_fingerprint(f"{const.INDEX_ROOT_PATH}/{index_name}")[0] for index_name in index_names]
+        if len(index_names) == 1:
+            index_fingerprint = index_fingerprints[0]
+        else:
+            index_fingerprint = utils.func.make_fingerprint(index_fingerprints, index_weights)
+        if use_hybrid:
+            index_fingerprint += "+keywords"
+        return utils.answer_cache.make_cache_key(st.session_state["model"], index_fingerprint, context_prompt)
+    return utils.answer_cache.make_cache_key(st.session_state["model"], "", "")
+
+def session_id():
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    return get_script_run_ctx().session_id
+
+def start_generation(prompt, request_id=None):
+    """Start generating the answer on the shared event loop (see utils/async_generation.py)."""
+    model = st.session_state["model"]
     if use_index:
         logging.info(f">>> RAG enabled:")
-        response_stream = st.session_state.chat_engine.stream_chat(prompt)
-        for chunk in response_stream.response_gen:
-            yield chunk
+        chat_engine, chat_memory = st.session_state.chat_engine, st.session_state.chat_memory
+        make_stream = lambda: utils.async_generation.rag_stream(chat_engine, chat_memory, model, prompt)
+        prompt_tokens = None
     else:
         logging.info(f">>> Just LLM (no RAG):")
         messages_only_role_and_content = [{"role": message["role"], "content": message["content"]} for message in st.session_state.messages]
+        messages, prompt_tokens = utils.context_budget.compact_history(messages_only_role_and_content, token_budget)
+        make_stream = lambda: utils.async_generation.chat_stream(model, messages)
+    generation = utils.async_generation.start(session_id(), model, make_stream, request_id)
+    generation.prompt_tokens = generation.prompt_tokens or prompt_tokens
+    return generation
+
+def show_generation(pending):
+    """Stream an answer being generated, from its start, and add it to the conversation once it ends."""
+    generation = pending["generation"]
+    with st.chat_message("assistant", avatar=AVATAR_AI):
+        stop_button = st.empty()
+        if stop_button.button("Stop", key=f"stop_{generation.id}", help="Stop generating this answer."):
+            generation.cancel()
+        with st.spinner("Thinking..."):
+            status = st.empty()
+            while not generation.wait_started(0.5):
+                # Updating the page also lets Streamlit stop this run when the user clicks
+                status.caption(f"Waiting for `{generation.model}`: {generation.queue_position()} session(s) ahead")
+            status.empty()
+            st.write_stream(generation.stream())
+        stop_button.empty()
+        message = generation.text
+        if generation.state == 'cancelled':
+            st.caption("Stopped.")
+        elif isinstance(generation.error, utils.ollama_scheduler.OllamaBusy):
+            st.warning(str(generation.error), icon="⏳")
+        elif generation.state == 'failed':
+            st.error(f"Generating the answer failed: {generation.error}", icon="🚨")
+        if generation.prompt_tokens:
+            st.caption(f"~{generation.prompt_tokens} prompt tokens")
+            utils.metrics.record("prompt_tokens", generation.prompt_tokens, generation.request_id, model=generation.model)
+            logging.info(f">>> Prompt: ~{generation.prompt_tokens} tokens (budget {token_budget})")
+    utils.metrics.record("chat_turn_seconds", time.perf_counter() - pending["start_time"], generation.request_id, model=generation.model)
 
-        stream = ollama.chat(
-            model=st.session_state["model"],
-            messages=messages_only_role_and_content,
-            stream=True,
-        )
-        for chunk in stream:
-            yield chunk["message"]["content"]
+    if pending["use_index"] and generation.state != 'done' and "chat_memory" in st.session_state:
+        # The engine only writes complete answers to its memory; keep the turns paired
+        from llama_index.core.llms import ChatMessage
+        st.session_state.chat_memory.put(ChatMessage(role="assistant", content=message))
+    if pending["cache"] is not None and generation.state == 'done':
+        cache_key, index_label, embedding = pending["cache"]
+        utils.answer_cache.get_cache().put(cache_key, index_label, pending["prompt"], embedding, message)
+    # llama_index's embedding model sends no keep_alive, so Ollama fell back to its default: pin it again
+    utils.ollama_models.touch(generation.model)
+    if pending["use_index"]:
+        utils.ollama_models.touch(const.DEFAULT_EMBED_MODEL, repin=True)
+    st.session_state.messages.append({"role": "assistant", "content": message, "avatar": AVATAR_AI,
+                                      "prompt_tokens": generation.prompt_tokens})
+    del st.session_state.pending_generation
 
 # Display chat messages from history on app rerun
 for message in st.session_state.messages:
     with st.chat_message(message["role"], avatar=message["avatar"]):
         st.markdown(message["content"])
+        if message.get("prompt_tokens"):
+            st.caption(f"~{message['prompt_tokens']} prompt tokens")
 
-if prompt := st.chat_input("Enter prompt here.."):
+prompt = st.chat_input("Enter prompt here..", disabled=st.session_state["model"] is None)
+
+# An answer still being generated when the script was rerun (e.g. by the Stop button) is shown and streamed again
+if "pending_generation" in st.session_state:
+    if prompt:
+        # A new question stops the answer to the previous one
+        st.session_state.pending_generation["generation"].cancel()
+    show_generation(st.session_state.pending_generation)
+
+if prompt:
     # add latest message to history in format {role, content}
     st.session_state.messages.append({"role": "user", "content": prompt, "avatar": AVATAR_USER})
 
     with st.chat_message("user", avatar=AVATAR_USER):
         st.markdown(prompt)
 
-    with st.chat_message("assistant", avatar=AVATAR_AI):
-        with st.spinner("Thinking..."):
-            time.sleep(1)
-            message = st.write_stream(model_res_generator(prompt))
-            st.session_state.messages.append({"role": "assistant", "content": message, "avatar": AVATAR_AI})
+    request_id = utils.metrics.new_request_id()
+    start_time = time.perf_counter()
+    cache = None
+    answered = False
+    # Follow-ups ("why?", "tell me more") depend on the conversation, which the cache key does not cover
+    follow_up = any(message["role"] == "user" for message in st.session_state.messages[:-1])
+    if use_answer_cache and not follow_up:
+        answer_cache = utils.answer_cache.get_cache()
+        cache_key = answer_cache_key()
+        utils.metrics.set_request_id(request_id)
+        try:
+            embedding = get_embed_model().get_query_embedding(prompt)
+        except utils.ollama_scheduler.OllamaBusy as e:
+            # Answer without the cache rather than leave the question unanswered
+            logging.warning(f"!!! Answer cache skipped: {e}")
+            embedding = None
+        finally:
+            utils.metrics.set_request_id(None)
+        if embedding is not None:
+            utils.ollama_models.touch(const.DEFAULT_EMBED_MODEL, repin=True)
+            hit = answer_cache.lookup(cache_key, embedding)
+            if hit is not None:
+                answer, similarity, cached_prompt = hit
+                logging.info(f">>> Answer cache hit (similarity {similarity:.3f} with \"{cached_prompt}\")")
+                if use_index:
+                    # Keep the chat engine memory in line with the conversation shown
+                    from llama_index.core.llms import ChatMessage
+                    st.session_state.chat_memory.put(ChatMessage(role="user", content=prompt))
+                    st.session_state.chat_memory.put(ChatMessage(role="assistant", content=answer))
+                with st.chat_message("assistant", avatar=AVATAR_AI):
+                    st.write_stream(utils.answer_cache.replay(answer))
+                st.session_state.messages.append({"role": "assistant", "content": answer, "avatar": AVATAR_AI})
+                utils.metrics.record("chat_turn_seconds", time.perf_counter() - start_time, request_id, model=st.session_state["model"])
+                answered = True
+            else:
+                cache = (cache_key, "\n".join(index_names) if use_index else None, embedding)
+    if not answered:
+        st.session_state.pending_generation = {"generation": start_generation(prompt, request_id), "prompt": prompt,
+                                               "use_index": use_index, "cache": cache, "start_time": start_time}
+        show_generation(st.session_state.pending_generation)
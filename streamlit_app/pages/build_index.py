@@ -1,21 +1,7 @@
-import ollama
 import openai
 import streamlit as st
 import pandas as pd
 
-from llama_index.core import VectorStoreIndex, Settings, SimpleDirectoryReader
-from llama_index.llms.ollama import Ollama
-from llama_index.core.memory import ChatMemoryBuffer
-from llama_index.embeddings.ollama import OllamaEmbedding
-from llama_index.embeddings.openai import OpenAIEmbedding
-from llama_index.core import SummaryIndex
-from llama_index.readers.web import SimpleWebPageReader
-from llama_index.core.readers.base import BaseReader
-from llama_index.core import Document
-from typing import Dict, Type
-
-from PIL import Image
-import time
 import os
 
 import logging
@@ -27,32 +13,29 @@ parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, parent_dir)
 import utils.func 
 import utils.constants as const
-
-class ExcelReader(BaseReader):
-    def load_data(self, file_path: str, extra_info: dict = None):
-        data = pd.read_excel(file_path).to_string()
-        return [Document(text=data, metadata=extra_info)]
-    
-DEFAULT_FILE_READER_CLS: Dict[str, Type[BaseReader]] = {
-    ".xlsx": ExcelReader,
-    ".xls": ExcelReader,
-}
+import utils.ollama_models
+import utils.download_status
+import utils.build_jobs
+import utils.ollama_scheduler
+import utils.file_inventory
 
 def on_settings_change():
     logging.info(" --- settings updated ---")
 
 def on_local_model_change():
-    Settings.embed_model = OllamaEmbedding(model_name=st.session_state.my_local_model)
-    logging.info(f" --- Settings.embed_model=OllamaEmbedding(model_name={st.session_state.my_local_model}) ---")
+    st.session_state.embed_choice = ('ollama', st.session_state.my_local_model)
+    logging.info(f" --- embedding model: OllamaEmbedding(model_name={st.session_state.my_local_model}) ---")
 
 def on_openai_model_change():
-    Settings.embed_model = OpenAIEmbedding(model_name=st.session_state.my_openai_model, dimensions=1024)
-    logging.info(f" --- Settings.embed_model=OpenAIEmbedding(model_name={st.session_state.my_openai_model}) ---")
+    if st.session_state.my_openai_model.startswith('--'):
+        return
+    st.session_state.embed_choice = ('openai', st.session_state.my_openai_model)
+    logging.info(f" --- embedding model: OpenAIEmbedding(model_name={st.session_state.my_openai_model}) ---")
 
 def on_indexname_change():
     name = st.session_state.my_indexname
     name = utils.func.make_valid_directory_name(name)
-    if os.path.exists(os.path.join(const.INDEX_ROOT_PATH, name)):
+    if os.path.exists(os.path.join(const.INDEX_ROOT_PATH, name)) or utils.build_jobs.get_queue().is_active(name):
         with container_name:
             st.error('The title name is not valid', icon="🚨")
     else:
@@ -61,21 +44,41 @@ def on_indexname_change():
         with container_name:
             st.markdown(f"`{st.session_state.index_path_to_be_created}` will be created")
 
+def on_update_indexname_change():
+    name = st.session_state.my_update_indexname
+    st.session_state.index_name = name
+    with container_name:
+        st.markdown(f"`{const.INDEX_ROOT_PATH}/{name}` will be updated in place")
+
 def on_docspath_change():
     logging.info("### on_docspath_change")
-    st.session_state['docpath_untouched'] = False
-    dir = st.session_state.docspath
-    with container_docs:
-        with st.spinner('Checking files under the directory...'):
-            files = utils.func.get_files_with_extensions(dir, const.SUPPORTED_FILE_TYPES)
-            total_docs_size = utils.func.get_total_size_mib(dir)
-            md = f"**`{len(files)}`** files found! (Total file size: **`{total_docs_size:,.2f}`** MiB)"
-            logging.info(f"{len(files)} files found!")
-            df = pd.DataFrame(files, columns=['Filename', 'Size (KiB)'])
-            st.markdown(md)
-            st.session_state.num_of_files_to_read = len(files)
-            if len(files) != 0:
-                st.dataframe(df.style.format({'Size (KiB)' : "{:,.1f}"}))
+    st.session_state.my_files_page = 1
+
+def show_inventory(inventory, docs_path):
+    summary = inventory.summary(docs_path)
+    num_files = summary["num_files"]
+    st.session_state.num_of_files_to_read = num_files
+    md = f"**`{num_files}`** files found! (Total file size: **`{summary['total_bytes'] / 1024**2:,.2f}`** MiB)"
+    if summary["num_skipped"]:
+        md += f"  \n{summary['num_skipped']} files of other types ({summary['skipped_bytes'] / 1024**2:,.2f} MiB) are left out."
+    st.markdown(md)
+    if num_files == 0:
+        return
+    tab_types, tab_files = st.tabs(["By file type", "Files"])
+    with tab_types:
+        df = pd.DataFrame([(ext, count, size / 1024**2) for ext, (count, size) in summary["by_extension"].items()],
+                          columns=['Type', 'Files', 'Size (MiB)']).sort_values('Size (MiB)', ascending=False)
+        st.dataframe(df.style.format({'Size (MiB)': "{:,.2f}"}), hide_index=True)
+    with tab_files:
+        files = inventory.files(docs_path)
+        num_pages = (len(files) - 1) // const.INVENTORY_PAGE_SIZE + 1
+        page = 1
+        if num_pages > 1:
+            page = st.number_input(f"Page (of {num_pages})", min_value=1, max_value=num_pages, key='my_files_page')
+        start = (page - 1) * const.INVENTORY_PAGE_SIZE
+        df = pd.DataFrame([(path, size / 1024) for path, size in files[start:start + const.INVENTORY_PAGE_SIZE]],
+                          columns=['Filename', 'Size (KiB)'])
+        st.dataframe(df.style.format({'Size (KiB)' : "{:,.1f}"}), hide_index=True)
 
 def on_urllist_change():
     urls = st.session_state.my_urllist
@@ -113,71 +116,140 @@ def check_if_ready_to_index():
 # App title
 st.set_page_config(page_title="Jetson Copilot - Build Index", menu_items=None)
 
-### Building Index with Embedding Model
-def index_data():
+def make_job_spec():
+    """Collect the build settings of the sidebar for a job; the worker process does not see the session state."""
+    backend, model_name = st.session_state.get('embed_choice', ('ollama', st.session_state.get('my_local_model', const.DEFAULT_EMBED_MODEL)))
+    return {
+        "docs_path": st.session_state.get('docspath'),
+        "embed_backend": backend,
+        "embed_model": model_name,
+        "chunk_size": st.session_state.get('my_chunk_size', 1024),
+        "chunk_overlap": st.session_state.get('my_chunk_overlap', 50),
+        "chunking": 'structured' if st.session_state.get('my_structured_chunking', True) else 'uniform',
+        "embed_batch_size": st.session_state.get('my_embed_batch_size', const.EMBED_BATCH_SIZE),
+        "embed_workers": st.session_state.get('my_embed_workers', const.EMBED_MAX_WORKERS),
+        "loader_workers": st.session_state.get('my_loader_workers', const.LOADER_PROCESS_WORKERS),
+        "keyword_index": st.session_state.get('my_keyword_index', True),
+    }
+
+def submit_job(kind, index_name, spec):
+    try:
+        utils.build_jobs.get_queue().submit(kind, index_name, spec["embed_backend"], spec)
+    except ValueError as e:
+        with container_status:
+            st.error(str(e), icon="🚨")
+        return
+    utils.build_jobs.ensure_workers()
     with container_status:
-        start_time = time.time()
-        with st.status("Indexing documents..."):
-            logging.info(f"Setting Embedding model... {Settings.embed_model}")
-            docs = []
-            web_docs = []
-            if st.session_state.num_of_files_to_read != 0:
-                reader = SimpleDirectoryReader(input_dir=st.session_state.docspath, recursive=True)
-                st.write(    "Loading local documents...")
-                logging.info("Loading local documents...")
-                docs = reader.load_data()
-                st.write(    f"{len(docs)} local documents loaded.")
-                logging.info(f"{len(docs)} local documents loaded.")
-                st.write(    "Building Index from local docs (using GPU)...")
-                logging.info("Building Index from local docs (using GPU)...")
-                index = VectorStoreIndex.from_documents(docs)
-            if st.session_state.num_of_urls_to_read != 0:
-                st.write(    "Loading web documents...")
-                logging.info("Loading web documents...")
-                web_docs = SimpleWebPageReader(html_to_text=True).load_data(st.session_state.urllist)
-                st.write(    f"{len(web_docs)} web documents loaded.")
-                logging.info(f"{len(web_docs)} web documents loaded.")
-                logging.info(f"len(web_docs): {len(web_docs)}")
-                logging.info(f"web_docs[0]  : {web_docs[0]}")
-                st.write(    "Building Index from web docs (using GPU)...")
-                logging.info("Building Index from web docs (using GPU)...")
-                if 'index' not in locals():
-                    index = VectorStoreIndex.from_documents(web_docs)
-                else:
-                    for d in web_docs:
-                        index.insert(document = d)
-            st.write(    "Saving the built index to disk...")
-            logging.info("Saving the built index to disk...")
-            index.storage_context.persist(persist_dir=st.session_state.index_path_to_be_created)
-            st.write(    "Indexing done!")
-            logging.info("Indexing done!")
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-    
-    total_size_mib = utils.func.get_total_size_mib(st.session_state.index_path_to_be_created)
-
-    md = f"""
-    Index named **"{st.session_state.index_name}"** was built from **`{len(docs)}` local** documents and **`{len(web_docs)}` online** documents!
-
-    The index is saved under `{st.session_state.index_path_to_be_created}` and the total size of this index is **`{total_size_mib:.2f}`** MiB. 
-
-    The indexing task took **`{elapsed_time:.1f}`** seconds to complete.
+        st.success(f"Job queued for index **\"{index_name}\"**. It keeps running if you leave this page.", icon="✅")
+
+### Building Index with Embedding Model (in a background worker process)
+def index_data():
+    spec = make_job_spec()
+    if st.session_state.num_of_files_to_read == 0:
+        spec["docs_path"] = None
+    spec["urls"] = st.session_state.urllist if st.session_state.num_of_urls_to_read != 0 else []
+    spec["vector_dtype"] = st.session_state.my_vector_dtype
+    spec["ann_backend"] = st.session_state.my_ann_backend
+    spec["ann_nlist"] = st.session_state.get('my_ann_nlist') or None
+    spec["ann_nprobe"] = st.session_state.get('my_ann_nprobe', const.ANN_DEFAULT_NPROBE)
+    submit_job('build', st.session_state.index_name, spec)
+
+### Updating an existing Index with only the new/changed local documents
+def update_index_data():
+    submit_job('update', st.session_state.my_update_indexname, make_job_spec())
+
+def on_cancel_job(job_id):
+    utils.build_jobs.get_queue().cancel(job_id)
+
+def on_resume_job(job_id):
+    try:
+        utils.build_jobs.get_queue().resume(job_id)
+    except ValueError as e:
+        st.toast(str(e), icon="🚨")
+        return
+    utils.build_jobs.ensure_workers()
+
+def on_remove_job(job_id):
+    utils.build_jobs.get_queue().remove(job_id)
+
+JOB_STATUS_ICONS = {'queued': '⏳', 'running': '⚙️', 'done': '✅', 'failed': '🚨', 'cancelled': '⏹️'}
+
+def show_job_result(job):
+    result = job['result']
+    if job['kind'] == 'update':
+        diff = result['diff']
+        md = f"""
+        Index named **"{job['index_name']}"** was updated: **`{diff['new']}`** new, **`{diff['changed']}`** changed and **`{diff['removed']}`** removed files (**`{diff['unchanged']}`** files unchanged, **`{result['num_deleted']}`** outdated chunks deleted).
+        """
+    else:
+        md = f"""
+        Index named **"{job['index_name']}"** was built from **`{result['num_documents']}` local** documents and **`{result['num_web_documents']}` online** documents!
+        """
+    md += f"""
+    The index is saved under `{const.INDEX_ROOT_PATH}/{job['index_name']}` and the total size of this index is **`{result['size_mib']:.2f}`** MiB.
+
+    The task took **`{utils.func.format_duration(result['elapsed_sec'])}`** to complete, embedding **`{result['num_chunks']}`** chunks at **`{result['chunks_per_sec']:.1f}`** chunks/sec
+    (embedding cache: {result['embed_cache_hits']} hits, {result['embed_cache_misses']} misses).
+    """
+    if result.get('chunks_by_strategy'):
+        md += f"""
+    Chunks average **`{result['avg_chunk_chars']:,.0f}`** characters: {", ".join(f"{chunks} {strategy} ({chars / chunks:,.0f} chars avg)" for strategy, (chunks, chars) in result['chunks_by_strategy'].items() if chunks)}.
     """
+    st.markdown(md)
+    for path, error in result.get('failures', []):
+        st.warning(f"Skipped `{path}`: {error}", icon="⚠️")
 
-    with container_result:
-        st.markdown(md)
-        logging.info(md)
+@st.experimental_fragment(run_every=2)
+def show_jobs():
+    jobs = utils.build_jobs.get_queue().list_jobs()
+    if not jobs:
+        st.caption("No build jobs yet.")
+        return
+    ollama_stats = utils.ollama_scheduler.get_scheduler().stats()
+    if any(job['status'] == 'running' for job in jobs):
+        # Chat requests go first, so embedding slows down while someone is chatting
+        st.caption(f"Ollama requests: {ollama_stats[utils.ollama_scheduler.BUILD]['running']} from builds running, "
+                   f"{ollama_stats[utils.ollama_scheduler.BUILD]['waiting']} waiting; "
+                   f"{ollama_stats[utils.ollama_scheduler.INTERACTIVE]['running']} from chat running")
+    for job in jobs:
+        with st.container(border=True):
+            col1, col2 = st.columns([5, 1])
+            with col1:
+                st.markdown(f"{JOB_STATUS_ICONS.get(job['status'], '')} **{job['index_name']}** ({'update' if job['kind'] == 'update' else 'new index'}, `{job['spec']['embed_model']}`): {job['status']}")
+            with col2:
+                if job['status'] in utils.build_jobs.ACTIVE_STATUSES:
+                    st.button("Cancel", key=f"cancel_{job['id']}", on_click=on_cancel_job, args=(job['id'],), disabled=bool(job['cancel_requested']))
+                else:
+                    if job['status'] in ('cancelled', 'failed'):
+                        st.button("Resume", key=f"resume_{job['id']}", on_click=on_resume_job, args=(job['id'],))
+                    st.button("Remove", key=f"remove_{job['id']}", on_click=on_remove_job, args=(job['id'],))
+            progress = job['progress']
+            if job['status'] == 'running' and progress:
+                text = f"{progress.get('phase', '')}: {progress.get('files_done', 0)} / {progress.get('files_total', 0)} files"
+                if progress.get('chunks_done'):
+                    text += f", {progress['chunks_done']} chunks ({progress.get('chunks_per_sec', 0.0):.1f} chunks/sec)"
+                text += f", ETA {utils.func.format_duration(progress.get('eta_sec'))}"
+                st.progress(min(progress.get('fraction', 0.0), 1.0), text=text)
+            elif job['status'] == 'queued':
+                st.caption("Waiting for a worker" + (f" (resumes after {progress.get('files_done', 0)} files)" if progress else ""))
+            elif job['status'] == 'failed':
+                st.error(job['error'], icon="🚨")
+            elif job['status'] == 'done':
+                with st.expander("Result"):
+                    show_job_result(job)
 
 # Side bar
 with st.sidebar:
+    utils.download_status.show_downloads()
     st.title("Building Index")
     st.info('Build your own custom Index based on your local/online documents.')
 
     st.subheader("Embedding Model")
     t1,t2 = st.tabs(['Local','OpenAI'])
     with t1:
-        models = [model["name"] for model in ollama.list()["models"]]
-        st.selectbox("Choose local embedding model", models, index=models.index("mxbai-embed-large:latest"), key='my_local_model', on_change=on_local_model_change)
+        models = utils.ollama_models.list_model_names()
+        st.selectbox("Choose local embedding model", models, index=models.index(const.DEFAULT_EMBED_MODEL) if const.DEFAULT_EMBED_MODEL in models else 0, key='my_local_model', on_change=on_local_model_change)
     with t2:
         openai.api_key = st.text_input("OpenAI API Key", key="chatbot_api_key", type="password")
         os.environ["OPENAI_API_KEY"] = openai.api_key
@@ -185,39 +257,70 @@ with st.sidebar:
         st.selectbox("Choose OpenAI embedding model", ["-- Choose from below --", "text-embedding-3-large", "text-embedding-3-small", "text-embedding-ada-002"], index=0, key='my_openai_model', on_change=on_openai_model_change)
     use_customized_chunk = st.toggle("Customize chunk parameters", value=False)
     if use_customized_chunk:
-        Settings.chunk_size = st.slider("Chunk size", 100, 5000, 1024, key='my_chunk_size', on_change=on_settings_change)
-        Settings.chunk_overlap = st.slider("Chunk overlap", 10, 500, 50, key='my_chunk_overlap', on_change=on_settings_change)
-        logging.info(f"> Settings.chunk_size    = {Settings.chunk_size}")
-        logging.info(f"> Settings.chunk_overlap = {Settings.chunk_overlap}")
+        chunk_size = st.slider("Chunk size", 100, 5000, 1024, key='my_chunk_size', on_change=on_settings_change)
+        chunk_overlap = st.slider("Chunk overlap", 10, 500, 50, key='my_chunk_overlap', on_change=on_settings_change)
+        logging.info(f"> chunk_size    = {chunk_size}")
+        logging.info(f"> chunk_overlap = {chunk_overlap}")
+        st.checkbox("Split along the document structure", value=True, key='my_structured_chunking', on_change=on_settings_change,
+                    help="Markdown and HTML at headings, notebooks at cells, CSV and Excel in groups of rows with their header, PDF by page; "
+                         "small neighboring parts are merged up to the chunk size. Unchecked, every file is cut every chunk size tokens.")
+    use_customized_embedding = st.toggle("Customize embedding throughput", value=False)
+    if use_customized_embedding:
+        st.slider("Embedding batch size", 1, 256, const.EMBED_BATCH_SIZE, key='my_embed_batch_size', on_change=on_settings_change)
+        st.slider("Concurrent embedding requests", 1, 16, const.EMBED_MAX_WORKERS, key='my_embed_workers', on_change=on_settings_change)
+    use_customized_loading = st.toggle("Customize document loading", value=False)
+    if use_customized_loading:
+        st.slider("Parallel document parsers (PDF, Office, media)", 1, 16, const.LOADER_PROCESS_WORKERS, key='my_loader_workers', on_change=on_settings_change)
+    st.selectbox("Embedding storage precision", const.VECTOR_DTYPES, index=0, key='my_vector_dtype', help="float16 halves the index size on disk and int8 quarters it, at a small precision cost.")
+    st.selectbox("Search method", const.ANN_BACKENDS, index=0, key='my_ann_backend', format_func=lambda b: {'exact': 'Exact (brute force)', 'ivf': 'Approximate (IVF), for large corpora'}[b])
+    if st.session_state.my_ann_backend == 'ivf':
+        st.number_input("IVF lists (0 = automatic)", 0, 65536, 0, key='my_ann_nlist', help="More lists make each query scan fewer vectors.")
+        st.slider("IVF lists probed per query", 1, 128, const.ANN_DEFAULT_NPROBE, key='my_ann_nprobe', help="Higher values raise recall at the cost of latency; can be changed later in the chat sidebar.")
+    st.checkbox("Build a keyword index (BM25)", value=True, key='my_keyword_index',
+                help="Lets the chat combine keyword and vector search, for exact terms such as command names, versions or part numbers. No extra embedding is computed.")
 
 st.subheader("Index Name")
-index_name = st.text_input("Enter the name for your new index", key='my_indexname', on_change=on_indexname_change)
+update_mode = st.toggle("Update an existing index (only new, changed or removed local files are processed)", value=False, key='my_update_mode')
+if update_mode:
+    st.selectbox("Select the index to update", utils.func.list_directories(const.INDEX_ROOT_PATH), index=None, key='my_update_indexname', on_change=on_update_indexname_change)
+    st.caption("Use the same embedding model as the one the index was built with.")
+else:
+    index_name = st.text_input("Enter the name for your new index", key='my_indexname', on_change=on_indexname_change)
 container_name = st.container()
 
 st.subheader('Local documents')
-subdirs = utils.func.get_subdirectories(const.DOC_ROOT_PATH)
+# One cached inventory of the whole documents tree; only directories that changed are listed again
+inventory = utils.file_inventory.get_inventory(const.DOC_ROOT_PATH)
+subdirs = inventory.subdirectories()
 st.selectbox("Select the path to the local directory that you had stored your documents", subdirs, key='docspath', on_change=on_docspath_change)
 container_docs = st.container()
-if 'docpath_untouched' not in st.session_state:
-    st.session_state['docpath_untouched'] = True
-    st.session_state.num_of_files_to_read = 0
-if len(subdirs) != 0 and st.session_state['docpath_untouched']:
-    logging.info(f"################ st.session_state['docpath_untouched']: {st.session_state['docpath_untouched']}")
-    on_docspath_change()
+st.session_state.num_of_files_to_read = 0
+if st.session_state.get("docspath"):
+    with container_docs:
+        show_inventory(inventory, st.session_state.docspath)
 
-st.subheader('Online documents')
-list_urls = st.text_area("List of URLs (one per a line)", key='my_urllist', on_change=on_urllist_change)
-container_urls = st.container()
+if not update_mode:
+    st.subheader('Online documents')
+    list_urls = st.text_area("List of URLs (one per a line)", key='my_urllist', on_change=on_urllist_change)
+    container_urls = st.container()
 
 st.warning("Check the model and its configurations on the sidebar (⬅️) and then hit the button below to build a new Index.", icon="⚠️")
 
 container_settings = st.container()
 
 check_if_ready_to_index()
-logging.info(f"Setting Embedding model... {Settings.embed_model}")
+logging.info(f"Embedding model... {st.session_state.get('embed_choice')}")
 
-st.button("Build Index", on_click=index_data, key='my_button', disabled=st.session_state.get("index_button_disabled", True))
+if update_mode:
+    st.button("Update Index", on_click=update_index_data, key='my_update_button', disabled=not (st.session_state.get("my_update_indexname") and st.session_state.get("docspath")))
+else:
+    st.button("Build Index", on_click=index_data, key='my_button', disabled=st.session_state.get("index_button_disabled", True))
 container_status = st.container()
-container_result = st.container()
+
+st.subheader("Build jobs")
+st.caption("Jobs run in background worker processes: you can leave this page or close the tab. A cancelled job resumes from its last checkpoint.")
+# Also restarts the workers of jobs interrupted by a restart of the container
+utils.build_jobs.ensure_workers()
+show_jobs()
 
 st.page_link("app.py", label="Back to home", icon="🏠")
\ No newline at end of file
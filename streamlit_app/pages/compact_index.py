@@ -0,0 +1,98 @@
+import streamlit as st
+import pandas as pd
+
+import os
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_dir)
+import utils.func
+import utils.constants as const
+import utils.index_cache
+import utils.index_compaction
+import utils.ollama_scheduler
+import utils.download_status
+
+# App title
+st.set_page_config(page_title="Jetson Copilot - Compact Index", menu_items=None)
+
+with st.sidebar:
+    utils.download_status.show_downloads()
+
+st.subheader("Compact an index")
+st.caption("Quantize the embeddings, remove chunks with identical text and gzip the docstore. "
+           "The compacted copy is checked against the original before it replaces it; a dry run only reports.")
+
+index_names = utils.func.list_directories(const.INDEX_ROOT_PATH)
+if not index_names:
+    st.info("No index yet. Build one first.", icon=":material/info:")
+    st.page_link("pages/build_index.py", label=" Build a new index", icon="➕")
+    st.stop()
+
+index_name = st.selectbox("Index", index_names, key='compact_index_name')
+persist_dir = os.path.join(const.INDEX_ROOT_PATH, index_name)
+st.caption(f"{utils.func.get_total_size_mib(persist_dir):.1f} MiB on disk")
+
+col1, col2 = st.columns(2)
+with col1:
+    dtype = st.selectbox("Embedding precision", const.VECTOR_DTYPES, index=const.VECTOR_DTYPES.index('float16'),
+                         help="float16 halves the vectors, int8 (with one scale per vector) quarters them.")
+    top_k = st.number_input("Results compared per query (k)", min_value=1, max_value=50, value=const.COMPACT_EVAL_TOP_K)
+with col2:
+    dedupe = st.checkbox("Remove duplicate chunks", value=True, help="Chunks with the same text, e.g. from copies of a document; the first copy is kept.")
+    compress_docstore = st.checkbox("Compress the docstore", value=True)
+questions = st.text_area("Held-out questions (optional, one per line)",
+                         help=f"Measured with {const.COMPACT_EVAL_QUERIES} chunks of the index picked at random when empty; "
+                              f"questions are embedded with {const.DEFAULT_EMBED_MODEL}, which must be downloaded.")
+
+
+def run(dry_run):
+    query_embeddings = None
+    questions_list = [line.strip() for line in questions.splitlines() if line.strip()]
+    if questions_list:
+        from llama_index.embeddings.ollama import OllamaEmbedding
+        with utils.ollama_scheduler.slot(kind='embed'):
+            query_embeddings = OllamaEmbedding(model_name=const.DEFAULT_EMBED_MODEL, base_url=const.OLLAMA_BASE_URL).get_text_embedding_batch(questions_list)
+    report = utils.index_compaction.compact_index(persist_dir, dtype=dtype, dedupe=dedupe, compress_docstore=compress_docstore,
+                                                  top_k=top_k, query_embeddings=query_embeddings, dry_run=dry_run)
+    if not dry_run:
+        utils.index_cache.registry.invalidate(index_name)
+    st.session_state.compact_report = (index_name, report)
+
+
+col1, col2 = st.columns(2)
+with col1:
+    if st.button("Dry run", use_container_width=True):
+        with st.spinner("Measuring..."):
+            try:
+                run(dry_run=True)
+            except utils.ollama_scheduler.OllamaBusy as e:
+                st.warning(str(e), icon="⏳")
+with col2:
+    if st.button("Compact", type="primary", use_container_width=True):
+        with st.spinner(f"Compacting {index_name}..."):
+            try:
+                run(dry_run=False)
+            except RuntimeError as e:
+                st.error(str(e), icon=":material/error:")
+
+if st.session_state.get("compact_report") and st.session_state.compact_report[0] == index_name:
+    report = st.session_state.compact_report[1]
+    before, after = report["before"], report["after"]
+    st.markdown(f"""
+- Embeddings: **`{report['dtype_before']}`** → **`{report['dtype']}`**, {report['num_vectors_before']} → {report['num_vectors_after']} vectors ({report['num_duplicates']} duplicates removed)
+- Size: **`{sum(before.values()) / 2**20:.1f} MiB`** → **`{sum(after.values()) / 2**20:.1f} MiB`** {'(dry run, nothing changed)' if not report['applied'] else ''}
+""")
+    st.dataframe(pd.DataFrame([{'Component': component, 'Before (MiB)': before[component] / 2**20, 'After (MiB)': after[component] / 2**20}
+                               for component in before]).style.format({'Before (MiB)': "{:,.2f}", 'After (MiB)': "{:,.2f}"}), hide_index=True)
+    quality = report["quality"]
+    if quality["queries"]:
+        st.metric(f"Recall@{quality['top_k']} vs the original index", f"{quality['recall_at_k']:.1%}",
+                  delta=f"{quality['recall_at_k'] - 1:.1%}", help=f"Share of the original top-{quality['top_k']} results still retrieved, "
+                                                                  f"over {quality['queries']} held-out queries.")
+        st.caption(f"Top-1 result unchanged for {quality['top1_agreement']:.0%} of the queries.")
+
+st.page_link("app.py", label="Back to home", icon="🏠")
@@ -0,0 +1,69 @@
+import streamlit as st
+import pandas as pd
+
+import os
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_dir)
+import utils.constants as const
+import utils.metrics
+import utils.index_cache
+import utils.embed_cache
+import utils.answer_cache
+import utils.async_generation
+import utils.ollama_scheduler
+import utils.download_status
+
+# App title
+st.set_page_config(page_title="Jetson Copilot - Diagnostics", menu_items=None)
+
+with st.sidebar:
+    utils.download_status.show_downloads()
+
+st.subheader("Latency and throughput")
+st.caption(f"Since the server started; percentiles over the last {const.METRICS_WINDOW} observations of each metric. "
+           f"Also served for Prometheus at `http://<jetson>:{const.METRICS_PORT}/metrics`.")
+# Index builds run in worker processes, which log their spans apart
+utils.metrics.collect_worker_spans()
+summary = utils.metrics.registry.summary()
+if summary:
+    df = pd.DataFrame([{
+        'Metric': row['name'],
+        'Labels': ", ".join(f"{k}={v}" for k, v in row['labels'].items()),
+        'Count': row['count'],
+        'Mean': row['mean'],
+        'p50': row['p50'],
+        'p99': row['p99'],
+        'Last': row['last'],
+    } for row in summary])
+    st.dataframe(df.style.format({'Mean': "{:,.3f}", 'p50': "{:,.3f}", 'p99': "{:,.3f}", 'Last': "{:,.3f}"}), hide_index=True)
+else:
+    st.info("Nothing measured yet. Ask a question or build an index first.", icon=":material/info:")
+
+st.subheader("Caches")
+embed_stats = utils.embed_cache.get_cache().stats()
+answer_stats = utils.answer_cache.get_cache().stats()
+st.markdown(f"""
+- Embedding cache: **`{embed_stats['hit_rate']:.0%}`** hit rate ({embed_stats['hits']} hits, {embed_stats['misses']} misses), {embed_stats['size_mib']:.1f} MiB stored
+- Answer cache: **`{answer_stats['hit_rate']:.0%}`** hit rate ({answer_stats['hits']} hits, {answer_stats['misses']} misses), {answer_stats['entries']} answers stored
+- Loaded indexes: {", ".join(f"`{name}` ({size:.1f} MiB)" for name, size in utils.index_cache.registry.stats()) or "none"}
+- Answers being generated: {", ".join(f"`{model}` {active} running, {waiting} waiting" for model, (active, waiting) in utils.async_generation.stats().items()) or "none"}
+- Ollama requests: {", ".join(f"{priority_class} {counts['running']} running, {counts['waiting']} waiting" for priority_class, counts in utils.ollama_scheduler.get_scheduler().stats().items())} (at most {const.OLLAMA_MAX_IN_FLIGHT} at once)
+""")
+
+st.subheader("Recent spans")
+st.caption(f"From `{os.path.join(const.LOG_ROOT_PATH, const.METRICS_LOG_FNAME)}` (rotated at {const.METRICS_LOG_MAX_MIB} MiB).")
+spans = utils.metrics.read_recent_spans()
+if spans:
+    st.dataframe(pd.DataFrame(spans), hide_index=True)
+
+with st.expander("Prometheus text"):
+    text = utils.metrics.registry.prometheus_text()
+    st.code(text, language=None)
+    st.download_button("Download", text, file_name="metrics.prom")
+
+st.page_link("app.py", label="Back to home", icon="🏠")
@@ -1,8 +1,6 @@
-import ollama
 import streamlit as st
 import pandas as pd
 
-import time
 import os
 
 import logging
@@ -14,13 +12,15 @@ parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, parent_dir)
 import utils.func 
 import utils.constants as const
+import utils.ollama_models
+import utils.download_status
 
 # App title
 st.set_page_config(page_title="Jetson Copilot - Download Model", menu_items=None)
 
 st.subheader("List of Models Already Downloaded")
 with st.spinner('Checking existing models hosted on Ollama...'):
-    models = ollama.list()["models"]
+    models = utils.ollama_models.list_models()
     models_data = []
     for model in models:
         models_data.append((
@@ -51,30 +51,9 @@ def on_newmodel_name_change():
 def download_model():
     logging.info("download_model()")
     newmodel_name = st.session_state.my_newmodel_name
-    with container_status:
-        start_time = time.time()
-        my_bar = st.progress(0, text="progress text")
-        try:
-            for res in ollama.pull(newmodel_name, stream=True):
-                logging.info(res)
-                if 'total' in res and 'completed' in res:
-                    total = res['total']
-                    completed = res['completed']
-                    total_in_mib = total / 1024 / 1024
-                    completed_in_mib = completed / 1024 / 1024
-                    percent = completed / total
-                    my_bar.progress(percent, text=f"Downloading ({completed_in_mib:.1f} MiB / {total_in_mib:.1f} MiB)")
-                else:
-                    my_bar.progress(100, text=f"{res['status']}")
-        except ollama.ResponseError as e:
-            # Handle ResponseError specifically
-            logging.error(f"A ResponseError occurred: {e}")
-            st.error(f"It looks like \"**`{newmodel_name}`**\" is not the right name.", icon="🚨")
-            # You might want to log the error or retry the operation
-        except Exception as e:
-            # Handle any other exceptions
-            logging.error(f"An unexpected error occurred: {e}")
-            st.error(f"Some other error happend : {e}", icon="🚨")
+    # Queued for the download thread: the page can be left or reloaded, and asking twice pulls once
+    job = utils.ollama_models.start_pull(newmodel_name)
+    logging.info(f"Download of {job.name}: {job.state}")
 
 st.subheader("Download a New Model")
 # st.markdown("⚠ Check the model name on [Ollama Library](https://ollama.com/library) page.")
@@ -91,6 +70,6 @@ st.button(
     on_click=download_model, 
     disabled=st.session_state.get("download_model_disabled", True)
 )
-container_status = st.container()
+utils.download_status.show_downloads()
 
 st.page_link("app.py", label="Back to home", icon="🏠")
\ No newline at end of file
@@ -0,0 +1,103 @@
+"""
+Compare IVF approximate search against exact search: recall@k and p50/p99 query latency.
+
+Usage (inside the container, from /opt/jetson_copilot/app):
+
+    python tools/benchmark_ann.py _L4T_README                  # a saved index (binary format)
+    python tools/benchmark_ann.py --synthetic 200000 --dims 1024  # random clustered vectors
+    python tools/benchmark_ann.py --synthetic 100000 --nprobe 1 4 16 64 --k 5
+
+Queries are perturbed copies of stored vectors, so no embedding model is needed.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+import logging
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_dir)
+import utils.constants as const
+import utils.vector_store
+import utils.ann
+
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+
+def synthetic_store(num_vectors, dims, num_clusters=256, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_clusters, dims)).astype(np.float32)
+    labels = rng.integers(0, num_clusters, num_vectors)
+    matrix = centers[labels] + 0.5 * rng.standard_normal((num_vectors, dims)).astype(np.float32)
+    store = utils.vector_store.MmapVectorStore()
+    store._ids = [f"n{i}" for i in range(num_vectors)]
+    store._ref_doc_ids = ["None"] * num_vectors
+    store._matrix = matrix
+    return store
+
+
+def percentile_ms(latencies, q):
+    return float(np.percentile(latencies, q)) * 1000
+
+
+def run_queries(store, queries, k, **kwargs):
+    results, latencies = [], []
+    for q in queries:
+        start_time = time.perf_counter()
+        result = store.query(VectorStoreQuery(query_embedding=q.tolist(), similarity_top_k=k), **kwargs)
+        latencies.append(time.perf_counter() - start_time)
+        results.append(result.ids)
+    return results, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('index', nargs='?', help="Name of a saved index to benchmark")
+    parser.add_argument('--root', default=const.INDEX_ROOT_PATH, help="Directory holding the indexes")
+    parser.add_argument('--synthetic', type=int, metavar='N', help="Benchmark N random clustered vectors instead of an index")
+    parser.add_argument('--dims', type=int, default=1024, help="Dimensions of the synthetic vectors")
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=2, help="Number of results per query (the app uses 2)")
+    parser.add_argument('--nlist', type=int, default=0, help="IVF lists (0 = automatic)")
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    if args.synthetic:
+        store = synthetic_store(args.synthetic, args.dims)
+    elif args.index:
+        store = utils.vector_store.MmapVectorStore.from_persist_dir(os.path.join(args.root, args.index))
+    else:
+        parser.error("give an index name or --synthetic N")
+
+    matrix = np.asarray(store.matrix, dtype=np.float32)
+    rng = np.random.default_rng(1)
+    rows = rng.choice(len(matrix), min(args.queries, len(matrix)), replace=False)
+    noise = rng.standard_normal((len(rows), matrix.shape[1])).astype(np.float32)
+    queries = matrix[rows] + 0.1 * np.linalg.norm(matrix[rows], axis=1, keepdims=True) / np.sqrt(matrix.shape[1]) * noise
+
+    store.ann_backend = 'exact'
+    store._ivf = None
+    exact_ids, exact_latencies = run_queries(store, queries, args.k)
+    print(f"{store.count} vectors x {matrix.shape[1]} dims, {len(queries)} queries, k={args.k}")
+    print(f"{'method':<18} {'recall@k':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    print(f"{'exact':<18} {1.0:>9.3f} {percentile_ms(exact_latencies, 50):>9.2f} {percentile_ms(exact_latencies, 99):>9.2f}")
+
+    store.ann_backend = 'ivf'
+    store.ann_nlist = args.nlist or None
+    store.build_ann()
+    for nprobe in args.nprobe:
+        if nprobe > store._ivf.nlist:
+            continue
+        ivf_ids, ivf_latencies = run_queries(store, queries, args.k, nprobe=nprobe)
+        recall = np.mean([len(set(a) & set(e)) / len(e) for a, e in zip(ivf_ids, exact_ids)])
+        label = f"ivf {store._ivf.nlist}/{nprobe}"
+        print(f"{label:<18} {recall:>9.3f} {percentile_ms(ivf_latencies, 50):>9.2f} {percentile_ms(ivf_latencies, 99):>9.2f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,258 @@
+"""
+Offline benchmark of the index build and chat code paths, against a stub Ollama server.
+
+Builds indexes from synthetic corpora of growing size with the same code as
+the "Build Index" page, then loads them and queries them with the same chat
+engine as the app. Each size runs in its own process so that peak RSS is
+measured per size. Nothing talks to a real Ollama server.
+
+Usage (inside the container, from /opt/jetson_copilot/app):
+
+    python tools/benchmark_rag.py                                   # 1k and 10k chunks
+    python tools/benchmark_rag.py --sizes 1000 10000 100000 1000000 --dims 1024
+    python tools/benchmark_rag.py --save-baseline                   # store the results as the baseline
+    python tools/benchmark_rag.py --embed-ms 5 --token-ms 20        # emulate model latency
+
+Results are compared against the baseline (if any); the exit code is 1 when
+a metric regressed by more than --tolerance.
+"""
+import argparse
+import gc
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import logging
+logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_dir)
+import utils.constants as const
+
+# (metric, unit, True if higher is better)
+METRICS = [
+    ('build_seconds', 's', False),
+    ('build_chunks_per_sec', 'chunks/s', True),
+    ('index_mib', 'MiB', False),
+    ('load_seconds', 's', False),
+    ('retrieval_p50_ms', 'ms', False),
+    ('retrieval_p95_ms', 'ms', False),
+    ('retrieval_p99_ms', 'ms', False),
+    ('chat_ttft_ms', 'ms', False),
+    ('chat_total_ms', 'ms', False),
+    ('peak_rss_mib', 'MiB', False),
+]
+
+DEFAULT_BASELINE_PATH = os.path.join(const.LOG_ROOT_PATH, 'benchmark_baseline.json')
+
+
+def synthetic_documents(num_docs, vocabulary_size=20000, words_per_doc=120, seed=0):
+    """
+    Generate documents of random words with a Zipf-like frequency, each small enough to be one chunk.
+
+    Yields:
+    Document: Deterministic for a given seed.
+    """
+    from llama_index.core import Document
+
+    rng = np.random.default_rng(seed)
+    weights = 1.0 / np.arange(1, vocabulary_size + 1)
+    weights /= weights.sum()
+    for i in range(num_docs):
+        words = rng.choice(vocabulary_size, words_per_doc, p=weights)
+        yield Document(text=" ".join(f"w{w}" for w in words), id_=f"doc-{i}", metadata={"file_name": f"doc-{i}.txt"})
+
+
+def synthetic_queries(num_queries, vocabulary_size=20000, seed=1):
+    rng = np.random.default_rng(seed)
+    return [" ".join(f"w{w}" for w in rng.integers(0, vocabulary_size // 10, 8)) for _ in range(num_queries)]
+
+
+def percentile_ms(latencies, q):
+    return float(np.percentile(latencies, q)) * 1000
+
+
+def run_single(args):
+    """Benchmark one corpus size in this process and print the results as one JSON line."""
+    from tools.stub_ollama import StubOllama, start_server
+
+    workdir = tempfile.mkdtemp(prefix='rag-bench-', dir=args.workdir)
+    # Keep the benchmark's caches away from the real ones
+    const.CACHE_ROOT_PATH = os.path.join(workdir, '.cache')
+
+    from llama_index.core import VectorStoreIndex, Settings, load_index_from_storage
+    from llama_index.core.chat_engine import ContextChatEngine
+    from llama_index.llms.ollama import Ollama
+    from llama_index.embeddings.ollama import OllamaEmbedding
+    import utils.func
+    import utils.vector_store
+    import utils.embed_pipeline
+    import utils.embed_cache
+    import utils.chat_context
+    import utils.context_budget
+
+    stub = StubOllama(dims=args.dims, embed_ms=args.embed_ms, token_ms=args.token_ms,
+                      first_token_ms=args.first_token_ms, answer_tokens=args.answer_tokens)
+    server, base_url = start_server(stub)
+    embed_model = OllamaEmbedding(model_name="mxbai-embed-large:latest", base_url=base_url)
+    if args.embed_cache:
+        embed_model = utils.embed_cache.cached(embed_model)
+    Settings.embed_model = embed_model
+    Settings.llm = Ollama(model="llama3:latest", base_url=base_url, request_timeout=300.0)
+    results = {'size': args.single}
+
+    try:
+        # Build, as pages/build_index.py does
+        persist_dir = os.path.join(workdir, 'index')
+        start_time = time.perf_counter()
+        storage_context = utils.vector_store.new_storage_context(args.dtype, ann_backend=args.ann_backend)
+        index = VectorStoreIndex(nodes=[], storage_context=storage_context)
+        pipeline = utils.embed_pipeline.EmbeddingPipeline(embed_model, batch_size=args.batch_size, max_workers=args.workers)
+        nodes = utils.embed_pipeline.iter_chunks(synthetic_documents(args.single), Settings.node_parser, storage_context.docstore)
+        num_chunks = utils.embed_pipeline.insert_embedded_nodes(index, pipeline.run(nodes))
+        index.storage_context.persist(persist_dir=persist_dir)
+        results['build_seconds'] = time.perf_counter() - start_time
+        results['chunks'] = num_chunks
+        results['build_chunks_per_sec'] = num_chunks / results['build_seconds']
+        results['index_mib'] = utils.func.get_total_size_mib(persist_dir)
+        del index, storage_context, pipeline
+        gc.collect()
+
+        # Load, as app.py does
+        start_time = time.perf_counter()
+        index = load_index_from_storage(utils.vector_store.load_storage_context(persist_dir))
+        results['load_seconds'] = time.perf_counter() - start_time
+
+        # Retrieval, including the query embedding round trip
+        retriever = index.as_retriever(similarity_top_k=2)
+        queries = synthetic_queries(args.queries)
+        retriever.retrieve(queries[0])   # warm-up: builds the search matrix
+        latencies = []
+        for query in queries:
+            start_time = time.perf_counter()
+            retriever.retrieve(query)
+            latencies.append(time.perf_counter() - start_time)
+        results['retrieval_p50_ms'] = percentile_ms(latencies, 50)
+        results['retrieval_p95_ms'] = percentile_ms(latencies, 95)
+        results['retrieval_p99_ms'] = percentile_ms(latencies, 99)
+
+        # Chat turns, with the chat engine configuration of app.py
+        context_prompt = "Here are the relevant documents for the context:\n{context_str}"
+        token_budget = utils.context_budget.token_budget("llama3:latest")
+        chat_engine = ContextChatEngine.from_defaults(
+            retriever=index.as_retriever(),
+            memory=utils.chat_context.CompactingChatMemory.from_history([], token_budget),
+            node_postprocessors=[utils.chat_context.BudgetNodePostprocessor(
+                token_budget=token_budget, reserved_tokens=utils.context_budget.count_tokens(context_prompt))],
+            llm=Settings.llm,
+            context_template=context_prompt)
+        ttfts, totals = [], []
+        for query in queries[:args.chats]:
+            start_time = time.perf_counter()
+            first_token_time = None
+            for _ in chat_engine.stream_chat(query).response_gen:
+                if first_token_time is None:
+                    first_token_time = time.perf_counter()
+            ttfts.append((first_token_time or time.perf_counter()) - start_time)
+            totals.append(time.perf_counter() - start_time)
+        results['chat_ttft_ms'] = percentile_ms(ttfts, 50)
+        results['chat_total_ms'] = percentile_ms(totals, 50)
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    # ru_maxrss is in KiB on Linux
+    results['peak_rss_mib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps(results))
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the results next to the baseline and count regressions.
+
+    Returns:
+    int: The number of metrics worse than the baseline by more than `tolerance`.
+    """
+    regressions = 0
+    for size, result in results.items():
+        print(f"\n== {size} chunks ==")
+        base = (baseline or {}).get(size, {})
+        print(f"{'metric':<22} {'value':>12} {'baseline':>12} {'change':>8}")
+        for name, unit, higher_is_better in METRICS:
+            value = result.get(name)
+            if value is None:
+                continue
+            line = f"{name:<22} {value:>12.2f}"
+            if name in base and base[name]:
+                change = (value - base[name]) / base[name]
+                worse = -change if higher_is_better else change
+                flag = "  REGRESSION" if worse > tolerance else ""
+                regressions += bool(flag)
+                line += f" {base[name]:>12.2f} {change:>+7.0%}{flag}"
+            print(f"{line}  {unit}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000], help="Corpus sizes, in chunks")
+    parser.add_argument('--dims', type=int, default=1024, help="Embedding dimensions of the stub")
+    parser.add_argument('--embed-ms', type=float, default=0.0, help="Stub latency per embedding request")
+    parser.add_argument('--token-ms', type=float, default=0.0, help="Stub delay between streamed tokens")
+    parser.add_argument('--first-token-ms', type=float, default=0.0, help="Stub delay before the first token")
+    parser.add_argument('--answer-tokens', type=int, default=64)
+    parser.add_argument('--queries', type=int, default=200, help="Retrieval queries per size")
+    parser.add_argument('--chats', type=int, default=5, help="Chat turns per size")
+    parser.add_argument('--batch-size', type=int, default=const.EMBED_BATCH_SIZE)
+    parser.add_argument('--workers', type=int, default=const.EMBED_MAX_WORKERS)
+    parser.add_argument('--dtype', default='float32', choices=const.VECTOR_DTYPES)
+    parser.add_argument('--ann-backend', default='exact', choices=const.ANN_BACKENDS)
+    parser.add_argument('--embed-cache', action='store_true', help="Wrap the embedding model with the embedding cache, as the app does")
+    parser.add_argument('--workdir', default=None, help="Where to build the temporary indexes (default: system temp dir)")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH, help="Baseline results to compare against")
+    parser.add_argument('--save-baseline', action='store_true', help="Store these results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Relative change counted as a regression")
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        run_single(args)
+        return 0
+
+    forwarded = [a for a in sys.argv[1:] if a != '--save-baseline']
+    results = {}
+    for size in args.sizes:
+        print(f"> Benchmarking {size} chunks...", flush=True)
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--single', str(size)] + forwarded,
+                             capture_output=True, text=True, cwd=parent_dir)
+        if out.returncode != 0:
+            print(out.stdout[-2000:], out.stderr[-4000:])
+            return 2
+        results[str(size)] = json.loads(out.stdout.strip().splitlines()[-1])
+
+    baseline = None
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f).get('results')
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump({'config': {k: v for k, v in vars(args).items() if k not in ('single', 'save_baseline', 'baseline')},
+                       'results': results}, f, indent=1)
+        print(f"\nBaseline saved to {args.baseline}")
+    elif baseline is None:
+        print(f"\nNo baseline at {args.baseline}; run with --save-baseline to store one.")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
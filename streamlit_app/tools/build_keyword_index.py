@@ -0,0 +1,52 @@
+"""
+Add a BM25 keyword index to saved indexes, for hybrid (keywords + vectors) search.
+
+Indexes built with "Build a keyword index" checked already have one; use this
+for indexes built before, such as the bundled _L4T_README.
+
+Usage (inside the container, from /opt/jetson_copilot/app):
+
+    python tools/build_keyword_index.py                   # every index under Indexes/
+    python tools/build_keyword_index.py _L4T_README       # only the given index(es)
+    python tools/build_keyword_index.py --force           # rebuild existing keyword indexes
+"""
+import argparse
+import os
+import sys
+
+import logging
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_dir)
+import utils.func
+import utils.constants as const
+import utils.bm25
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('indexes', nargs='*', help="Index names (default: all)")
+    parser.add_argument('--root', default=const.INDEX_ROOT_PATH, help="Directory holding the indexes")
+    parser.add_argument('--force', action='store_true', help="Rebuild keyword indexes that already exist")
+    args = parser.parse_args()
+
+    names = args.indexes or utils.func.list_directories(args.root)
+    failed = 0
+    for name in names:
+        persist_dir = os.path.join(args.root, name)
+        if utils.bm25.has_keyword_index(persist_dir) and not args.force:
+            logging.info(f"> '{name}': already has a keyword index, skipping")
+            continue
+        try:
+            keyword_index = utils.bm25.BM25Index.from_storage(persist_dir)
+            keyword_index.save(persist_dir)
+            logging.info(f"> '{name}': {len(keyword_index)} nodes, {keyword_index.num_terms} terms")
+        except Exception as e:
+            failed += 1
+            logging.error(f"!!!!!! '{name}': keyword index failed: {e}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""
+Check that the exact search paths return the same nodes as llama_index's SimpleVectorStore.
+
+For each set of vectors, the same queries are answered by SimpleVectorStore
+(the reference) and by ExactSearchIndex (single and batched), MmapVectorStore
+(exact and restricted to node ids) and ExactSimpleVectorStore. Ids must match
+and similarities agree within --atol; results whose order differs only
+between tied scores are accepted.
+
+Usage (inside the container, from /opt/jetson_copilot/app):
+
+    python tools/check_exact_search.py                          # random vectors
+    python tools/check_exact_search.py _L4T_README              # saved indexes (JSON or binary format)
+    python tools/check_exact_search.py --synthetic 20000 --dims 256 --k 1 2 5
+
+Queries are perturbed copies of stored vectors plus random vectors, so no
+embedding model is needed. The exit code is 1 when any result differs.
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+
+import logging
+logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_dir)
+import utils.constants as const
+import utils.vector_store
+import utils.exact_search
+
+from llama_index.core.vector_stores import SimpleVectorStore
+from llama_index.core.vector_stores.simple import SimpleVectorStoreData
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+
+def load_vectors(persist_dir):
+    # The stored (decoded) embeddings: both sides search the same float32 values
+    if utils.vector_store.has_binary_store(persist_dir):
+        store = utils.vector_store.MmapVectorStore.from_persist_dir(persist_dir)
+        return store.node_ids, np.asarray(store.matrix, dtype=np.float32)
+    reference = SimpleVectorStore.from_persist_path(os.path.join(persist_dir, const.VECTOR_STORE_JSON_FNAME))
+    embedding_dict = reference.data.embedding_dict
+    return list(embedding_dict.keys()), np.asarray(list(embedding_dict.values()), dtype=np.float32)
+
+
+def synthetic_vectors(num_vectors, dims, seed=0):
+    rng = np.random.default_rng(seed)
+    return [f"n{i}" for i in range(num_vectors)], rng.standard_normal((num_vectors, dims)).astype(np.float32)
+
+
+def make_queries(matrix, num_queries, seed=1):
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, len(matrix), num_queries - num_queries // 2)
+    perturbed = matrix[rows] + 0.1 * rng.standard_normal((len(rows), matrix.shape[1])).astype(np.float32)
+    random = rng.standard_normal((num_queries // 2, matrix.shape[1])).astype(np.float32)
+    return np.vstack([perturbed, random])
+
+
+def ids_and_scores(result):
+    return result.ids, result.similarities
+
+
+def same_result(expected, boundary, ids, similarities, atol):
+    """
+    Compare a result with the reference.
+
+    Parameters:
+    expected (VectorStoreQueryResult): The reference result, with one result more than asked for.
+    boundary (int): The number of results asked for.
+    ids (list): The ids returned by the path checked.
+    similarities (list): Their similarities.
+    atol (float): Tolerance on the similarities.
+
+    Returns:
+    str: What differs, or None.
+    """
+    expected_ids, expected_scores = list(expected.ids[:boundary]), np.asarray(expected.similarities[:boundary])
+    if len(ids) != len(expected_ids):
+        return f"{len(ids)} results instead of {len(expected_ids)}"
+    if not np.allclose(similarities, expected_scores, rtol=0, atol=atol):
+        return f"similarities {np.round(similarities, 6).tolist()} instead of {np.round(expected_scores, 6).tolist()}"
+    if ids == expected_ids:
+        return None
+    # Tied scores may come in another order, or tie with the first result left out
+    all_scores = np.asarray(expected.similarities)
+    for position, (got, want) in enumerate(zip(ids, expected_ids)):
+        if got == want:
+            continue
+        neighbours = [all_scores[p] for p in (position - 1, position + 1) if 0 <= p < len(all_scores)]
+        if not any(abs(all_scores[position] - score) <= atol for score in neighbours):
+            return f"ids {ids} instead of {expected_ids}"
+    return None
+
+
+def check(name, ids, matrix, queries, ks, atol, seed=2):
+    reference = SimpleVectorStore(data=SimpleVectorStoreData(embedding_dict={i: row.tolist() for i, row in zip(ids, matrix)}))
+    exact_simple = utils.exact_search.ExactSimpleVectorStore(data=SimpleVectorStoreData(embedding_dict=dict(reference.data.embedding_dict)))
+    search_index = utils.exact_search.ExactSearchIndex(ids, matrix)
+    mmap_store = utils.vector_store.MmapVectorStore()
+    mmap_store._ids = list(ids)
+    mmap_store._ref_doc_ids = ["None"] * len(ids)
+    mmap_store._matrix = matrix
+    subset = sorted(np.random.default_rng(seed).choice(len(ids), max(len(ids) // 10, 1), replace=False).tolist())
+    subset_ids = [ids[row] for row in subset]
+
+    failures = 0
+    for k in ks:
+        batched = search_index.search_batch(queries, k)
+        for q, query in enumerate(queries):
+            query_list = query.tolist()
+            expected = reference.query(VectorStoreQuery(query_embedding=query_list, similarity_top_k=k + 1))
+            expected_subset = reference.query(VectorStoreQuery(query_embedding=query_list, similarity_top_k=k + 1, node_ids=subset_ids))
+            results = {
+                "ExactSearchIndex.search": search_index.search(query, k),
+                "ExactSearchIndex.search_batch": batched[q],
+                "MmapVectorStore.query": ids_and_scores(mmap_store.query(VectorStoreQuery(query_embedding=query_list, similarity_top_k=k))),
+                "ExactSimpleVectorStore.query": ids_and_scores(exact_simple.query(VectorStoreQuery(query_embedding=query_list, similarity_top_k=k))),
+            }
+            for path, (got_ids, got_scores) in results.items():
+                difference = same_result(expected, k, list(got_ids), got_scores, atol)
+                if difference is not None:
+                    failures += 1
+                    print(f"!!! {name}, k={k}, query {q}, {path}: {difference}")
+            subset_result = mmap_store.query(VectorStoreQuery(query_embedding=query_list, similarity_top_k=k, node_ids=subset_ids))
+            difference = same_result(expected_subset, k, list(subset_result.ids), subset_result.similarities, atol)
+            if difference is not None:
+                failures += 1
+                print(f"!!! {name}, k={k}, query {q}, MmapVectorStore.query with node_ids: {difference}")
+    print(f"{name}: {len(ids)} vectors, {len(queries)} queries, k={ks}: {'OK' if not failures else f'{failures} differences'}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('indexes', nargs='*', help="Saved indexes to check (default: random vectors only)")
+    parser.add_argument('--root', default=const.INDEX_ROOT_PATH, help="Directory holding the indexes")
+    parser.add_argument('--synthetic', type=int, default=5000, help="Random vectors to check (0: none)")
+    parser.add_argument('--dims', type=int, default=256)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--k', type=int, nargs='+', default=[1, 2, 5])
+    parser.add_argument('--atol', type=float, default=1e-5, help="Tolerance on the similarities")
+    args = parser.parse_args()
+
+    failures = 0
+    if args.synthetic:
+        ids, matrix = synthetic_vectors(args.synthetic, args.dims)
+        failures += check(f"{args.synthetic} random {args.dims}-d vectors", ids, matrix, make_queries(matrix, args.queries), args.k, args.atol)
+    for name in args.indexes:
+        ids, matrix = load_vectors(os.path.join(args.root, name))
+        failures += check(name, ids, matrix, make_queries(matrix, args.queries), args.k, args.atol)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
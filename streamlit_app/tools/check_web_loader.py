@@ -0,0 +1,200 @@
+"""
+Check ConcurrentWebLoader against local HTTP servers: revalidation, the page cache, per-host limits and per-URL timings.
+
+Two servers on 127.0.0.1 (two hosts, told apart by their port) each serve
+--pages HTML pages, answering after --delay seconds. Even pages carry an
+ETag and a Last-Modified date, odd pages only Last-Modified. The pages, plus
+one missing page per server, are loaded twice into the same, new page cache:
+
+- first run: every page is fetched (200), converted to text and cached;
+- second run: every page is revalidated, answered 304 Not Modified and
+  served from the cache, with the same text as in the first run.
+
+In both runs the missing pages must be reported as failures, each page must
+have one timing of at least --delay, and no server may see more than
+--max-per-host requests at once (nor fewer than 2, which would mean the
+pages were not fetched concurrently).
+
+Usage (inside the container, from /opt/jetson_copilot/app):
+
+    python tools/check_web_loader.py
+    python tools/check_web_loader.py --pages 40 --delay 0.1 --max-per-host 2 --convert-workers 1
+
+No network access is needed. The exit code is 1 when any check fails.
+"""
+import argparse
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import logging
+logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_dir)
+import utils.constants as const
+import utils.web_loader
+
+LAST_MODIFIED = 'Mon, 01 Jan 2024 00:00:00 GMT'
+
+
+def page_html(number):
+    return (f"<html><head><title>Page {number}</title></head>"
+            f"<body><h1>Page {number}</h1><p>The text of <b>page {number}</b>.</p></body></html>")
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so that the pooled connections of the loader are reused
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+        try:
+            time.sleep(server.delay)
+            status, headers, body = self._respond()
+        finally:
+            with server.lock:
+                server.active -= 1
+        with server.lock:
+            server.statuses[status] += 1
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _respond(self):
+        match = re.fullmatch(r'/page/(\d+)', self.path)
+        if match is None:
+            return 404, [], b''
+        number = int(match.group(1))
+        etag = f'"page-{number}"' if number % 2 == 0 else None
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            return 304, [('ETag', etag)], b''
+        if etag is None and self.headers.get('If-Modified-Since') == LAST_MODIFIED:
+            return 304, [], b''
+        headers = [('Content-Type', 'text/html; charset=utf-8'), ('Last-Modified', LAST_MODIFIED)]
+        if etag is not None:
+            headers.append(('ETag', etag))
+        return 200, headers, page_html(number).encode()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PageServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 64
+
+    def __init__(self, delay):
+        super().__init__(('127.0.0.1', 0), PageHandler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+        self.statuses = Counter()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def reset(self):
+        with self.lock:
+            self.peak = 0
+            self.statuses.clear()
+
+
+def check_run(name, loader, texts, servers, page_urls, missing_urls, expected_status, expected_texts, args):
+    """
+    Check a run of the loader against the servers.
+
+    Parameters:
+    name (str): The run, for the report.
+    loader (ConcurrentWebLoader): The loader, after the run.
+    texts (dict): {url: text} of the documents it yielded.
+    servers (list): The PageServer instances.
+    page_urls (list): The URLs of the existing pages.
+    missing_urls (list): The URLs answered with 404.
+    expected_status (int): 200 or 304, the status every existing page must get.
+    expected_texts (dict): {url: text} the documents must have, or None.
+    args (Namespace): The command line arguments.
+
+    Returns:
+    list: What went wrong, as messages.
+    """
+    errors = []
+    expected_source = 'fetched' if expected_status == 200 else 'cached'
+    if sorted(url for url, _ in loader.failures) != sorted(missing_urls):
+        errors.append(f"failures {loader.failures} instead of the missing pages {missing_urls}")
+    timed_urls = [url for url, _, _ in loader.latencies]
+    if sorted(timed_urls) != sorted(page_urls) or sorted(texts) != sorted(page_urls):
+        errors.append(f"{len(timed_urls)} timings and {len(texts)} documents for {len(page_urls)} pages")
+    for url, seconds, source in loader.latencies:
+        if source != expected_source:
+            errors.append(f"{url}: {source} instead of {expected_source}")
+        if seconds < args.delay:
+            errors.append(f"{url}: timed {seconds:.3f}s, below the {args.delay}s the server waits")
+    for url, text in texts.items():
+        if expected_texts is not None and text != expected_texts.get(url):
+            errors.append(f"{url}: the text differs from the first run")
+        elif expected_texts is None and f"# Page {url.rsplit('/', 1)[1]}" not in text:
+            errors.append(f"{url}: not converted to Markdown: {text[:80]!r}")
+    for server in servers:
+        if server.statuses[expected_status] != args.pages:
+            errors.append(f"{server.url}: answered {dict(server.statuses)}, expected {args.pages} x {expected_status}")
+        if server.peak > args.max_per_host:
+            errors.append(f"{server.url}: {server.peak} requests at once, above the limit of {args.max_per_host}")
+        elif server.peak < min(2, args.max_per_host, args.pages):
+            errors.append(f"{server.url}: at most {server.peak} request at once, the pages were not fetched concurrently")
+
+    for error in errors:
+        print(f"!!! {name}: {error}")
+    seconds = [seconds for _, seconds, _ in loader.latencies]
+    print(f"{name}: {len(loader.latencies)} pages, {len(loader.failures)} failed, "
+          f"{min(seconds, default=0):.2f}-{max(seconds, default=0):.2f}s per page, "
+          f"peak {[server.peak for server in servers]} requests per host: {'OK' if not errors else f'{len(errors)} errors'}")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=12, help="Pages per server")
+    parser.add_argument('--delay', type=float, default=0.2, help="Seconds each server waits before answering")
+    parser.add_argument('--workers', type=int, default=const.WEB_MAX_WORKERS)
+    parser.add_argument('--max-per-host', type=int, default=const.WEB_MAX_PER_HOST)
+    parser.add_argument('--convert-workers', type=int, default=const.WEB_CONVERT_WORKERS)
+    args = parser.parse_args()
+
+    servers = [PageServer(args.delay) for _ in range(2)]
+    page_urls = [f"{server.url}/page/{number}" for server in servers for number in range(args.pages)]
+    missing_urls = [f"{server.url}/missing" for server in servers]
+    failures = 0
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = utils.web_loader.WebPageCache(os.path.join(cache_dir, const.WEB_CACHE_FNAME))
+        expected_texts = None
+        for name, expected_status in (("first run", 200), ("second run", 304)):
+            for server in servers:
+                server.reset()
+            loader = utils.web_loader.ConcurrentWebLoader(
+                page_urls + missing_urls, max_workers=args.workers, max_per_host=args.max_per_host,
+                convert_workers=args.convert_workers, cache=cache)
+            texts = {doc.id_: doc.text for doc in loader}
+            failures += len(check_run(name, loader, texts, servers, page_urls, missing_urls, expected_status, expected_texts, args))
+            expected_texts = texts
+    for server in servers:
+        server.shutdown()
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
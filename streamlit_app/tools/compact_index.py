@@ -0,0 +1,79 @@
+"""
+Compact saved indexes: quantize the embeddings, drop duplicate chunks and gzip the docstore.
+
+Prints the size of each component before and after, and how much of the
+original top-k results the compacted embeddings still retrieve.
+
+Usage (inside the container, from /opt/jetson_copilot/app):
+
+    python tools/compact_index.py                        # every index under Indexes/, to float16
+    python tools/compact_index.py _L4T_README --dtype int8
+    python tools/compact_index.py _L4T_README --dtype int8 --dry-run
+    python tools/compact_index.py _L4T_README --queries questions.txt   # measure with real questions (needs Ollama)
+"""
+import argparse
+import os
+import sys
+
+import logging
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_dir)
+import utils.func
+import utils.constants as const
+import utils.index_compaction
+
+
+def print_report(name, report):
+    print(f"\n{name}: {report['dtype_before']} -> {report['dtype']}, "
+          f"{report['num_vectors_before']} -> {report['num_vectors_after']} vectors ({report['num_duplicates']} duplicates)"
+          f"{'' if report['applied'] else ' [dry run]'}")
+    print(f"{'component':<26}{'before MiB':>12}{'after MiB':>12}")
+    for component in report["before"]:
+        print(f"{component:<26}{report['before'][component] / 2**20:>12.2f}{report['after'][component] / 2**20:>12.2f}")
+    print(f"{'total':<26}{sum(report['before'].values()) / 2**20:>12.2f}{sum(report['after'].values()) / 2**20:>12.2f}")
+    quality = report["quality"]
+    if quality["queries"]:
+        print(f"recall@{quality['top_k']} vs original: {quality['recall_at_k']:.3f}, "
+              f"top-1 agreement: {quality['top1_agreement']:.3f} ({quality['queries']} queries)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('indexes', nargs='*', help="Index names to compact (default: all)")
+    parser.add_argument('--root', default=const.INDEX_ROOT_PATH, help="Directory holding the indexes")
+    parser.add_argument('--dtype', default='float16', choices=const.VECTOR_DTYPES)
+    parser.add_argument('--keep-duplicates', action='store_true', help="Do not remove chunks with identical text")
+    parser.add_argument('--no-compress', action='store_true', help="Keep the docstore as plain JSON")
+    parser.add_argument('--eval-queries', type=int, default=const.COMPACT_EVAL_QUERIES, help="Held-out chunks used as queries")
+    parser.add_argument('--top-k', type=int, default=const.COMPACT_EVAL_TOP_K)
+    parser.add_argument('--queries', help="File with one question per line to measure with instead of held-out chunks")
+    parser.add_argument('--embed-model', default=const.DEFAULT_EMBED_MODEL, help="Model used to embed --queries")
+    parser.add_argument('--dry-run', action='store_true', help="Only report; leave the indexes untouched")
+    args = parser.parse_args()
+
+    query_embeddings = None
+    if args.queries:
+        from llama_index.embeddings.ollama import OllamaEmbedding
+        with open(args.queries) as f:
+            questions = [line.strip() for line in f if line.strip()]
+        query_embeddings = OllamaEmbedding(model_name=args.embed_model, base_url=const.OLLAMA_BASE_URL).get_text_embedding_batch(questions)
+
+    names = args.indexes or utils.func.list_directories(args.root)
+    failed = 0
+    for name in names:
+        try:
+            report = utils.index_compaction.compact_index(
+                os.path.join(args.root, name), dtype=args.dtype, dedupe=not args.keep_duplicates,
+                compress_docstore=not args.no_compress, num_queries=args.eval_queries, top_k=args.top_k,
+                query_embeddings=query_embeddings, dry_run=args.dry_run)
+            print_report(name, report)
+        except Exception as e:
+            failed += 1
+            logging.error(f"!!!!!! '{name}': compaction failed: {e}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
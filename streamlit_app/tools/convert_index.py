@@ -0,0 +1,49 @@
+"""
+Convert saved indexes from the JSON vector store to the binary (memory-mapped) format.
+
+Usage (inside the container, from /opt/jetson_copilot/app):
+
+    python tools/convert_index.py                   # every index under Indexes/
+    python tools/convert_index.py _L4T_README       # only the given index(es)
+    python tools/convert_index.py --dtype float16 --remove-json
+"""
+import argparse
+import os
+import sys
+
+import logging
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_dir)
+import utils.func
+import utils.constants as const
+import utils.vector_store
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('indexes', nargs='*', help="Index names to convert (default: all)")
+    parser.add_argument('--root', default=const.INDEX_ROOT_PATH, help="Directory holding the indexes")
+    parser.add_argument('--dtype', default='float32', choices=const.VECTOR_DTYPES)
+    parser.add_argument('--remove-json', action='store_true', help="Delete default__vector_store.json after a verified conversion")
+    args = parser.parse_args()
+
+    names = args.indexes or utils.func.list_directories(args.root)
+    failed = 0
+    for name in names:
+        persist_dir = os.path.join(args.root, name)
+        if not os.path.isfile(os.path.join(persist_dir, const.VECTOR_STORE_JSON_FNAME)):
+            logging.info(f"> '{name}': no JSON vector store, skipping")
+            continue
+        try:
+            count = utils.vector_store.convert_json_index(persist_dir, dtype=args.dtype, remove_json=args.remove_json)
+            logging.info(f"> '{name}': {count} vectors converted and verified")
+        except Exception as e:
+            failed += 1
+            logging.error(f"!!!!!! '{name}': conversion failed: {e}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,181 @@
+"""
+Load test of the Ollama scheduler against the stub Ollama server.
+
+Runs chat sessions, index-build embedding workers and model downloads at the
+same time, each request taking a slot of its priority class like the app does
+(see utils/ollama_scheduler.py), and reports per class how long requests
+waited, how long they took and how many were rejected, along with the peak
+number of requests the server saw at once. Nothing talks to a real Ollama
+server, and the scheduler uses a database of its own.
+
+Usage (inside the container, from /opt/jetson_copilot/app):
+
+    python tools/load_test_ollama.py                                  # 4 chat sessions, 4 embedding workers, 1 download
+    python tools/load_test_ollama.py --sessions 16 --build-workers 8 --token-ms 20
+    python tools/load_test_ollama.py --no-scheduler                   # the same load, sent straight to the server
+
+The exit code is 1 when the server saw more requests at once than the
+scheduler allows.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+import logging
+logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_dir)
+import utils.constants as const
+import utils.ollama_scheduler
+from tools.stub_ollama import StubOllama, start_server
+
+CHAT_MODEL = 'llama3:latest'
+EMBED_MODEL = 'mxbai-embed-large:latest'
+
+
+class Results:
+    """Per-class timings and rejections, filled from the client threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.rows = {priority_class: {"wait": [], "first": [], "total": [], "rejected": 0}
+                     for priority_class in utils.ollama_scheduler.PRIORITIES}
+
+    def add(self, priority_class, wait, total, first=None):
+        with self._lock:
+            row = self.rows[priority_class]
+            row["wait"].append(wait)
+            row["total"].append(total)
+            if first is not None:
+                row["first"].append(first)
+
+    def reject(self, priority_class):
+        with self._lock:
+            self.rows[priority_class]["rejected"] += 1
+
+
+def make_slot(scheduler):
+    @contextmanager
+    def slot(priority_class, kind):
+        # Yields the seconds spent waiting for the slot
+        start_time = time.perf_counter()
+        if scheduler is None:
+            yield 0.0
+            return
+        request_id = scheduler.acquire(priority_class, kind)
+        try:
+            yield time.perf_counter() - start_time
+        finally:
+            scheduler.release(request_id)
+    return slot
+
+
+def chat_session(client, slot, results, questions, think_sec):
+    for i in range(questions):
+        start_time = time.perf_counter()
+        try:
+            with slot(utils.ollama_scheduler.INTERACTIVE, 'chat') as wait:
+                first = None
+                for chunk in client.chat(model=CHAT_MODEL, messages=[{"role": "user", "content": f"question {i}"}], stream=True):
+                    if first is None:
+                        first = time.perf_counter() - start_time
+            results.add(utils.ollama_scheduler.INTERACTIVE, wait, time.perf_counter() - start_time, first)
+        except utils.ollama_scheduler.OllamaBusy:
+            results.reject(utils.ollama_scheduler.INTERACTIVE)
+        time.sleep(think_sec)
+
+
+def build_worker(client, slot, results, batches, batch_size):
+    for i in range(batches):
+        start_time = time.perf_counter()
+        try:
+            with slot(utils.ollama_scheduler.BUILD, 'embed') as wait:
+                # One request per text, as llama_index's OllamaEmbedding sends them
+                for j in range(batch_size):
+                    client.embeddings(model=EMBED_MODEL, prompt=f"chunk {i} {j}")
+            results.add(utils.ollama_scheduler.BUILD, wait, time.perf_counter() - start_time)
+        except utils.ollama_scheduler.OllamaBusy:
+            results.reject(utils.ollama_scheduler.BUILD)
+
+
+def download(client, slot, results, name):
+    start_time = time.perf_counter()
+    try:
+        with slot(utils.ollama_scheduler.DOWNLOAD, 'pull') as wait:
+            for res in client.pull(name, stream=True):
+                pass
+        results.add(utils.ollama_scheduler.DOWNLOAD, wait, time.perf_counter() - start_time)
+    except utils.ollama_scheduler.OllamaBusy:
+        results.reject(utils.ollama_scheduler.DOWNLOAD)
+
+
+def percentile_ms(values, q):
+    return f"{np.percentile(values, q) * 1000:.0f}" if values else "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=4, help="Concurrent chat sessions")
+    parser.add_argument('--questions', type=int, default=5, help="Questions asked by each session")
+    parser.add_argument('--think-ms', type=float, default=200, help="Pause between two questions of a session")
+    parser.add_argument('--build-workers', type=int, default=4, help="Concurrent embedding workers")
+    parser.add_argument('--batches', type=int, default=40, help="Embedding batches sent by each worker")
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--downloads', type=int, default=1, help="Concurrent model pulls")
+    parser.add_argument('--token-ms', type=float, default=10, help="Stub delay between chat tokens (and pull steps)")
+    parser.add_argument('--answer-tokens', type=int, default=32)
+    parser.add_argument('--embed-ms', type=float, default=20, help="Stub latency of an embedding request")
+    parser.add_argument('--max-in-flight', type=int, default=const.OLLAMA_MAX_IN_FLIGHT)
+    parser.add_argument('--no-scheduler', action='store_true', help="Send the requests without taking slots, for comparison")
+    args = parser.parse_args()
+
+    stub = StubOllama(dims=64, embed_ms=args.embed_ms, token_ms=args.token_ms, answer_tokens=args.answer_tokens,
+                      models=[CHAT_MODEL, EMBED_MODEL])
+    server, base_url = start_server(stub)
+    import ollama
+    client = ollama.Client(host=base_url)
+
+    scheduler = None
+    db_dir = tempfile.mkdtemp(prefix='ollama_scheduler_')
+    if not args.no_scheduler:
+        scheduler = utils.ollama_scheduler.Scheduler(os.path.join(db_dir, const.OLLAMA_SCHEDULER_FNAME), max_in_flight=args.max_in_flight)
+    slot = make_slot(scheduler)
+    results = Results()
+
+    threads = [threading.Thread(target=build_worker, args=(client, slot, results, args.batches, args.batch_size))
+               for _ in range(args.build_workers)]
+    threads += [threading.Thread(target=download, args=(client, slot, results, f"model{i}:latest")) for i in range(args.downloads)]
+    threads += [threading.Thread(target=chat_session, args=(client, slot, results, args.questions, args.think_ms / 1000))
+                for _ in range(args.sessions)]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start_time
+    server.shutdown()
+    shutil.rmtree(db_dir, ignore_errors=True)
+
+    print(f"{'scheduler off' if scheduler is None else f'scheduler on (max {args.max_in_flight} in flight)'}: "
+          f"{elapsed:.1f}s, peak {stub.peak_in_flight} requests at once on the server")
+    print(f"{'class':<12} {'done':>5} {'rejected':>8} {'wait p50':>9} {'wait p95':>9} {'first p50':>10} {'first p95':>10} {'total p50':>10} {'total p95':>10}  (ms)")
+    for priority_class, row in results.rows.items():
+        print(f"{priority_class:<12} {len(row['total']):>5} {row['rejected']:>8} {percentile_ms(row['wait'], 50):>9} {percentile_ms(row['wait'], 95):>9} "
+              f"{percentile_ms(row['first'], 50):>10} {percentile_ms(row['first'], 95):>10} "
+              f"{percentile_ms(row['total'], 50):>10} {percentile_ms(row['total'], 95):>10}")
+    if scheduler is not None and stub.peak_in_flight > args.max_in_flight:
+        print(f"!!! The server saw {stub.peak_in_flight} requests at once, more than the {args.max_in_flight} allowed")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,305 @@
+"""
+Deterministic stand-in for the Ollama HTTP API, for offline benchmarks and local testing.
+
+Serves the endpoints the app uses: /api/tags, /api/ps, /api/show, /api/chat,
+/api/generate, /api/embeddings, /api/embed and /api/pull. Embeddings are
+hashed bag-of-words vectors, so that texts sharing words are similar and
+retrieval behaves like with a real model; chat answers are generated word by
+word with a fixed per-token delay. Models are "loaded" on their first request
+(with an optional load delay) and unloaded when their keep_alive expires, as
+reported by /api/ps.
+
+Usage:
+
+    python tools/stub_ollama.py --port 11435 --dims 1024 --embed-ms 5 --token-ms 20
+
+    OLLAMA_HOST=http://localhost:11435 streamlit run app.py   # point the app at the stub
+"""
+import argparse
+import hashlib
+import json
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+DEFAULT_MODELS = ['llama3:latest', 'mxbai-embed-large:latest']
+DEFAULT_KEEP_ALIVE_SEC = 300
+MODEL_SIZE = 1024 * 1024
+_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def parse_keep_alive(value):
+    """Seconds a model stays loaded, as Ollama reads keep_alive: None for ever, 0 to unload."""
+    if value is None:
+        return DEFAULT_KEEP_ALIVE_SEC
+    if isinstance(value, str):
+        match = re.fullmatch(r'(-?[\d.]+)(ms|s|m|h)?', value.strip())
+        value = float(match.group(1)) * _DURATION_UNITS[match.group(2) or 's'] if match else DEFAULT_KEEP_ALIVE_SEC
+    return None if value < 0 else float(value)
+
+
+class StubOllama:
+    """
+    Configuration and behavior of the stub server.
+
+    Parameters:
+    dims (int): Embedding dimensions.
+    embed_ms (float): Latency added to every embedding request.
+    token_ms (float): Delay between two streamed chat tokens.
+    first_token_ms (float): Delay before the first chat token (prompt processing).
+    answer_tokens (int): Number of tokens in every chat answer.
+    models (list): Model names reported by /api/tags.
+    load_ms (float): Delay of the first request to a model that is not loaded.
+    """
+
+    def __init__(self, dims=1024, embed_ms=0.0, token_ms=0.0, first_token_ms=0.0, answer_tokens=64, models=None, load_ms=0.0):
+        self.dims = dims
+        self.embed_ms = embed_ms
+        self.token_ms = token_ms
+        self.first_token_ms = first_token_ms
+        self.answer_tokens = answer_tokens
+        self.models = list(models or DEFAULT_MODELS)
+        self.load_ms = load_ms
+        self.loaded = {}   # model name -> expiry (time.time()), None for ever
+        self.loads = 0
+        self.requests = 0
+        self.in_flight = 0        # model requests (embed, chat, generate, pull) being served
+        self.peak_in_flight = 0
+        self._word_vectors = {}
+        self._lock = threading.Lock()
+
+    def load(self, name, keep_alive=None):
+        """Load a model for a request unless it is loaded, and set its expiry."""
+        seconds = parse_keep_alive(keep_alive)
+        if seconds == 0:
+            with self._lock:
+                self.loaded.pop(name, None)
+            return
+        if name not in self.running():
+            time.sleep(self.load_ms / 1000)
+            self.loads += 1
+        with self._lock:
+            self.loaded[name] = None if seconds is None else time.time() + seconds
+
+    def running(self):
+        now = time.time()
+        with self._lock:
+            return {name: expiry for name, expiry in self.loaded.items() if expiry is None or expiry > now}
+
+    def _word_vector(self, word):
+        vector = self._word_vectors.get(word)
+        if vector is None:
+            seed = int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+            vector = np.random.default_rng(seed).standard_normal(self.dims).astype(np.float32)
+            with self._lock:
+                self._word_vectors[word] = vector
+        return vector
+
+    def embed(self, text):
+        words = re.findall(r'\w+', text.lower()) or ['']
+        vector = np.sum([self._word_vector(word) for word in words], axis=0)
+        return (vector / (np.linalg.norm(vector) or 1.0)).tolist()
+
+    def answer_words(self, messages):
+        prompt = messages[-1]['content'] if messages else ''
+        words = re.findall(r'\w+', prompt) or ['stub']
+        return [f"{words[i % len(words)]} " for i in range(self.answer_tokens)]
+
+
+def make_handler(stub):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _read_json(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return json.loads(self.rfile.read(length) or b'{}')
+
+        def _send_json(self, payload, status=200):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _start_stream(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+
+        def _send_chunk(self, payload):
+            data = (json.dumps(payload) + '\n').encode('utf-8')
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def _end_stream(self):
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+        def _model_entry(self, name):
+            return {'name': name, 'model': name, 'size': MODEL_SIZE, 'digest': hashlib.sha256(name.encode()).hexdigest(),
+                    'modified_at': '2024-01-01T00:00:00Z',
+                    'details': {'format': 'gguf', 'family': 'stub', 'parameter_size': '0B', 'quantization_level': 'F32'}}
+
+        def do_GET(self):
+            stub.requests += 1
+            if self.path.startswith('/api/tags'):
+                self._send_json({'models': [self._model_entry(name) for name in stub.models]})
+            elif self.path.startswith('/api/ps'):
+                self._send_json({'models': [dict(self._model_entry(name), size_vram=MODEL_SIZE,
+                                                 expires_at=datetime.fromtimestamp(expiry or 2 ** 31, timezone.utc).isoformat())
+                                            for name, expiry in stub.running().items()]})
+            elif self.path == '/':
+                body = b'Ollama is running'
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self._send_json({'error': 'not found'}, 404)
+
+        def do_HEAD(self):
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def do_POST(self):
+            stub.requests += 1
+            request = self._read_json()
+            path = self.path.split('?')[0]
+            if path == '/api/show':
+                self._send_json({'modelfile': '', 'parameters': '', 'template': '', 'details': self._model_entry(request.get('name', ''))['details']})
+                return
+            with stub._lock:
+                stub.in_flight += 1
+                stub.peak_in_flight = max(stub.peak_in_flight, stub.in_flight)
+            try:
+                self._serve(path, request)
+            finally:
+                with stub._lock:
+                    stub.in_flight -= 1
+
+        def _serve(self, path, request):
+            if path in ('/api/embeddings', '/api/embed', '/api/chat', '/api/generate'):
+                stub.load(request.get('model'), request.get('keep_alive'))
+            if path == '/api/embeddings':
+                time.sleep(stub.embed_ms / 1000)
+                self._send_json({'embedding': stub.embed(request.get('prompt', ''))})
+            elif path == '/api/embed':
+                inputs = request.get('input', '')
+                inputs = [inputs] if isinstance(inputs, str) else inputs
+                time.sleep(stub.embed_ms / 1000)
+                self._send_json({'model': request.get('model'), 'embeddings': [stub.embed(text) for text in inputs]})
+            elif path in ('/api/chat', '/api/generate'):
+                self._chat(request, path == '/api/chat')
+            elif path == '/api/pull':
+                self._pull(request)
+            else:
+                self._send_json({'error': 'not found'}, 404)
+
+        def _chat(self, request, is_chat):
+            model = request.get('model')
+            messages = request.get('messages') or [{'role': 'user', 'content': request.get('prompt', '')}]
+            words = stub.answer_words(messages) if (is_chat or request.get('prompt')) else []
+            created_at = datetime.now(timezone.utc).isoformat()
+
+            def part(text, done):
+                payload = {'model': model, 'created_at': created_at, 'done': done}
+                if is_chat:
+                    payload['message'] = {'role': 'assistant', 'content': text}
+                else:
+                    payload['response'] = text
+                if done:
+                    payload.update({'done_reason': 'stop', 'eval_count': len(words), 'total_duration': 0})
+                return payload
+
+            time.sleep(stub.first_token_ms / 1000)
+            if not request.get('stream', True):
+                time.sleep(stub.token_ms * len(words) / 1000)
+                self._send_json(part(''.join(words), True))
+                return
+            self._start_stream()
+            for i, word in enumerate(words):
+                if i:
+                    time.sleep(stub.token_ms / 1000)
+                self._send_chunk(part(word, False))
+            self._send_chunk(part('', True))
+            self._end_stream()
+
+        def _pull(self, request):
+            name = request.get('name') or request.get('model')
+            if not request.get('stream', True):
+                if name not in stub.models:
+                    stub.models.append(name)
+                self._send_json({'status': 'success'})
+                return
+            self._start_stream()
+            self._send_chunk({'status': 'pulling manifest'})
+            total = 100 * 1024 * 1024
+            for step in range(1, 11):
+                time.sleep(stub.token_ms / 1000)
+                try:
+                    self._send_chunk({'status': f'pulling {name}', 'digest': 'sha256:stub', 'total': total, 'completed': total * step // 10})
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client cancelled: Ollama stops the pull, keeping what it downloaded
+                    self.close_connection = True
+                    return
+            if name not in stub.models:
+                stub.models.append(name)
+            self._send_chunk({'status': 'success'})
+            self._end_stream()
+
+    return Handler
+
+
+def start_server(stub, host='127.0.0.1', port=0):
+    """
+    Run the stub in a background thread.
+
+    Parameters:
+    stub (StubOllama): The stub configuration.
+    host (str): Address to bind.
+    port (int): Port to bind; 0 picks a free one.
+
+    Returns:
+    tuple: (server, base_url). Call `server.shutdown()` to stop it.
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(stub))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name='stub-ollama').start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11435)
+    parser.add_argument('--dims', type=int, default=1024)
+    parser.add_argument('--embed-ms', type=float, default=0.0, help="Latency of each embedding request")
+    parser.add_argument('--token-ms', type=float, default=0.0, help="Delay between streamed tokens")
+    parser.add_argument('--first-token-ms', type=float, default=0.0, help="Delay before the first token")
+    parser.add_argument('--answer-tokens', type=int, default=64)
+    parser.add_argument('--load-ms', type=float, default=0.0, help="Delay of the first request to a model not loaded")
+    args = parser.parse_args()
+
+    stub = StubOllama(args.dims, args.embed_ms, args.token_ms, args.first_token_ms, args.answer_tokens, load_ms=args.load_ms)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(stub))
+    print(f"Stub Ollama listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
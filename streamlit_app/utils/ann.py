@@ -0,0 +1,156 @@
+import os
+import json
+import time
+
+import numpy as np
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+import utils.constants as const
+
+
+def normalize_rows(matrix):
+    """
+    Scale the rows of a matrix to unit length (zero rows are left as is).
+
+    Parameters:
+    matrix (np.ndarray): Vectors, one per row.
+
+    Returns:
+    np.ndarray: A float32 copy with unit-length rows.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def default_nlist(num_vectors):
+    """A common rule of thumb: about 4 * sqrt(N) lists, with enough vectors per list to train on."""
+    return int(max(1, min(4 * np.sqrt(num_vectors), num_vectors // 39)))
+
+
+class IVFIndex:
+    """
+    Inverted-file (IVF) approximate nearest-neighbor index over a NumPy matrix.
+
+    The vectors are clustered with spherical k-means into `nlist` lists. A
+    query is compared against the list centroids first, and only the vectors
+    of the `nprobe` closest lists are scored. Raising `nprobe` trades latency
+    for recall; `nprobe == nlist` is an exact search.
+
+    Only the clustering (centroids and the row order grouped by list) is
+    stored; the vectors themselves stay in the vector store's matrix.
+    """
+
+    def __init__(self, nlist, nprobe=const.ANN_DEFAULT_NPROBE):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroids = None   # (nlist, dims) unit vectors
+        self.order = None       # row numbers, grouped by list
+        self.offsets = None     # list i holds order[offsets[i]:offsets[i + 1]]
+
+    @property
+    def num_vectors(self):
+        return 0 if self.order is None else len(self.order)
+
+    def train(self, matrix, iterations=const.ANN_TRAIN_ITERATIONS, sample_size=const.ANN_TRAIN_SAMPLE, seed=0):
+        """
+        Cluster the rows of `matrix` and build the inverted lists.
+
+        Parameters:
+        matrix (np.ndarray): The vectors to index, one per row.
+        iterations (int): Number of k-means iterations.
+        sample_size (int): The centroids are trained on at most this many rows.
+        seed (int): Random seed, so that rebuilding an index is deterministic.
+        """
+        start_time = time.time()
+        vectors = normalize_rows(matrix)
+        self.nlist = max(1, min(self.nlist, len(vectors)))
+        rng = np.random.default_rng(seed)
+        sample = vectors
+        if len(vectors) > sample_size:
+            sample = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+
+        centroids = sample[rng.choice(len(sample), self.nlist, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            counts = np.bincount(assignment, minlength=self.nlist)
+            # An empty list keeps its previous centroid
+            empty = counts == 0
+            sums[empty] = centroids[empty]
+            centroids = normalize_rows(sums)
+        self.centroids = centroids
+
+        assignment = self._assign(vectors)
+        self.order = np.argsort(assignment, kind='stable').astype(np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=self.nlist))]).astype(np.int64)
+        logging.info(f" ### IVFIndex: {len(vectors)} vectors in {self.nlist} lists, trained in {time.time() - start_time:.1f}s")
+
+    def _assign(self, vectors, block_size=8192):
+        assignment = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), block_size):
+            assignment[start:start + block_size] = np.argmax(vectors[start:start + block_size] @ self.centroids.T, axis=1)
+        return assignment
+
+    def candidates(self, query, nprobe=None):
+        """
+        Get the row numbers worth scoring for a query.
+
+        Parameters:
+        query (np.ndarray): The query vector.
+        nprobe (int): Number of lists to visit (default: self.nprobe).
+
+        Returns:
+        np.ndarray: Row numbers of the vectors in the closest lists.
+        """
+        nprobe = max(1, min(nprobe or self.nprobe, self.nlist))
+        q = normalize_rows(np.asarray(query, dtype=np.float32).reshape(1, -1))[0]
+        scores = self.centroids @ q
+        if nprobe < self.nlist:
+            lists = np.argpartition(-scores, nprobe - 1)[:nprobe]
+        else:
+            lists = np.arange(self.nlist)
+        return np.concatenate([self.order[self.offsets[i]:self.offsets[i + 1]] for i in lists])
+
+    def save(self, persist_dir):
+        path = os.path.join(persist_dir, const.ANN_IVF_FNAME)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, centroids=self.centroids, order=self.order, offsets=self.offsets)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, persist_dir, nprobe=const.ANN_DEFAULT_NPROBE):
+        ivf = cls(0, nprobe)
+        with np.load(os.path.join(persist_dir, const.ANN_IVF_FNAME)) as data:
+            ivf.centroids = data['centroids']
+            ivf.order = data['order']
+            ivf.offsets = data['offsets']
+        ivf.nlist = len(ivf.centroids)
+        return ivf
+
+
+def save_ann_config(persist_dir, config):
+    path = os.path.join(persist_dir, const.ANN_CONFIG_FNAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(config, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def load_ann_config(persist_dir):
+    """
+    Read the ANN settings of an index.
+
+    Returns:
+    dict: {"backend": "exact" or "ivf", "nlist": int or None (automatic), "nprobe": int};
+        "exact" if no config was saved.
+    """
+    path = os.path.join(persist_dir, const.ANN_CONFIG_FNAME)
+    if not os.path.isfile(path):
+        return {"backend": "exact"}
+    with open(path) as f:
+        return json.load(f)
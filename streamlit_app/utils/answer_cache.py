@@ -0,0 +1,157 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+
+import numpy as np
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+import utils.constants as const
+import utils.func
+
+
+def make_cache_key(model, index_fingerprint, system_prompt):
+    """
+    Scope of a cached answer: the same question only hits with the same model, index content and system prompt.
+
+    Parameters:
+    model (str): The LLM name.
+    index_fingerprint (str): Fingerprint of the index files, or "" without RAG.
+    system_prompt (str): The system prompt (with its context placeholder).
+
+    Returns:
+    str: The cache key.
+    """
+    prompt_hash = hashlib.sha256((system_prompt or "").encode('utf-8')).hexdigest()
+    return utils.func.make_fingerprint(model, index_fingerprint, prompt_hash)
+
+
+class AnswerCache:
+    """
+    Semantic cache of generated answers.
+
+    A new prompt hits when a prompt asked before under the same cache key has
+    an embedding with a cosine similarity of at least `threshold`. Entries
+    expire after `ttl_sec`, and the least recently used ones are evicted
+    beyond `max_entries`. Entries of an index are dropped when it is rebuilt.
+    """
+
+    def __init__(self, path, threshold=const.ANSWER_CACHE_THRESHOLD, ttl_sec=const.ANSWER_CACHE_TTL_SEC,
+                 max_entries=const.ANSWER_CACHE_MAX_ENTRIES):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.threshold = threshold
+        self.ttl_sec = ttl_sec
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS answers (
+            id INTEGER PRIMARY KEY, cache_key TEXT, index_name TEXT, prompt TEXT,
+            embedding BLOB, answer TEXT, created REAL, last_used REAL)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_key ON answers (cache_key)")
+        self._conn.commit()
+
+    def lookup(self, cache_key, embedding):
+        """
+        Find the answer to the most similar earlier prompt.
+
+        Parameters:
+        cache_key (str): See make_cache_key().
+        embedding (list): Embedding of the new prompt.
+
+        Returns:
+        tuple: (answer, similarity, earlier prompt), or None on a miss.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, prompt, embedding, answer FROM answers WHERE cache_key=? AND created>?",
+                (cache_key, time.time() - self.ttl_sec)).fetchall()
+            best = None
+            if rows:
+                matrix = np.stack([np.frombuffer(row[2], dtype=np.float32) for row in rows])
+                q = np.asarray(embedding, dtype=np.float32)
+                norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(q)
+                norms[norms == 0] = 1.0
+                scores = matrix @ q / norms
+                i = int(np.argmax(scores))
+                if scores[i] >= self.threshold:
+                    best = rows[i], float(scores[i])
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE answers SET last_used=? WHERE id=?", (time.time(), best[0][0]))
+            self._conn.commit()
+        return best[0][3], best[1], best[0][1]
+
+    def put(self, cache_key, index_name, prompt, embedding, answer):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO answers (cache_key, index_name, prompt, embedding, answer, created, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (cache_key, index_name, prompt, np.asarray(embedding, dtype=np.float32).tobytes(), answer, now, now))
+            self._conn.execute("DELETE FROM answers WHERE created<=?", (now - self.ttl_sec,))
+            self._conn.execute(
+                "DELETE FROM answers WHERE id IN (SELECT id FROM answers ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,))
+            self._conn.commit()
+
+    def invalidate_index(self, index_name):
+        """Drop the answers generated with an index, e.g. after it was rebuilt."""
+        with self._lock:
+            # Answers from several indexes store their names one per line
+            deleted = self._conn.execute("DELETE FROM answers WHERE index_name=? OR instr(char(10) || index_name || char(10), ?) > 0",
+                                         (index_name, f"\n{index_name}\n")).rowcount
+            self._conn.commit()
+        if deleted:
+            logging.info(f" ### AnswerCache: dropped {deleted} answers of index '{index_name}'")
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        """
+        Summarize the cache usage of this process.
+
+        Returns:
+        dict: hits, misses, hit_rate and entries.
+        """
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate, "entries": entries}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Get the process-wide AnswerCache, opening it on first use."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = AnswerCache(os.path.join(const.CACHE_ROOT_PATH, const.ANSWER_CACHE_FNAME))
+        return _cache
+
+
+def replay(answer):
+    """
+    Stream a cached answer back in small pieces, like a generation would.
+
+    Parameters:
+    answer (str): The cached answer.
+
+    Yields:
+    str: Words with their trailing whitespace.
+    """
+    yield from re.findall(r'\S+\s*|\s+', answer)
@@ -0,0 +1,340 @@
+import time
+import uuid
+import asyncio
+import threading
+import contextvars
+from collections import OrderedDict, deque
+
+import ollama
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+import utils.constants as const
+import utils.metrics
+import utils.ollama_scheduler
+
+# The generation being run by the current task, for code deep in llama_index (see utils/chat_context.py)
+current_generation = contextvars.ContextVar("current_generation", default=None)
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_loop():
+    """The event loop shared by all sessions, running in a background thread."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True, name="generation-loop").start()
+        return _loop
+
+
+_client = None
+
+
+def get_client():
+    """The async Ollama client, created on the loop (call from a coroutine only)."""
+    global _client
+    if _client is None:
+        _client = ollama.AsyncClient()
+    return _client
+
+
+def concurrency(model):
+    """Number of generations a model may run at once (GENERATION_CONCURRENCY_BY_MODEL, by full name then family)."""
+    for key in (model, model.split(':')[0]):
+        if key in const.GENERATION_CONCURRENCY_BY_MODEL:
+            return const.GENERATION_CONCURRENCY_BY_MODEL[key]
+    return const.GENERATION_CONCURRENCY
+
+
+class FairLimiter:
+    """
+    Let at most `limit` generations run at once, admitting the waiting ones round-robin by session.
+
+    A session that queues several generations only gets one slot per round,
+    so it cannot hold back the others. Only used from the event loop.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self._waiters = OrderedDict()   # session id -> deque of futures
+
+    @property
+    def waiting(self):
+        return sum(len(queue) for queue in self._waiters.values())
+
+    def position(self, session_id):
+        """Rough number of generations admitted before the first one of a session (0 if it has none waiting)."""
+        if session_id not in self._waiters:
+            return 0
+        return list(self._waiters).index(session_id) + 1
+
+    async def acquire(self, session_id):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(session_id, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Admitted just as it was cancelled: hand the slot on
+                self.release()
+            else:
+                queue = self._waiters.get(session_id)
+                if queue is not None and future in queue:
+                    queue.remove(future)
+                    if not queue:
+                        del self._waiters[session_id]
+            raise
+
+    def release(self):
+        self.active -= 1
+        while self._waiters and self.active < self.limit:
+            session_id, queue = next(iter(self._waiters.items()))
+            future = queue.popleft()
+            if queue:
+                self._waiters.move_to_end(session_id)
+            else:
+                del self._waiters[session_id]
+            if not future.cancelled():
+                self.active += 1
+                future.set_result(None)
+
+
+_limiters = {}
+
+
+def _limiter(model):
+    limiter = _limiters.get(model)
+    if limiter is None:
+        limiter = _limiters[model] = FairLimiter(concurrency(model))
+    return limiter
+
+
+def stats():
+    """Generations running and waiting per model: {model: (active, waiting)}."""
+    return {model: (limiter.active, limiter.waiting) for model, limiter in list(_limiters.items())}
+
+
+class Generation:
+    """
+    A chat answer generated on the shared event loop, read from the Streamlit script thread.
+
+    The chunks are kept, so a rerun of the script can show what was generated
+    so far and keep streaming from there; the generation itself goes on in
+    the background until it ends or is cancelled.
+
+    Attributes:
+    id (str): Unique id, e.g. for widget keys.
+    state (str): 'queued', 'running', 'done', 'cancelled' or 'failed'.
+    error (Exception): What made it fail.
+    prompt_tokens (int): Estimated prompt size, once known.
+    retrieval_seconds (float): Time spent retrieving documents, for RAG answers.
+    """
+
+    def __init__(self, session_id, model, request_id=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.session_id = session_id
+        self.model = model
+        self.request_id = request_id
+        self.state = 'queued'
+        self.error = None
+        self.prompt_tokens = None
+        self.retrieval_seconds = 0.0
+        self._chunks = []
+        self._cond = threading.Condition()
+        self._tasks = []
+
+    @property
+    def text(self):
+        with self._cond:
+            return "".join(self._chunks)
+
+    @property
+    def done(self):
+        return self.state in ('done', 'cancelled', 'failed')
+
+    def queue_position(self):
+        """Sessions served before this one while it waits for a slot (0 once running)."""
+        if self.state != 'queued':
+            return 0
+        return _limiter(self.model).position(self.session_id)
+
+    def attach(self, task):
+        """Cancel `task` along with the generation (e.g. the task llama_index streams the LLM output in)."""
+        self._tasks.append(task)
+
+    def _set_state(self, state, error=None):
+        with self._cond:
+            self.state = state
+            self.error = error
+            self._cond.notify_all()
+
+    def _emit(self, chunk):
+        with self._cond:
+            self._chunks.append(chunk)
+            self._cond.notify_all()
+
+    def wait_started(self, timeout):
+        """Wait until the generation left the queue. Returns True if it did."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.state != 'queued', timeout)
+
+    def stream(self, start=0):
+        """
+        Iterate over the chunks from the `start`-th on, blocking for new ones; for `st.write_stream`.
+
+        The iteration ends when the generation does, whether it was completed,
+        cancelled or failed: `state` and `error` tell which. Closing the iterator
+        (e.g. when Streamlit stops the script) does not cancel the generation;
+        cancel() does.
+        """
+        position = start
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._chunks) > position or self.done)
+                chunks = self._chunks[position:]
+                finished = self.done
+            for chunk in chunks:
+                yield chunk
+            position += len(chunks)
+            if finished and not chunks:
+                break
+
+    def cancel(self):
+        """Stop the generation; safe to call from any thread, and more than once."""
+        get_loop().call_soon_threadsafe(self._cancel_tasks)
+
+    def _cancel_tasks(self):
+        for task in self._tasks:
+            task.cancel()
+
+
+async def _run(generation, make_stream):
+    labels = {"model": generation.model}
+    current_generation.set(generation)
+    limiter = _limiter(generation.model)
+    submitted = time.perf_counter()
+    try:
+        await limiter.acquire(generation.session_id)
+    except asyncio.CancelledError:
+        generation._set_state('cancelled')
+        return
+    utils.metrics.record("generation_queue_seconds", time.perf_counter() - submitted, generation.request_id, **labels)
+    generation._set_state('running')
+    first_token_time = None
+    num_tokens = 0
+    try:
+        async for chunk in make_stream():
+            if first_token_time is None:
+                first_token_time = time.perf_counter()
+                utils.metrics.record("time_to_first_token_seconds", first_token_time - submitted, generation.request_id, **labels)
+            num_tokens += 1
+            generation._emit(chunk)
+        generation._set_state('done')
+    except asyncio.CancelledError:
+        logging.info(f" ### Generation {generation.id} cancelled after {num_tokens} chunks")
+        generation._set_state('cancelled')
+    except Exception as e:
+        logging.error(f"!!!!!! Generation {generation.id} with {generation.model} failed: {e}")
+        generation._set_state('failed', e)
+    finally:
+        limiter.release()
+        for task in generation._tasks[1:]:
+            task.cancel()
+    end_time = time.perf_counter()
+    utils.metrics.record("generation_seconds", end_time - submitted, generation.request_id, **labels)
+    if first_token_time is not None and end_time > first_token_time:
+        utils.metrics.record("generation_tokens_per_second", num_tokens / (end_time - first_token_time), generation.request_id, **labels)
+
+
+def start(session_id, model, make_stream, request_id=None):
+    """
+    Start a generation on the shared event loop.
+
+    It waits for one of the model's slots (see concurrency()), taken in turn
+    by the sessions with generations waiting.
+
+    Parameters:
+    session_id (str): The Streamlit session, for fairness.
+    model (str): The model generating, for its concurrency limit.
+    make_stream (callable): Called on the loop, returns an async iterator of text chunks.
+    request_id (str): See utils.metrics.record().
+
+    Returns:
+    Generation: The handle to stream from (see Generation.stream()) or cancel.
+    """
+    generation = Generation(session_id, model, request_id)
+    loop = get_loop()
+    context = contextvars.copy_context()
+
+    def submit():
+        generation.attach(loop.create_task(_run(generation, make_stream), context=context))
+
+    loop.call_soon_threadsafe(submit)
+    return generation
+
+
+async def ensure_loaded(model):
+    """Wait for a model to be loaded (see utils.ollama_models.warm()), without blocking the loop."""
+    import utils.ollama_models
+
+    def wait():
+        job = utils.ollama_models.warm(model)
+        while not job.done:
+            time.sleep(0.05)
+
+    await asyncio.to_thread(wait)
+
+
+async def chat_stream(model, messages):
+    """
+    Stream a chat answer from Ollama without RAG.
+
+    Yields:
+    str: The generated chunks.
+    """
+    generation = current_generation.get()
+    async with utils.ollama_scheduler.aslot(utils.ollama_scheduler.INTERACTIVE, kind='chat'):
+        stream = await get_client().chat(model=model, messages=messages, stream=True, keep_alive=const.MODEL_KEEP_ALIVE)
+        async for chunk in stream:
+            if chunk.get("done") and "prompt_eval_count" in chunk:
+                # Counted by the model's own tokenizer; Ollama leaves it out when the prompt was fully cached
+                utils.metrics.record("prompt_eval_tokens", chunk["prompt_eval_count"], generation and generation.request_id, model=model)
+            yield chunk["message"]["content"]
+
+
+async def rag_stream(chat_engine, chat_memory, model, prompt):
+    """
+    Stream a RAG answer with the chat engine's `astream_chat`.
+
+    The chat model is made ready while the question is embedded and the
+    documents retrieved, instead of after.
+
+    Yields:
+    str: The generated chunks.
+    """
+    generation = current_generation.get()
+    loading = asyncio.create_task(ensure_loaded(model))
+    start_time = time.perf_counter()
+    try:
+        response = await chat_engine.astream_chat(prompt)
+    except BaseException:
+        loading.cancel()
+        raise
+    if generation is not None:
+        # Query embedding and retrieval are timed apart (see ThreadedRetriever); the rest of the setup is prompt assembly
+        setup = time.perf_counter() - start_time
+        utils.metrics.record("rag_setup_seconds", setup, generation.request_id, model=model)
+        utils.metrics.record("prompt_assembly_seconds", max(0.0, setup - generation.retrieval_seconds), generation.request_id, model=model)
+        generation.prompt_tokens = chat_memory.last_prompt_tokens
+    await loading
+    async for token in response.async_response_gen():
+        yield token
@@ -0,0 +1,254 @@
+import os
+import re
+import time
+import threading
+from collections import Counter
+from typing import Any, List
+
+import numpy as np
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.constants import DEFAULT_SIMILARITY_TOP_K
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+import utils.constants as const
+import utils.exact_search
+import utils.metrics
+import utils.vector_store
+
+# Words, numbers and identifiers such as jetson_clocks, r36.3, tegra-x1 or /etc/nvpmodel.conf
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[._\-/][a-z0-9]+)*")
+TOKEN_SEPARATORS = re.compile(r"[._\-/]")
+MAX_TOKEN_LENGTH = 40
+
+
+def tokenize(text):
+    """
+    Split text into lowercase terms for keyword search.
+
+    Identifiers are kept whole and also split into their parts, so that
+    "L4T R36.3" matches both "r36.3" and "r36", and "jetson_clocks" matches
+    "jetson clocks".
+
+    Parameters:
+    text (str): The text.
+
+    Returns:
+    list: The terms, in order, with repetitions.
+    """
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if len(token) > MAX_TOKEN_LENGTH:
+            continue
+        tokens.append(token)
+        if TOKEN_SEPARATORS.search(token):
+            tokens.extend(part for part in TOKEN_SEPARATORS.split(token) if part)
+    return tokens
+
+
+def _pack_strings(strings):
+    # One newline-separated byte buffer: fixed-width numpy string arrays would pad every entry to the longest one
+    return np.frombuffer("\n".join(strings).encode('utf-8'), dtype=np.uint8)
+
+
+def _unpack_strings(buffer):
+    text = buffer.tobytes().decode('utf-8')
+    return text.split("\n") if text else []
+
+
+class BM25Index:
+    """
+    Inverted index with BM25 scoring over the nodes of an index.
+
+    Postings are stored in CSR form: the documents containing term `t` are
+    `doc_ids[indptr[t]:indptr[t + 1]]`, with their term frequencies in
+    `term_freqs`. A query only touches the postings of its own terms.
+    """
+
+    def __init__(self, node_ids, terms, indptr, doc_ids, term_freqs, doc_lengths, k1=const.BM25_K1, b=const.BM25_B):
+        self.node_ids = list(node_ids)
+        self.term_ids = {term: i for i, term in enumerate(terms)}
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.term_freqs = term_freqs.astype(np.float32)
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        num_docs = len(self.node_ids)
+        doc_freqs = np.diff(indptr).astype(np.float32)
+        self.idf = np.log1p((num_docs - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype(np.float32)
+        avgdl = float(doc_lengths.mean()) if num_docs else 1.0
+        # Per-document part of the BM25 denominator, computed once
+        self._norm = (k1 * (1 - b + b * doc_lengths / max(avgdl, 1.0))).astype(np.float32)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    @property
+    def num_terms(self):
+        return len(self.term_ids)
+
+    @classmethod
+    def build(cls, node_ids, texts, k1=const.BM25_K1, b=const.BM25_B):
+        """
+        Build the index.
+
+        Parameters:
+        node_ids (list): Node ids.
+        texts (iterable): The text of each node, in the same order.
+
+        Returns:
+        BM25Index: The index.
+        """
+        start_time = time.time()
+        vocabulary = {}
+        posting_terms, posting_docs, posting_freqs = [], [], []
+        doc_lengths = np.zeros(len(node_ids), dtype=np.int32)
+        for doc, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_lengths[doc] = sum(counts.values())
+            for term, count in counts.items():
+                posting_terms.append(vocabulary.setdefault(term, len(vocabulary)))
+                posting_docs.append(doc)
+                posting_freqs.append(count)
+        posting_terms = np.asarray(posting_terms, dtype=np.int32)
+        order = np.argsort(posting_terms, kind='stable')
+        indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(posting_terms, minlength=len(vocabulary)), out=indptr[1:])
+        index = cls(node_ids, list(vocabulary), indptr,
+                    np.asarray(posting_docs, dtype=np.int32)[order],
+                    np.minimum(np.asarray(posting_freqs, dtype=np.int64)[order], np.iinfo(np.uint16).max).astype(np.uint16),
+                    doc_lengths, k1, b)
+        logging.info(f" ### BM25Index: {len(node_ids)} nodes, {len(vocabulary)} terms, {len(order)} postings in {time.time() - start_time:.2f}s")
+        return index
+
+    @classmethod
+    def from_index(cls, index):
+        """Build the keyword index over the nodes of a VectorStoreIndex, as stored in its docstore."""
+        return cls._from_docstore(index.index_struct, index.docstore)
+
+    @classmethod
+    def from_storage(cls, persist_dir):
+        """Build the keyword index of a saved index from its docstore alone, without loading vectors or an embedding model."""
+        from llama_index.core.storage.index_store import SimpleIndexStore
+        index_struct = SimpleIndexStore.from_persist_dir(persist_dir).index_structs()[0]
+        return cls._from_docstore(index_struct, utils.vector_store.load_docstore(persist_dir))
+
+    @classmethod
+    def _from_docstore(cls, index_struct, docstore):
+        node_ids = list(index_struct.nodes_dict.values())
+        nodes = [node for node in docstore.get_nodes(node_ids, raise_error=False) if node is not None]
+        node_ids = [node.node_id for node in nodes]
+        return cls.build(node_ids, (node.get_content(metadata_mode=MetadataMode.NONE) for node in nodes))
+
+    def search(self, query, k):
+        """
+        Find the k nodes with the highest BM25 score for a query.
+
+        Parameters:
+        query (str): The query text.
+        k (int): Number of results.
+
+        Returns:
+        tuple: (node ids, scores), best first; nodes sharing no term with the query are left out.
+        """
+        scores = np.zeros(len(self.node_ids), dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            docs = self.doc_ids[start:end]
+            freqs = self.term_freqs[start:end]
+            # Each document appears once per term, so a plain fancy-indexed add is safe
+            scores[docs] += self.idf[term_id] * freqs * (self.k1 + 1) / (freqs + self._norm[docs])
+        best = utils.exact_search.top_k(scores, k)
+        best = best[scores[best] > 0]
+        return [self.node_ids[i] for i in best], scores[best].tolist()
+
+    def save(self, persist_dir):
+        path = os.path.join(persist_dir, const.KEYWORD_INDEX_FNAME)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, node_ids=_pack_strings(self.node_ids), terms=_pack_strings(self.term_ids),
+                     indptr=self.indptr, doc_ids=self.doc_ids, term_freqs=self.term_freqs.astype(np.uint16),
+                     doc_lengths=self.doc_lengths, params=np.asarray([self.k1, self.b]))
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, persist_dir):
+        with np.load(os.path.join(persist_dir, const.KEYWORD_INDEX_FNAME)) as data:
+            k1, b = data["params"].tolist()
+            return cls(_unpack_strings(data["node_ids"]), _unpack_strings(data["terms"]), data["indptr"], data["doc_ids"],
+                       data["term_freqs"], data["doc_lengths"], k1, b)
+
+
+def has_keyword_index(persist_dir):
+    return os.path.isfile(os.path.join(persist_dir, const.KEYWORD_INDEX_FNAME))
+
+
+_loaded = {}   # persist_dir -> (mtime_ns, BM25Index)
+_loaded_lock = threading.Lock()
+
+
+def get_keyword_index(persist_dir):
+    """
+    Load the keyword index of an index, shared by all sessions and reloaded when the file changes.
+
+    Returns:
+    BM25Index: The keyword index, or None if the index has none.
+    """
+    path = os.path.join(persist_dir, const.KEYWORD_INDEX_FNAME)
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    with _loaded_lock:
+        cached = _loaded.get(persist_dir)
+        if cached is None or cached[0] != mtime_ns:
+            cached = _loaded[persist_dir] = (mtime_ns, BM25Index.load(persist_dir))
+        return cached[1]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Combine vector search and BM25 keyword search with reciprocal rank fusion.
+
+    Both searches return `candidates` nodes; each node scores
+    sum(1 / (rrf_k + rank)) over the lists it appears in, and the best
+    `similarity_top_k` are kept. Nodes only found by keywords are read from
+    the docstore, so no extra embedding is computed.
+    """
+
+    def __init__(self, vector_retriever, keyword_index, docstore, similarity_top_k=DEFAULT_SIMILARITY_TOP_K,
+                 candidates=const.HYBRID_CANDIDATES, rrf_k=const.HYBRID_RRF_K, **kwargs: Any) -> None:
+        self._vector_retriever = vector_retriever
+        self._keyword_index = keyword_index
+        self._docstore = docstore
+        self._similarity_top_k = similarity_top_k
+        self._candidates = candidates
+        self._rrf_k = rrf_k
+        super().__init__(**kwargs)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        vector_hits = self._vector_retriever.retrieve(query_bundle)
+        start_time = time.perf_counter()
+        keyword_ids, _ = self._keyword_index.search(query_bundle.query_str, self._candidates)
+        utils.metrics.record("keyword_search_seconds", time.perf_counter() - start_time)
+
+        scores, nodes = {}, {}
+        for rank, hit in enumerate(vector_hits, 1):
+            scores[hit.node.node_id] = scores.get(hit.node.node_id, 0.0) + 1.0 / (self._rrf_k + rank)
+            nodes[hit.node.node_id] = hit.node
+        for rank, node_id in enumerate(keyword_ids, 1):
+            scores[node_id] = scores.get(node_id, 0.0) + 1.0 / (self._rrf_k + rank)
+        best = sorted(scores, key=scores.get, reverse=True)[:self._similarity_top_k]
+        missing = [node_id for node_id in best if node_id not in nodes]
+        if missing:
+            for node in self._docstore.get_nodes(missing, raise_error=False):
+                if node is not None:
+                    nodes[node.node_id] = node
+        return [NodeWithScore(node=nodes[node_id], score=scores[node_id]) for node_id in best if node_id in nodes]
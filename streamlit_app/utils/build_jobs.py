@@ -0,0 +1,381 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import signal
+import sqlite3
+import threading
+import subprocess
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if parent_dir not in sys.path:
+    sys.path.insert(0, parent_dir)
+import utils.constants as const
+
+ACTIVE_STATUSES = ('queued', 'running')
+
+
+class JobQueue:
+    """
+    Persistent queue of index build jobs, shared by the Streamlit server and the worker processes.
+
+    A job goes through queued -> running -> done | failed | cancelled. A
+    cancelled or failed job can be queued again and resumes from its last
+    checkpoint. A running job whose worker stopped sending heartbeats (it was
+    killed, or the container restarted) is queued again automatically.
+    At most BUILD_BACKEND_CONCURRENCY[backend] jobs run at once per embedding
+    backend, whatever the number of workers.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY, kind TEXT, index_name TEXT, backend TEXT, spec TEXT, status TEXT,
+            submitted REAL, started REAL, finished REAL, heartbeat REAL, worker_pid INTEGER,
+            cancel_requested INTEGER DEFAULT 0, progress TEXT, result TEXT, error TEXT)""")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS workers (
+            pid INTEGER PRIMARY KEY, backends TEXT, started REAL, heartbeat REAL)""")
+
+    @staticmethod
+    def _decode(row):
+        if row is None:
+            return None
+        job = dict(row)
+        for key in ('spec', 'progress', 'result'):
+            job[key] = json.loads(job[key]) if job[key] else {}
+        return job
+
+    def submit(self, kind, index_name, backend, spec):
+        """
+        Queue a job.
+
+        Parameters:
+        kind (str): 'build' for a new index, 'update' for an incremental update of an existing one.
+        index_name (str): The index to create or update.
+        backend (str): The embedding backend, a key of BUILD_BACKEND_CONCURRENCY.
+        spec (dict): Everything the worker needs to run the job (see utils/index_builder.py).
+
+        Returns:
+        str: The job id.
+
+        Raises:
+        ValueError: If a job for this index is already queued or running.
+        """
+        job_id = uuid.uuid4().hex[:12]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                active = self._conn.execute(
+                    f"SELECT id FROM jobs WHERE index_name=? AND status IN {ACTIVE_STATUSES}", (index_name,)).fetchone()
+                if active is not None:
+                    raise ValueError(f"A job for index '{index_name}' is already queued or running")
+                self._conn.execute(
+                    "INSERT INTO jobs (id, kind, index_name, backend, spec, status, submitted) VALUES (?, ?, ?, ?, ?, 'queued', ?)",
+                    (job_id, kind, index_name, backend, json.dumps(spec), time.time()))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        logging.info(f" ### Build job {job_id} queued ({kind} '{index_name}', {backend})")
+        return job_id
+
+    def get(self, job_id):
+        with self._lock:
+            return self._decode(self._conn.execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone())
+
+    def list_jobs(self, limit=20):
+        """The most recent jobs, newest first."""
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM jobs ORDER BY submitted DESC LIMIT ?", (limit,)).fetchall()
+        return [self._decode(row) for row in rows]
+
+    def is_active(self, index_name):
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT 1 FROM jobs WHERE index_name=? AND status IN {ACTIVE_STATUSES}", (index_name,)).fetchone() is not None
+
+    def _requeue_stale(self, now):
+        stale = self._conn.execute(
+            "UPDATE jobs SET status='queued', worker_pid=NULL WHERE status='running' AND heartbeat<?",
+            (now - const.BUILD_HEARTBEAT_TIMEOUT_SEC,)).rowcount
+        if stale:
+            logging.warning(f"!!!!!! {stale} build job(s) lost their worker; queued again to resume from their checkpoint")
+
+    def claim(self, worker_pid, backends):
+        """
+        Take the oldest queued job this worker can run, within the per-backend concurrency limits.
+
+        Parameters:
+        worker_pid (int): The claiming worker.
+        backends (list): The embedding backends this worker can use.
+
+        Returns:
+        dict: The job, now running, or None.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._requeue_stale(now)
+                running = dict(self._conn.execute(
+                    "SELECT backend, COUNT(*) FROM jobs WHERE status='running' GROUP BY backend").fetchall())
+                row = None
+                for candidate in self._conn.execute("SELECT * FROM jobs WHERE status='queued' ORDER BY submitted").fetchall():
+                    backend = candidate['backend']
+                    if backend in backends and running.get(backend, 0) < const.BUILD_BACKEND_CONCURRENCY.get(backend, 1):
+                        row = candidate
+                        break
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET status='running', started=COALESCE(started, ?), heartbeat=?, worker_pid=?, cancel_requested=0 WHERE id=?",
+                        (now, now, worker_pid, row['id']))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return self.get(row['id']) if row is not None else None
+
+    def heartbeat(self, job_id):
+        """
+        Tell the queue the job is alive.
+
+        Returns:
+        bool: True if cancelling the job was requested.
+        """
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET heartbeat=? WHERE id=?", (time.time(), job_id))
+            row = self._conn.execute("SELECT cancel_requested FROM jobs WHERE id=?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def set_progress(self, job_id, progress):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET progress=?, heartbeat=? WHERE id=?", (json.dumps(progress), time.time(), job_id))
+
+    def finish(self, job_id, status, result=None, error=None):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status=?, finished=?, result=?, error=?, worker_pid=NULL WHERE id=?",
+                (status, time.time(), json.dumps(result or {}), error, job_id))
+        logging.info(f" ### Build job {job_id} {status}" + (f": {error}" if error else ""))
+
+    def requeue(self, job_id):
+        """Give a running job back to the queue, e.g. when its worker is stopped; it resumes from its checkpoint."""
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status='queued', worker_pid=NULL WHERE id=? AND status='running'", (job_id,))
+
+    def cancel(self, job_id):
+        """Cancel a queued job now, or ask the worker of a running job to stop at the next batch."""
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status='cancelled', finished=? WHERE id=? AND status='queued'", (time.time(), job_id))
+            self._conn.execute("UPDATE jobs SET cancel_requested=1 WHERE id=? AND status='running'", (job_id,))
+
+    def resume(self, job_id):
+        """
+        Queue a cancelled or failed job again; it continues from its last checkpoint.
+
+        Raises:
+        ValueError: If another job for the same index is active.
+        """
+        job = self.get(job_id)
+        if job is None or job['status'] not in ('cancelled', 'failed'):
+            return
+        if self.is_active(job['index_name']):
+            raise ValueError(f"A job for index '{job['index_name']}' is already queued or running")
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status='queued', finished=NULL, error=NULL, cancel_requested=0 WHERE id=?", (job_id,))
+
+    def remove(self, job_id):
+        """Forget a finished job and delete its checkpoint."""
+        with self._lock:
+            deleted = self._conn.execute(
+                f"DELETE FROM jobs WHERE id=? AND status NOT IN {ACTIVE_STATUSES}", (job_id,)).rowcount
+        if deleted:
+            shutil.rmtree(os.path.join(const.STAGING_ROOT_PATH, job_id), ignore_errors=True)
+
+    def register_worker(self, pid, backends):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO workers (pid, backends, started, heartbeat) VALUES (?, ?, ?, ?)",
+                               (pid, json.dumps(backends), now, now))
+
+    def worker_heartbeat(self, pid):
+        with self._lock:
+            self._conn.execute("UPDATE workers SET heartbeat=? WHERE pid=?", (time.time(), pid))
+
+    def unregister_worker(self, pid):
+        with self._lock:
+            self._conn.execute("DELETE FROM workers WHERE pid=?", (pid,))
+
+    def live_workers(self):
+        """
+        Returns:
+        list: (pid, backends) of the workers that are running and sent a heartbeat recently.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM workers WHERE heartbeat<?", (time.time() - const.BUILD_HEARTBEAT_TIMEOUT_SEC,))
+            rows = self._conn.execute("SELECT pid, backends FROM workers").fetchall()
+            gone = [row[0] for row in rows if not _process_exists(row[0])]
+            self._conn.executemany("DELETE FROM workers WHERE pid=?", [(pid,) for pid in gone])
+        return [(row[0], json.loads(row[1])) for row in rows if row[0] not in gone]
+
+    def demand(self):
+        """
+        Returns:
+        dict: {backend: number of queued and running jobs}.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT backend, COUNT(*) FROM jobs WHERE status IN {ACTIVE_STATUSES} GROUP BY backend").fetchall()
+        return dict(rows)
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """Get the JobQueue of this process, opening it on first use."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue(os.path.join(const.CACHE_ROOT_PATH, const.BUILD_JOBS_FNAME))
+        return _queue
+
+
+def worker_backends():
+    """The embedding backends a worker started with the current environment can use."""
+    return ['ollama'] + (['openai'] if os.environ.get("OPENAI_API_KEY") else [])
+
+
+def spawn_worker():
+    """
+    Start a worker process, detached from the Streamlit server so that it outlives the page and the session.
+
+    The worker inherits the environment, including OPENAI_API_KEY if set.
+    """
+    try:
+        os.makedirs(const.LOG_ROOT_PATH, exist_ok=True)
+        log = open(os.path.join(const.LOG_ROOT_PATH, const.BUILD_WORKER_LOG_FNAME), 'a')
+    except OSError:
+        log = subprocess.DEVNULL
+    process = subprocess.Popen([sys.executable, '-m', 'utils.build_jobs'], cwd=parent_dir,
+                               stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    # Registered right away, so that a second call does not start another worker before this one is up
+    get_queue().register_worker(process.pid, worker_backends())
+    logging.info(f" ### Started build worker (pid {process.pid})")
+    return process.pid
+
+
+def ensure_workers():
+    """
+    Start workers until every backend with pending jobs has as many as it may run concurrently,
+    within BUILD_MAX_WORKERS in total.
+
+    Returns:
+    int: The number of workers started.
+    """
+    queue = get_queue()
+    workers = queue.live_workers()
+    started = 0
+    for backend, pending in queue.demand().items():
+        wanted = min(pending, const.BUILD_BACKEND_CONCURRENCY.get(backend, 1))
+        serving = sum(1 for _, backends in workers if backend in backends)
+        while serving < wanted and len(workers) < const.BUILD_MAX_WORKERS and backend in worker_backends():
+            workers.append((spawn_worker(), worker_backends()))
+            serving += 1
+            started += 1
+    return started
+
+
+class _Heartbeat(threading.Thread):
+    """Keep the worker and its current job alive in the queue, and relay cancel requests."""
+
+    def __init__(self, queue, pid):
+        super().__init__(daemon=True, name="build-heartbeat")
+        self.queue = queue
+        self.pid = pid
+        self.job_id = None
+        self.cancel_event = threading.Event()
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(const.BUILD_HEARTBEAT_SEC):
+            self.queue.worker_heartbeat(self.pid)
+            job_id = self.job_id
+            if job_id is not None and self.queue.heartbeat(job_id):
+                self.cancel_event.set()
+
+
+def run_worker(idle_sec=const.BUILD_WORKER_IDLE_SEC):
+    """
+    Run queued jobs one after another; return after `idle_sec` without work.
+    """
+    import utils.index_builder
+    import utils.ollama_scheduler
+    import utils.metrics
+
+    # Build spans reach the Diagnostics page and the metrics endpoint through the server process
+    utils.metrics.use_worker_log()
+    # Embedding requests of builds give way to the chat (see utils/ollama_scheduler.py)
+    utils.ollama_scheduler.set_default_class(utils.ollama_scheduler.BUILD)
+    # Stopped with SIGTERM (e.g. by `docker stop`): unwind so the worker unregisters; its job resumes later
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    queue = get_queue()
+    pid = os.getpid()
+    backends = worker_backends()
+    queue.register_worker(pid, backends)
+    heartbeat = _Heartbeat(queue, pid)
+    heartbeat.start()
+    logging.info(f" ### Build worker {pid} ready (backends: {backends})")
+    idle_since = time.monotonic()
+    try:
+        while time.monotonic() - idle_since < idle_sec:
+            job = queue.claim(pid, backends)
+            if job is None:
+                time.sleep(1)
+                continue
+            heartbeat.cancel_event.clear()
+            heartbeat.job_id = job['id']
+            try:
+                builder = utils.index_builder.IndexBuilder(job, queue, heartbeat.cancel_event)
+                queue.finish(job['id'], 'done', result=builder.run())
+            except utils.index_builder.JobCancelled:
+                queue.finish(job['id'], 'cancelled')
+            except (SystemExit, KeyboardInterrupt):
+                queue.requeue(job['id'])
+                raise
+            except Exception as e:
+                logging.exception(f"!!!!!! Build job {job['id']} failed")
+                queue.finish(job['id'], 'failed', error=f"{type(e).__name__}: {e}")
+            finally:
+                heartbeat.job_id = None
+                idle_since = time.monotonic()
+    finally:
+        heartbeat.stop_event.set()
+        queue.unregister_worker(pid)
+        logging.info(f" ### Build worker {pid} exiting")
+
+
+if __name__ == '__main__':
+    run_worker()
@@ -0,0 +1,161 @@
+import time
+import asyncio
+from typing import Any, List, Optional, Sequence
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.base.llms.types import ChatMessage, ChatResponse, ChatResponseAsyncGen, MessageRole
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.memory import ChatMemoryBuffer
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+from llama_index.llms.ollama import Ollama
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+import utils.constants as const
+import utils.async_generation
+import utils.context_budget
+import utils.metrics
+import utils.ollama_scheduler
+
+
+class BudgetNodePostprocessor(BaseNodePostprocessor):
+    """
+    Fit retrieved nodes into the documents' share of the prompt token budget.
+
+    Sentences repeated across nodes (chunk overlaps, copies of a document)
+    are removed first, then the best ranked nodes are kept until the budget
+    is spent, the last one cut.
+    """
+
+    token_budget: int = Field(description="Prompt token budget.")
+    reserved_tokens: int = Field(default=0, description="Tokens of the system prompt, always sent.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "BudgetNodePostprocessor"
+
+    def _postprocess_nodes(self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        question_tokens = utils.context_budget.count_tokens(query_bundle.query_str) if query_bundle else 0
+        max_tokens = utils.context_budget.docs_budget(self.token_budget, self.reserved_tokens + question_tokens)
+        texts = utils.context_budget.dedupe_chunks([n.node.get_content(metadata_mode=MetadataMode.NONE) for n in nodes])
+        overheads = [utils.context_budget.count_tokens(n.node.get_content(metadata_mode=MetadataMode.LLM))
+                     - utils.context_budget.count_tokens(n.node.get_content(metadata_mode=MetadataMode.NONE)) for n in nodes]
+        texts = utils.context_budget.fit_chunks(texts, max_tokens, overheads)
+
+        results = []
+        for n, text in zip(nodes, texts):
+            if not text:
+                continue
+            node = n.node.copy()
+            node.text = text
+            results.append(NodeWithScore(node=node, score=n.score))
+        context_tokens = sum(utils.context_budget.count_tokens(n.node.get_content(metadata_mode=MetadataMode.LLM)) for n in results)
+        utils.metrics.record("context_tokens", context_tokens)
+        logging.info(f" ### Context: {len(results)} of {len(nodes)} nodes, ~{context_tokens} tokens (budget {max_tokens})")
+        return results
+
+
+class CompactingChatMemory(ChatMemoryBuffer):
+    """
+    Chat memory that compacts older turns to fit the token budget instead of dropping them.
+
+    `token_limit` is the whole prompt budget; ContextChatEngine passes the
+    tokens of the system prompt and documents as `initial_token_count`, and
+    the history gets the rest (see utils.context_budget.compact_history()).
+    """
+
+    last_prompt_tokens: int = Field(default=0, description="Estimated tokens of the last prompt assembled.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CompactingChatMemory"
+
+    @classmethod
+    def from_history(cls, chat_history, token_limit):
+        return cls.from_defaults(chat_history=chat_history, token_limit=token_limit,
+                                 tokenizer_fn=utils.context_budget.estimate_tokenizer)
+
+    def get(self, input: Optional[str] = None, initial_token_count: int = 0, **kwargs: Any) -> List[ChatMessage]:
+        history = [{"role": message.role.value, "content": message.content or ""} for message in self.get_all()]
+        compacted, history_tokens = utils.context_budget.compact_history(history, max(0, self.token_limit - initial_token_count))
+        self.last_prompt_tokens = initial_token_count + history_tokens
+        return [ChatMessage(role=message["role"], content=message["content"]) for message in compacted]
+
+
+class ThreadedRetriever(BaseRetriever):
+    """
+    Run a retriever in a worker thread when called asynchronously.
+
+    Our retrievers (exact or IVF search, BM25, federated) are synchronous,
+    and llama_index would otherwise run them on the event loop, holding up
+    every other session's generation meanwhile.
+    """
+
+    def __init__(self, retriever, **kwargs: Any) -> None:
+        self._retriever = retriever
+        super().__init__(**kwargs)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return self._retriever.retrieve(query_bundle)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        generation = utils.async_generation.current_generation.get()
+        request_id = generation.request_id if generation is not None else None
+
+        def retrieve():
+            # Embedding and retrieval timings are recorded against the thread's request id
+            utils.metrics.set_request_id(request_id)
+            start_time = time.perf_counter()
+            try:
+                return self._retriever.retrieve(query_bundle)
+            finally:
+                if generation is not None:
+                    generation.retrieval_seconds = time.perf_counter() - start_time
+                utils.metrics.set_request_id(None)
+
+        return await asyncio.to_thread(retrieve)
+
+
+class AsyncOllama(Ollama):
+    """
+    Ollama LLM that really streams asynchronously, through the shared async client.
+
+    The llama_index integration implements `astream_chat` on top of its
+    blocking `stream_chat`. This one also pins the model with MODEL_KEEP_ALIVE,
+    and ties the task it streams in to the current generation, so that
+    stopping the generation stops Ollama too. The request waits for an
+    interactive slot of the Ollama scheduler (see utils/ollama_scheduler.py).
+    """
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "AsyncOllama"
+
+    async def astream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseAsyncGen:
+        async def gen() -> ChatResponseAsyncGen:
+            generation = utils.async_generation.current_generation.get()
+            if generation is not None:
+                generation.attach(asyncio.current_task())
+            async with utils.ollama_scheduler.aslot(utils.ollama_scheduler.INTERACTIVE, kind='chat'):
+                stream = await utils.async_generation.get_client().chat(
+                    model=self.model,
+                    messages=[{"role": message.role.value, "content": message.content or ""} for message in messages],
+                    stream=True,
+                    options=self._model_kwargs,
+                    keep_alive=const.MODEL_KEEP_ALIVE,
+                    **kwargs)
+                text = ""
+                async for chunk in stream:
+                    if chunk.get("done"):
+                        if "prompt_eval_count" in chunk:
+                            utils.metrics.record("prompt_eval_tokens", chunk["prompt_eval_count"],
+                                                 generation and generation.request_id, model=self.model)
+                        break
+                    delta = chunk["message"]["content"]
+                    text += delta
+                    yield ChatResponse(message=ChatMessage(content=text, role=MessageRole.ASSISTANT), delta=delta, raw=chunk)
+
+        return gen()
@@ -0,0 +1,377 @@
+import io
+import os
+import re
+import csv
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, List, Sequence
+
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.constants import DEFAULT_CHUNK_OVERLAP, DEFAULT_CHUNK_SIZE
+from llama_index.core.node_parser import NodeParser, SentenceSplitter
+from llama_index.core.node_parser.node_utils import build_nodes_from_splits
+from llama_index.core.schema import BaseNode, MetadataMode
+from llama_index.core.utils import get_tokenizer
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+import utils.constants as const
+
+STRATEGIES = ['markdown', 'notebook', 'table', 'page', 'text']
+
+_HEADING = re.compile(r'^(#{1,6})\s+(.+?)\s*#*\s*$')
+_FENCE = re.compile(r'^\s*(```|~~~)')
+_CELL = re.compile(r'^# %%(.*)')
+# Room left in every chunk for the metadata added per chunk (section, rows, cells)
+_CHUNK_METADATA_TOKENS = 32
+
+
+def strategy_for(document):
+    """
+    Pick the chunking strategy of a document from its file type (see CHUNK_STRATEGIES).
+
+    Returns:
+    str: One of STRATEGIES.
+    """
+    file_name = document.metadata.get("file_name") or document.metadata.get("file_path")
+    if file_name:
+        return const.CHUNK_STRATEGIES.get(os.path.splitext(file_name)[1].lower().lstrip('.'), 'text')
+    if document.id_.startswith(('http://', 'https://')):
+        # Web pages are converted to Markdown (see utils/web_loader.py)
+        return 'markdown'
+    return 'text'
+
+
+def markdown_sections(text):
+    """
+    Split Markdown at its headings, ignoring `#` lines inside fenced code.
+
+    Returns:
+    list: (heading path, section text) tuples; the text before the first heading has an empty path.
+    """
+    sections = []
+    path = []
+    lines = []
+    in_fence = False
+    for line in text.splitlines():
+        if _FENCE.match(line):
+            in_fence = not in_fence
+        match = None if in_fence else _HEADING.match(line)
+        if match:
+            if any(l.strip() for l in lines):
+                sections.append((tuple(path), "\n".join(lines).strip()))
+            level = len(match.group(1))
+            path = [(lvl, title) for lvl, title in path if lvl < level] + [(level, match.group(2))]
+            lines = [line]
+        else:
+            lines.append(line)
+    if any(l.strip() for l in lines):
+        sections.append((tuple(path), "\n".join(lines).strip()))
+    return [(tuple(title for _, title in path), section) for path, section in sections]
+
+
+class StructuredNodeParser(NodeParser):
+    """
+    Split documents along their structure rather than every `chunk_size` tokens.
+
+    - markdown (Markdown, HTML, web pages): at headings; neighboring sections
+      are merged up to `chunk_size`, and each chunk records its heading path
+      as `section` metadata.
+    - notebook: at cells (`# %%` markers, see utils/readers.py), merged the same way;
+      `cells` metadata.
+    - table (CSV, Excel sheets): groups of rows, each chunk repeating the
+      header row; `rows` metadata.
+    - page (PDF, read one document per page): a page is never merged with another.
+    - text: the sentence splitter, as before.
+
+    Parts longer than `chunk_size` (a huge section, cell or row) go through the
+    sentence splitter with `chunk_overlap`.
+    """
+
+    chunk_size: int = Field(default=DEFAULT_CHUNK_SIZE, gt=0, description="The token chunk size for each chunk.")
+    chunk_overlap: int = Field(default=DEFAULT_CHUNK_OVERLAP, ge=0, description="Token overlap when a part is split.")
+    structured: bool = Field(default=True, description="False: split every document with the sentence splitter.")
+
+    _splitter: SentenceSplitter = PrivateAttr()
+    _tokenizer: Any = PrivateAttr()
+
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE, chunk_overlap=DEFAULT_CHUNK_OVERLAP, structured=True, **kwargs: Any) -> None:
+        super().__init__(chunk_size=chunk_size, chunk_overlap=chunk_overlap, structured=structured, **kwargs)
+        self._splitter = SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        self._tokenizer = get_tokenizer()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "StructuredNodeParser"
+
+    def _tokens(self, text):
+        return len(self._tokenizer(text))
+
+    def _split(self, text, metadata_str):
+        return self._splitter.split_text_metadata_aware(text, metadata_str)
+
+    def _merge(self, units, budget, metadata_str):
+        """
+        Merge consecutive units up to `budget` tokens.
+
+        Parameters:
+        units (list): (text, label) tuples; the labels of a chunk's units are passed to the caller.
+
+        Returns:
+        list: (text, labels) tuples.
+        """
+        chunks = []
+        texts, labels, size = [], [], 0
+        for text, label in units:
+            tokens = self._tokens(text)
+            if texts and size + tokens > budget:
+                chunks.append(("\n\n".join(texts), labels))
+                texts, labels, size = [], [], 0
+            if tokens > budget:
+                chunks.extend((piece, [label]) for piece in self._split(text, metadata_str))
+                continue
+            texts.append(text)
+            labels.append(label)
+            size += tokens
+        if texts:
+            chunks.append(("\n\n".join(texts), labels))
+        return chunks
+
+    def _markdown(self, text, budget, metadata_str):
+        chunks = []
+        for chunk, paths in self._merge([(section, path) for path, section in markdown_sections(text)], budget, metadata_str):
+            # The headings the merged sections share, or the first section's
+            common = list(paths[0])
+            for path in paths[1:]:
+                common = [a for a, b in zip(common, path) if a == b]
+            section = " > ".join(common or paths[0])
+            chunks.append((chunk, {"section": section} if section else {}))
+        return chunks
+
+    def _notebook(self, text, budget, metadata_str):
+        cells = []
+        heading = ""
+        for cell in re.split(r'(?m)^(?=# %%)', text):
+            if not cell.strip():
+                continue
+            marker = _CELL.match(cell)
+            if marker and '[markdown]' in marker.group(1):
+                titles = [match.group(2) for match in map(_HEADING.match, cell.splitlines()[1:]) if match]
+                heading = titles[0] if titles else heading
+            cells.append((cell.strip(), (len(cells) + 1, heading)))
+        chunks = []
+        for chunk, labels in self._merge(cells, budget, metadata_str):
+            first, last = labels[0][0], labels[-1][0]
+            metadata = {"cells": f"{first}-{last}" if last != first else str(first)}
+            if labels[0][1]:
+                metadata["section"] = labels[0][1]
+            chunks.append((chunk, metadata))
+        return chunks
+
+    def _table(self, text, budget, metadata_str):
+        try:
+            records = list(csv.reader(io.StringIO(text)))
+        except csv.Error:
+            return [(piece, {}) for piece in self._split(text, metadata_str)]
+        records = [record for record in records if any(field.strip() for field in record)]
+        if len(records) < 2:
+            return [(piece, {}) for piece in self._split(text, metadata_str)]
+
+        def to_csv(rows):
+            out = io.StringIO()
+            csv.writer(out, lineterminator="\n").writerows(rows)
+            return out.getvalue().rstrip("\n")
+
+        header = records[0]
+        budget -= self._tokens(to_csv([header]))
+        chunks = []
+        group, first, size = [], 1, 0
+        for number, record in enumerate(records[1:], start=1):
+            row = to_csv([record])
+            tokens = self._tokens(row)
+            if group and size + tokens > budget:
+                chunks.append((to_csv([header] + group), {"rows": f"{first}-{number - 1}" if number - 1 != first else str(first)}))
+                group, size = [], 0
+            if tokens > budget:
+                chunks.extend((piece, {"rows": str(number)}) for piece in self._split(to_csv([header]) + "\n" + row, metadata_str))
+                continue
+            if not group:
+                first = number
+            group.append(record)
+            size += tokens
+        if group:
+            last = len(records) - 1
+            chunks.append((to_csv([header] + group), {"rows": f"{first}-{last}" if last != first else str(first)}))
+        return chunks
+
+    def chunk_document(self, document):
+        """
+        Split one document.
+
+        Returns:
+        tuple: (list of TextNode, strategy name)
+        """
+        strategy = strategy_for(document) if self.structured else 'text'
+        metadata_str = max(document.get_metadata_str(MetadataMode.EMBED), document.get_metadata_str(MetadataMode.LLM), key=len)
+        budget = self.chunk_size - self._tokens(metadata_str) - _CHUNK_METADATA_TOKENS
+        text = document.get_content(metadata_mode=MetadataMode.NONE)
+        if strategy in ('markdown', 'notebook', 'table') and budget > 0:
+            chunks = getattr(self, f"_{strategy}")(text, budget, metadata_str)
+        else:
+            # Pages are read one document each, so the sentence splitter keeps them apart
+            chunks = [(piece, {}) for piece in self._split(text, metadata_str)]
+        nodes = build_nodes_from_splits([chunk for chunk, _ in chunks], document, id_func=self.id_func)
+        for node, (_, metadata) in zip(nodes, chunks):
+            node.metadata.update(metadata)
+            # Headings help find a chunk; row and cell numbers do not
+            node.excluded_embed_metadata_keys = node.excluded_embed_metadata_keys + [key for key in ("rows", "cells") if key in metadata]
+        return nodes, strategy
+
+    def _parse_nodes(self, nodes: Sequence[BaseNode], show_progress: bool = False, **kwargs: Any) -> List[BaseNode]:
+        all_nodes = []
+        for node in nodes:
+            all_nodes.extend(self.chunk_document(node)[0])
+        return all_nodes
+
+
+_parsers = {}
+
+
+def _get_parser(config):
+    parser = _parsers.get(config)
+    if parser is None:
+        parser = _parsers[config] = StructuredNodeParser(*config)
+    return parser
+
+
+def _warm_up(config):
+    _get_parser(config)
+
+
+def chunk_batch(config, documents):
+    """
+    Split a batch of documents. Runs inside a chunking worker.
+
+    Parameters:
+    config (tuple): (chunk_size, chunk_overlap, structured).
+    documents (list): The documents.
+
+    Returns:
+    tuple: (nodes, {strategy: [chunks, characters]}, elapsed seconds)
+    """
+    start_time = time.perf_counter()
+    parser = _get_parser(config)
+    nodes = []
+    stats = {}
+    for document in documents:
+        # One document at a time, so that start_char_idx and prev/next links stay within it
+        document_nodes, strategy = parser.chunk_document(document)
+        document_nodes = parser._postprocess_parsed_nodes(document_nodes, {document.id_: document})
+        counts = stats.setdefault(strategy, [0, 0])
+        counts[0] += len(document_nodes)
+        counts[1] += sum(len(node.get_content(metadata_mode=MetadataMode.NONE)) for node in document_nodes)
+        nodes.extend(document_nodes)
+    return nodes, stats, time.perf_counter() - start_time
+
+
+class ParallelChunker:
+    """
+    Split a stream of documents into chunks in a pool of worker processes.
+
+    Documents are sent in batches of about `batch_chars` characters; at most
+    `max_workers * 2` batches are in flight, so pulling documents stalls when
+    the workers fall behind. Chunks are yielded batch by batch, in completion
+    order. With `max_workers` <= 1, or a single CPU, the documents are split
+    in this process.
+    The workers start (and import llama_index) as soon as the chunker is
+    created, while the first documents are being loaded; the pool is kept
+    across run() calls until close().
+
+    Attributes:
+    stats (dict): Strategy -> [chunks, characters], over every run.
+    elapsed (float): Seconds spent splitting, summed over the workers.
+    """
+
+    def __init__(self, chunk_size, chunk_overlap, structured=True, max_workers=const.CHUNK_WORKERS, batch_chars=const.CHUNK_BATCH_CHARS):
+        self.config = (chunk_size, chunk_overlap, structured)
+        self.max_workers = max_workers
+        self.batch_chars = batch_chars
+        self.stats = {}
+        self.elapsed = 0.0
+        self._pool = None
+        if max_workers > 1 and (os.cpu_count() or 1) > 1:
+            # spawn: forking the multi-threaded build worker is not safe
+            self._pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+            for _ in range(max_workers):
+                self._pool.submit(_warm_up, self.config)
+
+    @property
+    def num_chunks(self):
+        return sum(chunks for chunks, _ in self.stats.values())
+
+    @property
+    def avg_chunk_chars(self):
+        num_chunks = self.num_chunks
+        return sum(chars for _, chars in self.stats.values()) / num_chunks if num_chunks else 0.0
+
+    def _batches(self, documents, docstore):
+        batch, size = [], 0
+        for doc in documents:
+            if docstore is not None:
+                docstore.set_document_hash(doc.get_doc_id(), doc.hash)
+            batch.append(doc)
+            size += len(doc.text)
+            if size >= self.batch_chars:
+                yield batch
+                batch, size = [], 0
+        if batch:
+            yield batch
+
+    def _collect(self, result):
+        nodes, stats, elapsed = result
+        for strategy, (chunks, chars) in stats.items():
+            counts = self.stats.setdefault(strategy, [0, 0])
+            counts[0] += chunks
+            counts[1] += chars
+        self.elapsed += elapsed
+        return nodes
+
+    def run(self, documents, docstore=None):
+        """
+        Split documents into nodes.
+
+        Parameters:
+        documents (iterable): Documents to split; may be a generator.
+        docstore (BaseDocumentStore): If given, the document hashes are recorded in it.
+
+        Yields:
+        BaseNode: The nodes, without embeddings.
+        """
+        if self._pool is None:
+            for batch in self._batches(documents, docstore):
+                yield from self._collect(chunk_batch(self.config, batch))
+            return
+
+        in_flight = set()
+        try:
+            for batch in self._batches(documents, docstore):
+                if len(in_flight) >= self.max_workers * 2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield from self._collect(future.result())
+                in_flight.add(self._pool.submit(chunk_batch, self.config, batch))
+            while in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from self._collect(future.result())
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -1,5 +1,7 @@
 # constants.py
 
+import os
+
 DOC_ROOT_PATH = '/opt/jetson_copilot/Documents'
 INDEX_ROOT_PATH = '/opt/jetson_copilot/Indexes'
 
@@ -7,4 +9,150 @@ SUPPORTED_FILE_TYPES = ['txt', 'csv', 'docx', 'epub', 'hwp', 'ipynb',
                         'jpeg', 'jpg', 'mbox', 'md', 'mp3', 
                         'mp4', 'pdf', 'png', 'ppt', 'pptm', 'pptx',
                         'xlsx', 'xls',
-                        ]
\ No newline at end of file
+                        ]
+
+# Binary vector store (see utils/vector_store.py)
+VECTOR_MATRIX_FNAME = 'vector_matrix.npy'
+VECTOR_IDS_FNAME = 'vector_ids.json'
+VECTOR_STORE_JSON_FNAME = 'default__vector_store.json'
+VECTOR_SCALES_FNAME = 'vector_scales.npy'   # per-row scales of int8 matrices
+VECTOR_DTYPES = ['float32', 'float16', 'int8']
+DOCSTORE_FNAME = 'docstore.json'
+DOCSTORE_GZ_FNAME = 'docstore.json.gz'
+
+# Process-wide cache of loaded indexes (see utils/index_cache.py)
+INDEX_CACHE_BUDGET_MIB = 2048
+
+# Concurrent, batched embedding during index builds (see utils/embed_pipeline.py)
+EMBED_BATCH_SIZE = 32
+EMBED_MAX_WORKERS = 4
+EMBED_MAX_RETRIES = 3
+
+# Manifest of indexed files, for incremental index updates (see utils/incremental.py)
+FILE_MANIFEST_FNAME = 'file_manifest.json'
+
+# Caches shared by the app and the build page (hidden, so not listed as an index)
+CACHE_ROOT_PATH = f'{INDEX_ROOT_PATH}/.cache'
+EMBED_CACHE_FNAME = 'embeddings.sqlite'
+EMBED_CACHE_MAX_MIB = 1024
+
+# Parallel document loading (see utils/doc_loader.py)
+# Files parsed in worker processes; the other types are read in threads
+HEAVY_FILE_TYPES = ['pdf', 'docx', 'epub', 'hwp', 'ipynb', 'ppt', 'pptm', 'pptx', 'xlsx', 'xls',
+                    'jpeg', 'jpg', 'png', 'mp3', 'mp4']
+LOADER_PROCESS_WORKERS = 4
+LOADER_THREAD_WORKERS = 4
+LOADER_MAX_PENDING_FILES = 16
+
+# Structure-aware chunking (see utils/chunking.py)
+# Chunking strategy per file type; web pages converted to text are Markdown, the other types are split as plain text
+CHUNK_STRATEGIES = {'md': 'markdown', 'markdown': 'markdown', 'html': 'markdown', 'htm': 'markdown',
+                    'ipynb': 'notebook', 'csv': 'table', 'xlsx': 'table', 'xls': 'table', 'pdf': 'page'}
+CHUNK_WORKERS = 2                # processes splitting documents; 1: in the build worker itself
+CHUNK_BATCH_CHARS = 1_000_000    # documents sent to a chunking process at once, by text size
+
+# Concurrent web page fetching (see utils/web_loader.py)
+WEB_CACHE_FNAME = 'web_pages.sqlite'
+WEB_MAX_WORKERS = 8
+WEB_MAX_PER_HOST = 4
+WEB_TIMEOUT_SEC = 30
+WEB_CONVERT_WORKERS = 2   # processes converting HTML to text; 1: in the fetching threads
+
+# Approximate nearest-neighbor search (see utils/ann.py)
+ANN_BACKENDS = ['exact', 'ivf']
+ANN_CONFIG_FNAME = 'ann_config.json'
+ANN_IVF_FNAME = 'ann_ivf.npz'
+ANN_DEFAULT_NPROBE = 8
+ANN_TRAIN_ITERATIONS = 10
+ANN_TRAIN_SAMPLE = 50000
+
+# Semantic answer cache (see utils/answer_cache.py)
+ANSWER_CACHE_FNAME = 'answers.sqlite'
+ANSWER_CACHE_THRESHOLD = 0.95
+ANSWER_CACHE_TTL_SEC = 7 * 24 * 3600
+ANSWER_CACHE_MAX_ENTRIES = 2000
+
+# Timing spans and metrics (see utils/metrics.py)
+LOG_ROOT_PATH = '/data/logs'
+METRICS_LOG_FNAME = 'metrics.jsonl'
+METRICS_LOG_MAX_MIB = 10
+METRICS_LOG_BACKUPS = 5
+METRICS_WORKER_LOG_FNAME = 'metrics.worker.{pid}.jsonl'   # spans of a build worker, collected by the server process
+METRICS_WINDOW = 1000
+METRICS_PORT = 8502
+
+# Ollama models (see utils/ollama_models.py)
+# The ollama client reads OLLAMA_HOST itself; llama_index's Ollama classes are given it as base_url
+OLLAMA_BASE_URL = os.environ.get('OLLAMA_HOST', 'http://localhost:11434')
+if '://' not in OLLAMA_BASE_URL:
+    OLLAMA_BASE_URL = f'http://{OLLAMA_BASE_URL}'
+DEFAULT_LLM = 'llama3:latest'
+DEFAULT_EMBED_MODEL = 'mxbai-embed-large:latest'
+REQUIRED_MODELS = [DEFAULT_LLM, DEFAULT_EMBED_MODEL]
+MODEL_LIST_TTL_SEC = 10
+
+# Model downloads (see utils/ollama_models.py)
+MODEL_PULLS_FNAME = 'model_pulls.json'   # pulls not finished yet, started again after a restart
+MODEL_PULL_WORKERS = 1                   # models pulled at once; Ollama already fetches the layers of a model in parallel
+MODEL_PULL_RETRIES = 3                   # Ollama keeps the partial layers, so a retry resumes where the pull stopped
+MODEL_PULL_RETRY_SEC = 5
+MODEL_PULL_RATE_WINDOW_SEC = 10
+MODEL_PULL_LOG_INTERVAL_SEC = 10
+
+# Background index builds (see utils/build_jobs.py and utils/index_builder.py)
+BUILD_JOBS_FNAME = 'build_jobs.sqlite'
+STAGING_ROOT_PATH = f'{INDEX_ROOT_PATH}/.staging'
+BUILD_CHECKPOINT_FNAME = 'build_checkpoint.json'
+BUILD_MAX_WORKERS = 2
+BUILD_BACKEND_CONCURRENCY = {'ollama': 1, 'openai': 2}
+BUILD_SEGMENT_FILES = 32
+BUILD_CHECKPOINT_INTERVAL_SEC = 60
+BUILD_HEARTBEAT_SEC = 5
+BUILD_HEARTBEAT_TIMEOUT_SEC = 60
+BUILD_WORKER_IDLE_SEC = 300
+BUILD_WORKER_LOG_FNAME = 'build_worker.log'
+
+# Keyword search and hybrid retrieval (see utils/bm25.py)
+KEYWORD_INDEX_FNAME = 'keyword_index.npz'
+BM25_K1 = 1.2
+BM25_B = 0.75
+HYBRID_RRF_K = 60
+HYBRID_CANDIDATES = 10
+
+# Prompt token budget (see utils/context_budget.py)
+# Ollama runs models with a 2048-token window by default, answer included
+CONTEXT_TOKEN_BUDGET = 1536
+CONTEXT_TOKEN_BUDGETS = {}   # per model, by full name or family (e.g. {'phi3': 1024}); overrides CONTEXT_TOKEN_BUDGET
+CONTEXT_DOCS_SHARE = 0.6
+CONTEXT_SUMMARY_SHARE = 0.2
+CHARS_PER_TOKEN = 4
+
+# Model warm-up, keep-alive and unloading (see utils/ollama_models.py)
+MODEL_KEEP_ALIVE = '30m'            # how long Ollama keeps a model loaded after its last use; -1: until unloaded
+MODEL_MEMORY_BUDGET_MIB = None      # memory for loaded models; None: MODEL_MEMORY_SHARE of the RAM
+MODEL_MEMORY_SHARE = 0.7
+MODEL_PS_TTL_SEC = 2
+MODEL_WARM_RETRY_SEC = 30
+
+# Document inventory on the Build Index page (see utils/file_inventory.py)
+INVENTORY_PAGE_SIZE = 200
+
+# Queries across several indexes (see utils/federated.py)
+FEDERATED_MAX_WORKERS = 4
+
+# Asynchronous chat generation (see utils/async_generation.py)
+GENERATION_CONCURRENCY = 1              # answers a model generates at once; Ollama queues the others anyway
+GENERATION_CONCURRENCY_BY_MODEL = {}    # per model, by full name or family (e.g. {'phi3': 2}); overrides GENERATION_CONCURRENCY
+
+# Index compaction (see utils/index_compaction.py)
+COMPACT_EVAL_QUERIES = 200   # held-out chunks used as queries to measure the retrieval-quality change
+COMPACT_EVAL_TOP_K = 5
+
+# Admission control for the Ollama server, shared with the build workers (see utils/ollama_scheduler.py)
+OLLAMA_SCHEDULER_FNAME = 'ollama_scheduler.sqlite'
+OLLAMA_MAX_IN_FLIGHT = 4                # requests sent to Ollama at once, all classes together
+OLLAMA_CLASS_LIMITS = {'interactive': 4, 'build': 2, 'download': 1}   # requests in flight per class
+OLLAMA_RESERVED_INTERACTIVE = 1         # slots builds and downloads leave free for chat
+OLLAMA_QUEUE_LIMITS = {'interactive': 16, 'build': 64, 'download': 4}  # waiting requests beyond which new ones are rejected
+OLLAMA_WAIT_TIMEOUT_SEC = {'interactive': 60, 'build': None, 'download': None}   # None: wait as long as it takes
+OLLAMA_POLL_SEC = 0.05
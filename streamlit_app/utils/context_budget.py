@@ -0,0 +1,212 @@
+import re
+
+import utils.constants as const
+
+# Sentences shorter than this (code fences, list bullets, "Note:") are never treated as duplicates
+MIN_DEDUPE_CHARS = 20
+# Below this, a partly fitting chunk is dropped rather than cut
+MIN_PARTIAL_TOKENS = 64
+SUMMARY_QUESTION_TOKENS = 25
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+_BLANK_LINES = re.compile(r"\n{3,}")
+
+
+def count_tokens(text):
+    """
+    Estimate the number of tokens of a text.
+
+    Every model has its own tokenizer; the estimate (about 4 characters per
+    token for English) is cheap, needs no model files and is only used to
+    keep the prompt within a budget.
+    """
+    return (len(text or "") + const.CHARS_PER_TOKEN - 1) // const.CHARS_PER_TOKEN
+
+
+def estimate_tokenizer(text):
+    """Tokenizer function for llama_index memories, which only take len() of its result."""
+    return range(count_tokens(text))
+
+
+def token_budget(model):
+    """
+    Prompt token budget of a model.
+
+    Parameters:
+    model (str): The model name, e.g. 'llama3:latest', or None.
+
+    Returns:
+    int: The budget from CONTEXT_TOKEN_BUDGETS (by full name, then by family), or CONTEXT_TOKEN_BUDGET.
+    """
+    if model:
+        for key in (model, model.split(':')[0]):
+            if key in const.CONTEXT_TOKEN_BUDGETS:
+                return const.CONTEXT_TOKEN_BUDGETS[key]
+    return const.CONTEXT_TOKEN_BUDGET
+
+
+def docs_budget(total_tokens, reserved_tokens, docs_share=const.CONTEXT_DOCS_SHARE):
+    """
+    Share of a budget left for retrieved documents.
+
+    Parameters:
+    total_tokens (int): The prompt token budget.
+    reserved_tokens (int): Tokens always sent: the system prompt and the new question.
+
+    Returns:
+    int: Tokens for the documents; the conversation history gets what they leave.
+    """
+    return max(0, int((total_tokens - reserved_tokens) * docs_share))
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut a text to about max_tokens tokens, at a word boundary when possible."""
+    limit = max_tokens * const.CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    cut = text.rfind(" ", 0, limit - 1)
+    if cut < limit // 2:
+        cut = limit - 1
+    return text[:cut].rstrip() + "…"
+
+
+def _dedupe_key(sentence):
+    return " ".join(sentence.lower().split())
+
+
+def dedupe_chunks(texts):
+    """
+    Remove sentences already present in an earlier chunk.
+
+    Chunks are cut with an overlap, so neighbouring chunks of a document
+    repeat each other's edges, and copies of a document repeat whole chunks.
+    Chunks should be given best first so the kept copy is the best ranked.
+
+    Parameters:
+    texts (list): Chunk texts, best first.
+
+    Returns:
+    list: The texts in the same order, with repeated sentences removed; "" for a chunk with nothing new.
+    """
+    seen = set()
+    results = []
+    for text in texts:
+        lines = []
+        num_new, num_repeated = 0, 0
+        for line in text.splitlines():
+            sentences = []
+            for sentence in _SENTENCE_END.split(line):
+                key = _dedupe_key(sentence)
+                if len(key) >= MIN_DEDUPE_CHARS:
+                    if key in seen:
+                        num_repeated += 1
+                        continue
+                    seen.add(key)
+                    num_new += 1
+                sentences.append(sentence)
+            if sentences or not line.strip():
+                lines.append(" ".join(sentences))
+        if num_repeated and not num_new:
+            results.append("")
+        else:
+            results.append(_BLANK_LINES.sub("\n\n", "\n".join(lines)).strip())
+    return results
+
+
+def fit_chunks(texts, max_tokens, overheads=None):
+    """
+    Keep the chunks that fit in a token budget, best first, cutting the last one.
+
+    Parameters:
+    texts (list): Chunk texts, best first; "" entries are skipped.
+    max_tokens (int): The budget.
+    overheads (list): Tokens added to each chunk around its text (e.g. metadata), if any.
+
+    Returns:
+    list: The texts in the same order, cut to fit; "" for a chunk left out.
+    """
+    overheads = overheads or [0] * len(texts)
+    remaining = max_tokens
+    results = []
+    for text, overhead in zip(texts, overheads):
+        cost = count_tokens(text) + overhead + 1   # + the separator between chunks
+        if not text or remaining <= 0:
+            results.append("")
+        elif cost <= remaining:
+            results.append(text)
+            remaining -= cost
+        elif remaining - overhead - 1 >= MIN_PARTIAL_TOKENS:
+            results.append(truncate_to_tokens(text, remaining - overhead - 1))
+            remaining = 0
+        else:
+            results.append("")
+            remaining = 0
+    return results
+
+
+def summarize_turns(messages, max_tokens):
+    """
+    Condense earlier turns into a short note of the questions asked, without calling a model.
+
+    Parameters:
+    messages (list): Dicts with role and content, oldest first.
+    max_tokens (int): Budget for the note.
+
+    Returns:
+    str: The note, or None if there is no question to list or no room for one.
+    """
+    header = "Earlier in this conversation, the user asked:"
+    remaining = max_tokens - count_tokens(header)
+    questions = []
+    for message in reversed(messages):
+        if message["role"] != "user" or not message["content"].strip():
+            continue
+        question = "- " + truncate_to_tokens(message["content"].strip().splitlines()[0], SUMMARY_QUESTION_TOKENS)
+        cost = count_tokens(question) + 1
+        if cost > remaining:
+            break
+        questions.append(question)
+        remaining -= cost
+    if not questions:
+        return None
+    return "\n".join([header] + questions[::-1])
+
+
+def compact_history(messages, max_tokens, summary_share=const.CONTEXT_SUMMARY_SHARE):
+    """
+    Fit a conversation into a token budget.
+
+    The newest messages are kept whole and the older ones are replaced with a
+    note listing the questions asked (see summarize_turns()). The last message,
+    the new question, is always kept.
+
+    Parameters:
+    messages (list): Dicts with role and content, oldest first.
+    max_tokens (int): The budget.
+    summary_share (float): Part of the budget set aside for the note when turns are dropped.
+
+    Returns:
+    tuple: (messages, estimated token count)
+    """
+    counts = [count_tokens(message["content"]) for message in messages]
+    total = sum(counts)
+    if total <= max_tokens or len(messages) <= 1:
+        return list(messages), total
+
+    keep_budget = max_tokens - int(max_tokens * summary_share)
+    start = len(messages) - 1
+    used = counts[-1]
+    while start > 0 and used + counts[start - 1] <= keep_budget:
+        start -= 1
+        used += counts[start]
+    # The kept part should not open with an answer to a dropped question
+    while start < len(messages) - 1 and messages[start]["role"] == "assistant":
+        used -= counts[start]
+        start += 1
+
+    compacted = messages[start:]
+    summary = summarize_turns(messages[:start], max_tokens - used)
+    if summary is not None:
+        compacted = [{"role": "system", "content": summary}] + compacted
+        used += count_tokens(summary)
+    return compacted, used
@@ -0,0 +1,147 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+import utils.constants as const
+
+
+def load_file(file_path):
+    """
+    Parse a single file into documents. Runs inside a loader worker.
+
+    Parameters:
+    file_path (str): The path to the file.
+
+    Returns:
+    tuple: (file_path, documents, elapsed seconds, error message or None)
+    """
+    from llama_index.core import SimpleDirectoryReader
+    import utils.readers
+
+    start_time = time.time()
+    try:
+        reader = SimpleDirectoryReader(input_files=[file_path], file_extractor=utils.readers.get_file_extractor(), raise_on_error=True)
+        docs = reader.load_data()
+        return file_path, docs, time.time() - start_time, None
+    except Exception as e:
+        # SimpleDirectoryReader wraps the parser error; report the root cause
+        cause = e.__cause__ or e
+        return file_path, [], time.time() - start_time, f"{type(cause).__name__}: {cause}"
+
+
+def is_heavy_file(file_path):
+    return os.path.splitext(str(file_path))[1].lower().lstrip('.') in const.HEAVY_FILE_TYPES
+
+
+class StreamingDocumentLoader:
+    """
+    Load documents from many files in parallel and yield them as they are parsed.
+
+    Heavy formats (PDF, Office documents, spreadsheets, media) are parsed in a
+    pool of worker processes, plain-text formats in a thread pool. At most
+    `max_pending` files are in flight, so parsing runs ahead of chunking and
+    embedding by a bounded amount regardless of the corpus size. A file that
+    fails to parse, or crashes its worker process, is recorded in `failures`
+    and skipped instead of aborting the build; after a crash, the heavy files
+    that were in flight are parsed again one at a time, each in a new worker,
+    so that the others are not failed along with it.
+    """
+
+    def __init__(self, input_files, process_workers=const.LOADER_PROCESS_WORKERS, thread_workers=const.LOADER_THREAD_WORKERS,
+                 max_pending=const.LOADER_MAX_PENDING_FILES, progress=None):
+        self.input_files = [str(path) for path in input_files]
+        self.process_workers = process_workers
+        self.thread_workers = thread_workers
+        self.max_pending = max_pending
+        self.progress = progress
+        self.timings = []      # (file_path, seconds, number of documents)
+        self.failures = []     # (file_path, error message)
+        self.ref_doc_ids_by_file = {}
+        self.num_documents = 0
+
+    @property
+    def num_files_done(self):
+        return len(self.timings) + len(self.failures)
+
+    def _new_process_pool(self, max_workers=None):
+        # spawn: forking the multi-threaded Streamlit server is not safe
+        return ProcessPoolExecutor(max_workers=max_workers or self.process_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def _load_alone(self, file_path):
+        """Parse a file in a worker process of its own, to tell whether it is the one crashing workers."""
+        with self._new_process_pool(max_workers=1) as process_pool:
+            try:
+                _, docs, elapsed, error = process_pool.submit(load_file, file_path).result()
+            except BrokenProcessPool:
+                docs, elapsed, error = [], 0.0, "The worker process crashed while parsing this file"
+        return docs, elapsed, error
+
+    def _record(self, file_path, docs, elapsed, error):
+        if error is None:
+            self.timings.append((file_path, elapsed, len(docs)))
+            self.ref_doc_ids_by_file[file_path] = [doc.get_doc_id() for doc in docs]
+            self.num_documents += len(docs)
+            logging.info(f"> Loaded {len(docs)} documents from '{file_path}' in {elapsed:.2f}s")
+        else:
+            self.failures.append((file_path, error))
+            logging.error(f"!!!!!! Failed to load '{file_path}': {error}")
+        if self.progress is not None:
+            self.progress(self.num_files_done, len(self.input_files), file_path, error)
+
+    def __iter__(self):
+        process_pool = None
+        thread_pool = ThreadPoolExecutor(max_workers=self.thread_workers)
+        in_flight = {}   # future -> (file_path, is_heavy)
+        pending_files = iter(self.input_files)
+        try:
+            while True:
+                while len(in_flight) < self.max_pending:
+                    file_path = next(pending_files, None)
+                    if file_path is None:
+                        break
+                    if is_heavy_file(file_path):
+                        process_pool = process_pool or self._new_process_pool()
+                        in_flight[process_pool.submit(load_file, file_path)] = (file_path, True)
+                    else:
+                        in_flight[thread_pool.submit(load_file, file_path)] = (file_path, False)
+                if not in_flight:
+                    break
+
+                done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                suspect_files = []
+                for future in done:
+                    file_path, heavy = in_flight.pop(future)
+                    try:
+                        _, docs, elapsed, error = future.result()
+                    except BrokenProcessPool:
+                        suspect_files.append(file_path)
+                        continue
+                    self._record(file_path, docs, elapsed, error)
+                    yield from docs
+                if suspect_files:
+                    # A crash fails every file queued on the pool; parse them again one at
+                    # a time, so that only the file that crashes a worker on its own fails
+                    process_pool.shutdown(wait=False, cancel_futures=True)
+                    process_pool = None
+                    for future, (file_path, heavy) in list(in_flight.items()):
+                        if heavy and not (future.done() and future.exception() is None):
+                            del in_flight[future]
+                            suspect_files.append(file_path)
+                    for file_path in suspect_files:
+                        docs, elapsed, error = self._load_alone(file_path)
+                        self._record(file_path, docs, elapsed, error)
+                        yield from docs
+        finally:
+            thread_pool.shutdown(wait=False, cancel_futures=True)
+            if process_pool is not None:
+                process_pool.shutdown(wait=False, cancel_futures=True)
+
+        slowest = sorted(self.timings, key=lambda t: t[1], reverse=True)[:5]
+        logging.info(f" ### Loaded {self.num_documents} documents from {len(self.timings)} files "
+                     f"({len(self.failures)} failed). Slowest: {[(os.path.basename(p), round(s, 2)) for p, s, _ in slowest]}")
@@ -0,0 +1,67 @@
+import streamlit as st
+
+import utils.func
+import utils.ollama_models
+
+# Progress of the model downloads, shown on every page (see utils/ollama_models.py for the queue)
+
+PULL_STATE_ICONS = {'queued': '🕒', 'pulling': '⏳', 'done': '✅', 'failed': '🚨', 'cancelled': '⛔'}
+
+
+def on_cancel_pull(name):
+    utils.ollama_models.cancel_pull(name)
+
+def on_retry_pull(name):
+    utils.ollama_models.start_pull(name)
+
+def on_forget_pull(name):
+    utils.ollama_models.forget_pull(name)
+
+
+@st.experimental_fragment(run_every=2)
+def show_pulls():
+    jobs = utils.ollama_models.pull_jobs()
+    # A pull finished since the last refresh: rerun the whole page, so that its model lists include the new model
+    pending = {job.name for job in jobs if not job.done}
+    finished = st.session_state.get("pulls_pending", set()) - pending
+    st.session_state["pulls_pending"] = pending
+    if any(job.name in finished and job.state == 'done' for job in jobs):
+        st.rerun()
+
+    totals = utils.ollama_models.pull_totals()
+    if totals["pending"]:
+        text = f"Downloading {totals['pending']} model{'s' if totals['pending'] > 1 else ''}"
+        if totals["total"]:
+            text += f": {totals['completed'] / 2**20:,.0f} / {totals['total'] / 2**20:,.0f} MiB"
+        if totals["rate"]:
+            text += f", {totals['rate'] / 2**20:,.1f} MiB/s, ETA {utils.func.format_duration(totals['eta'])}"
+        st.progress(totals["completed"] / totals["total"] if totals["total"] else 0.0, text=text)
+    for job in jobs:
+        col1, col2 = st.columns([4, 1])
+        with col1:
+            line = f"{PULL_STATE_ICONS[job.state]} `{job.name}` {job.state}"
+            if job.state == 'pulling':
+                line += f": {job.status}" + (f" ({job.progress:.0%})" if job.total else "")
+            st.caption(line)
+        with col2:
+            if not job.done:
+                st.button("⛔", key=f"cancel_pull_{job.name}", help="Cancel; downloading again resumes where it stopped",
+                          on_click=on_cancel_pull, args=(job.name,))
+            else:
+                if job.state in ('failed', 'cancelled'):
+                    st.button("🔁", key=f"retry_pull_{job.name}", help="Download again", on_click=on_retry_pull, args=(job.name,))
+                st.button("✖", key=f"forget_pull_{job.name}", help="Remove from the list", on_click=on_forget_pull, args=(job.name,))
+        if job.error is not None and "file does not exist" in job.error:
+            st.error(f"It looks like \"**`{job.name}`**\" is not the right name.", icon="🚨")
+        elif job.error is not None:
+            st.error(f"Downloading **`{job.name}`** failed: {job.error}", icon="🚨")
+
+
+def show_downloads():
+    """
+    Show the model downloads of the server, while there are any: their total
+    progress, throughput and ETA, and the state of each. Refreshed every 2
+    seconds; when a download completes, the page is rerun to list the new model.
+    """
+    if utils.ollama_models.pull_jobs():
+        show_pulls()
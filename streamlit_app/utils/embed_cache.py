@@ -0,0 +1,215 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Any, List
+
+import numpy as np
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+import utils.constants as const
+import utils.ollama_scheduler
+
+
+class EmbeddingCache:
+    """
+    On-disk embedding cache keyed by (model name, dimensions, kind, text hash).
+
+    Backed by SQLite so that it can be shared by the app, the build page and
+    any worker process. Once the stored vectors exceed `max_mib`, the least
+    recently used entries are evicted down to 90% of the cap.
+    """
+
+    def __init__(self, path, max_mib):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_mib * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+            model TEXT, dims INTEGER, kind TEXT, text_hash TEXT,
+            vector BLOB, nbytes INTEGER, last_used REAL,
+            PRIMARY KEY (model, dims, kind, text_hash))""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM embeddings").fetchone()[0]
+
+    @staticmethod
+    def text_hash(text):
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def get_many(self, model, dims, kind, texts):
+        """
+        Look up embeddings.
+
+        Returns:
+        list: One embedding (list of float) or None per text.
+        """
+        hashes = [self.text_hash(text) for text in texts]
+        found = {}
+        with self._lock:
+            for start in range(0, len(hashes), 500):
+                chunk = hashes[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model=? AND dims=? AND kind=? "
+                    f"AND text_hash IN ({','.join('?' * len(chunk))})",
+                    [model, dims, kind] + chunk).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used=? WHERE model=? AND dims=? AND kind=? AND text_hash=?",
+                    [(now, model, dims, kind, h) for h in found])
+                self._conn.commit()
+            results = [np.frombuffer(found[h], dtype=np.float32).tolist() if h in found else None for h in hashes]
+            hits = sum(1 for r in results if r is not None)
+            self.hits += hits
+            self.misses += len(results) - hits
+        return results
+
+    def put_many(self, model, dims, kind, texts, embeddings):
+        now = time.time()
+        rows = []
+        for text, embedding in zip(texts, embeddings):
+            vector = np.asarray(embedding, dtype=np.float32).tobytes()
+            rows.append((model, dims, kind, self.text_hash(text), vector, len(vector), now))
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self._conn.commit()
+            self._total_bytes += sum(row[5] for row in rows)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        target = int(self.max_bytes * 0.9)
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM embeddings").fetchone()[0]
+        evicted = 0
+        while self._total_bytes > target:
+            rows = self._conn.execute(
+                "SELECT rowid, nbytes FROM embeddings ORDER BY last_used LIMIT 1000").fetchall()
+            if not rows:
+                break
+            self._conn.executemany("DELETE FROM embeddings WHERE rowid=?", [(row[0],) for row in rows])
+            self._total_bytes -= sum(row[1] for row in rows)
+            evicted += len(rows)
+        self._conn.commit()
+        logging.info(f" ### EmbeddingCache: evicted {evicted} entries ({self._total_bytes / 1024 / 1024:.1f} MiB left)")
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        """
+        Summarize the cache usage of this process.
+
+        Returns:
+        dict: hits, misses, hit_rate and size_mib.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "size_mib": self._total_bytes / 1024 / 1024,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Get the process-wide EmbeddingCache, opening it on first use."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache(os.path.join(const.CACHE_ROOT_PATH, const.EMBED_CACHE_FNAME), const.EMBED_CACHE_MAX_MIB)
+        return _cache
+
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Embedding model wrapper that serves repeated texts and queries from the EmbeddingCache.
+
+    Only cache misses are forwarded to the wrapped model, in one batch.
+    """
+
+    _inner: BaseEmbedding = PrivateAttr()
+    _dims: int = PrivateAttr()
+    _scheduled: bool = PrivateAttr()
+
+    def __init__(self, inner: BaseEmbedding, **kwargs: Any) -> None:
+        # The wrapped model does its own batching, so hand it whole lists
+        super().__init__(model_name=inner.model_name, embed_batch_size=2048, **kwargs)
+        self._inner = inner
+        self._dims = getattr(inner, 'dimensions', None) or 0
+        # Calls to the local Ollama server wait for a slot (see utils/ollama_scheduler.py)
+        self._scheduled = inner.class_name() == "OllamaEmbedding"
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def inner(self) -> BaseEmbedding:
+        return self._inner
+
+    def _cached(self, kind, texts, embed_fn):
+        cache = get_cache()
+        results = cache.get_many(self.model_name, self._dims, kind, texts)
+        # dict.fromkeys de-duplicates the misses while keeping their order
+        missing_texts = list(dict.fromkeys(text for text, result in zip(texts, results) if result is None))
+        if missing_texts:
+            if self._scheduled:
+                with utils.ollama_scheduler.slot(kind='embed'):
+                    embeddings = embed_fn(missing_texts)
+            else:
+                embeddings = embed_fn(missing_texts)
+            cache.put_many(self.model_name, self._dims, kind, missing_texts, embeddings)
+            computed = dict(zip(missing_texts, embeddings))
+            results = [computed[text] if result is None else result for text, result in zip(texts, results)]
+        return results
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._cached('query', [query], lambda texts: [self._inner.get_query_embedding(texts[0])])[0]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embedding(text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._cached('text', texts, self._inner.get_text_embedding_batch)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._get_text_embeddings(texts)
+
+
+def cached(embed_model):
+    """
+    Wrap an embedding model with the persistent embedding cache.
+
+    Parameters:
+    embed_model (BaseEmbedding): e.g. an OllamaEmbedding or OpenAIEmbedding instance.
+
+    Returns:
+    CachedEmbedding: The wrapped model.
+    """
+    if isinstance(embed_model, CachedEmbedding):
+        return embed_model
+    return CachedEmbedding(embed_model)
@@ -0,0 +1,172 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from llama_index.core.schema import MetadataMode
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+import utils.constants as const
+
+
+def chunk_documents(documents, node_parser, docstore=None):
+    """
+    Split documents into nodes (chunks) ready to be embedded.
+
+    Parameters:
+    documents (list): Documents to split.
+    node_parser (NodeParser): The parser to use, typically `Settings.node_parser`.
+    docstore (BaseDocumentStore): If given, the document hashes are recorded in it,
+        as `VectorStoreIndex.from_documents` would do.
+
+    Returns:
+    list: The nodes, without embeddings.
+    """
+    if docstore is not None:
+        for doc in documents:
+            docstore.set_document_hash(doc.get_doc_id(), doc.hash)
+    return node_parser.get_nodes_from_documents(documents)
+
+
+def iter_chunks(documents, node_parser, docstore=None):
+    """
+    Lazily split a stream of documents into nodes, one document at a time.
+
+    Parameters:
+    documents (iterable): Documents to split; may be a generator.
+    node_parser (NodeParser): The parser to use, typically `Settings.node_parser`.
+    docstore (BaseDocumentStore): If given, the document hashes are recorded in it.
+
+    Yields:
+    BaseNode: The nodes, without embeddings.
+    """
+    for doc in documents:
+        yield from chunk_documents([doc], node_parser, docstore)
+
+
+def insert_embedded_nodes(index, batches):
+    """
+    Add batches of already-embedded nodes to a VectorStoreIndex as they arrive.
+
+    Does what `VectorStoreIndex.insert_nodes` does, except that the index
+    struct is written to the index store once at the end instead of after
+    every batch, and embeddings are dropped from the nodes once they are in
+    the vector store.
+
+    Parameters:
+    index (VectorStoreIndex): The index to fill.
+    batches (iterable): Batches of nodes with embeddings, e.g. EmbeddingPipeline.run().
+
+    Returns:
+    int: The number of nodes added.
+    """
+    num_nodes = 0
+    for nodes in batches:
+        new_ids = index.vector_store.add(nodes)
+        for node, new_id in zip(nodes, new_ids):
+            node.embedding = None
+            index.index_struct.add_node(node, text_id=new_id)
+        index.docstore.add_documents(nodes, allow_update=True)
+        num_nodes += len(nodes)
+    index.storage_context.index_store.add_index_struct(index.index_struct)
+    return num_nodes
+
+
+class EmbeddingPipeline:
+    """
+    Embed nodes in batches with a bounded pool of concurrent requests.
+
+    Batches are submitted to a thread pool; at most `max_workers * 2` batches
+    are in flight, so pulling nodes from the input iterable stalls while the
+    embedding server is saturated (backpressure). A failing batch is retried
+    with exponential backoff before the error is raised to the caller.
+    """
+
+    def __init__(self, embed_model, batch_size=const.EMBED_BATCH_SIZE, max_workers=const.EMBED_MAX_WORKERS,
+                 max_retries=const.EMBED_MAX_RETRIES, progress=None):
+        self.embed_model = embed_model
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.progress = progress
+        self.num_embedded = 0
+        self.elapsed = 0.0
+
+    @property
+    def chunks_per_sec(self):
+        return self.num_embedded / self.elapsed if self.elapsed > 0 else 0.0
+
+    def _embed_batch(self, nodes):
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        for attempt in range(self.max_retries + 1):
+            try:
+                embeddings = self.embed_model.get_text_embedding_batch(texts)
+                break
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = 0.5 * (2 ** attempt)
+                logging.warning(f"!!!!!! Embedding batch failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+        for node, embedding in zip(nodes, embeddings):
+            node.embedding = embedding
+        return nodes
+
+    def _batches(self, nodes):
+        # Yields (batch, embedded): nodes that already have an embedding are batched apart and passed through
+        batches = {False: [], True: []}
+        for node in nodes:
+            embedded = node.embedding is not None
+            batch = batches[embedded]
+            batch.append(node)
+            if len(batch) == self.batch_size:
+                yield batch, embedded
+                batches[embedded] = []
+        for embedded, batch in batches.items():
+            if batch:
+                yield batch, embedded
+
+    def run(self, nodes):
+        """
+        Embed nodes, yielding each batch once its embeddings are set.
+
+        Parameters:
+        nodes (iterable): Nodes to embed; may be a lazy generator.
+
+        Yields:
+        list: Batches of nodes with `node.embedding` filled, in completion order.
+            Nodes that already had an embedding come through unchanged, in batches of their own.
+        """
+        start_time = time.time()
+        max_in_flight = self.max_workers * 2
+        in_flight = set()
+
+        def collect(done):
+            for future in done:
+                batch = future.result()
+                self.num_embedded += len(batch)
+                self.elapsed = time.time() - start_time
+                if self.progress is not None:
+                    self.progress(self.num_embedded, self.chunks_per_sec)
+                yield batch
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            try:
+                for batch, embedded in self._batches(nodes):
+                    if embedded:
+                        yield batch
+                        continue
+                    if len(in_flight) >= max_in_flight:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        yield from collect(done)
+                    in_flight.add(executor.submit(self._embed_batch, batch))
+                while in_flight:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    yield from collect(done)
+            finally:
+                for future in in_flight:
+                    future.cancel()
+
+        self.elapsed = time.time() - start_time
+        logging.info(f" ### Embedded {self.num_embedded} chunks in {self.elapsed:.1f}s ({self.chunks_per_sec:.1f} chunks/sec)")
@@ -0,0 +1,140 @@
+import time
+
+import numpy as np
+
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.vector_stores import SimpleVectorStore
+from llama_index.core.vector_stores.types import VectorStoreQuery, VectorStoreQueryMode, VectorStoreQueryResult
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+import utils.ann
+
+
+def top_k(scores, k):
+    """
+    Get the positions of the k highest scores, best first.
+
+    Uses argpartition, so only the k selected scores are sorted.
+
+    Parameters:
+    scores (np.ndarray): 1-D array of scores.
+    k (int): Number of positions to return.
+
+    Returns:
+    np.ndarray: Positions into `scores`.
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < len(scores):
+        best = np.argpartition(-scores, k - 1)[:k]
+    else:
+        best = np.arange(len(scores))
+    return best[np.argsort(-scores[best], kind='stable')]
+
+
+class ExactSearchIndex:
+    """
+    Exact cosine-similarity search over a pre-normalized float32 matrix.
+
+    The embeddings are normalized once, into one contiguous matrix, so a query
+    is a single matrix-vector product followed by an argpartition top-k,
+    instead of a Python loop over every stored embedding.
+    """
+
+    def __init__(self, ids, matrix):
+        start_time = time.time()
+        self.ids = list(ids)
+        self.matrix = np.ascontiguousarray(utils.ann.normalize_rows(matrix)) if len(self.ids) else np.zeros((0, 0), dtype=np.float32)
+        logging.info(f" ### ExactSearchIndex: {len(self.ids)} vectors normalized in {time.time() - start_time:.2f}s")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, query, k, rows=None):
+        """
+        Find the k stored vectors most similar to a query.
+
+        Parameters:
+        query (list or np.ndarray): The query embedding.
+        k (int): Number of results.
+        rows (np.ndarray): If given, only these row numbers are searched.
+
+        Returns:
+        tuple: (ids, similarities), best first.
+        """
+        if len(self.ids) == 0:
+            return [], []
+        q = utils.ann.normalize_rows(np.asarray(query, dtype=np.float32).reshape(1, -1))[0]
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        scores = matrix @ q
+        best = top_k(scores, k)
+        if rows is not None:
+            return [self.ids[rows[b]] for b in best], [float(scores[b]) for b in best]
+        return [self.ids[b] for b in best], [float(scores[b]) for b in best]
+
+    def search_batch(self, queries, k):
+        """
+        Answer several queries with one matrix-matrix product.
+
+        Parameters:
+        queries (list or np.ndarray): Query embeddings, one per row.
+        k (int): Number of results per query.
+
+        Returns:
+        list: One (ids, similarities) tuple per query.
+        """
+        if len(self.ids) == 0:
+            return [([], []) for _ in queries]
+        scores = utils.ann.normalize_rows(queries) @ self.matrix.T
+        results = []
+        for row in scores:
+            best = top_k(row, k)
+            results.append(([self.ids[b] for b in best], [float(row[b]) for b in best]))
+        return results
+
+
+class ExactSimpleVectorStore(SimpleVectorStore):
+    """
+    SimpleVectorStore (JSON format) answering unfiltered queries with an ExactSearchIndex.
+
+    Filtered and non-default queries fall back to SimpleVectorStore. The
+    search matrix is rebuilt lazily after nodes are added or deleted.
+    """
+
+    _search_index: ExactSearchIndex = PrivateAttr(default=None)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ExactSimpleVectorStore"
+
+    def _get_search_index(self):
+        if self._search_index is None:
+            embedding_dict = self.data.embedding_dict
+            self._search_index = ExactSearchIndex(embedding_dict.keys(), list(embedding_dict.values()))
+        return self._search_index
+
+    def add(self, nodes, **add_kwargs):
+        self._search_index = None
+        return super().add(nodes, **add_kwargs)
+
+    def delete(self, ref_doc_id, **delete_kwargs):
+        self._search_index = None
+        return super().delete(ref_doc_id, **delete_kwargs)
+
+    def delete_nodes(self, node_ids=None, filters=None, **delete_kwargs):
+        self._search_index = None
+        return super().delete_nodes(node_ids, filters, **delete_kwargs)
+
+    def clear(self):
+        self._search_index = None
+        return super().clear()
+
+    def query(self, query: VectorStoreQuery, **kwargs) -> VectorStoreQueryResult:
+        if query.filters is not None or query.node_ids is not None or query.mode != VectorStoreQueryMode.DEFAULT:
+            return super().query(query, **kwargs)
+        ids, similarities = self._get_search_index().search(query.query_embedding, query.similarity_top_k)
+        return VectorStoreQueryResult(similarities=similarities, ids=ids)
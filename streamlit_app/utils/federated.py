@@ -0,0 +1,72 @@
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.constants import DEFAULT_SIMILARITY_TOP_K
+from llama_index.core.schema import NodeWithScore, QueryBundle
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+import utils.constants as const
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """The thread pool shared by all sessions for fanning out retrievals."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=const.FEDERATED_MAX_WORKERS, thread_name_prefix='federated')
+        return _executor
+
+
+class FederatedRetriever(BaseRetriever):
+    """
+    Retrieve from several indexes in parallel and merge the results by weighted score.
+
+    The query is embedded once and handed to every retriever, which then run
+    concurrently, so the latency is that of the slowest index rather than the
+    sum. Each node scores its retriever's score times the index weight; the
+    best `similarity_top_k` are kept. All indexes must use the same embedding
+    model, and the retrievers the same kind of score.
+    """
+
+    def __init__(self, retrievers, weights=None, embed_model=None, similarity_top_k=DEFAULT_SIMILARITY_TOP_K, **kwargs: Any) -> None:
+        """
+        Parameters:
+        retrievers (dict): Index name -> retriever.
+        weights (dict): Index name -> weight (default 1.0).
+        embed_model (BaseEmbedding): Model to embed the query with once for all retrievers.
+        similarity_top_k (int): Number of nodes returned.
+        """
+        self._retrievers = dict(retrievers)
+        self._weights = {name: (weights or {}).get(name, 1.0) for name in self._retrievers}
+        self._embed_model = embed_model
+        self._similarity_top_k = similarity_top_k
+        super().__init__(**kwargs)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if self._embed_model is not None and query_bundle.embedding is None:
+            query_bundle.embedding = self._embed_model.get_agg_embedding_from_queries(query_bundle.embedding_strs)
+
+        executor = get_executor()
+        futures = {name: executor.submit(contextvars.copy_context().run, retriever.retrieve, query_bundle)
+                   for name, retriever in self._retrievers.items()}
+        best = {}
+        for name, future in futures.items():
+            try:
+                hits = future.result()
+            except Exception as e:
+                logging.error(f"!!!!!! Retrieval from index '{name}' failed: {e}")
+                continue
+            for hit in hits:
+                score = (hit.score or 0.0) * self._weights[name]
+                if hit.node.node_id not in best or best[hit.node.node_id].score < score:
+                    best[hit.node.node_id] = NodeWithScore(node=hit.node, score=score)
+        return sorted(best.values(), key=lambda hit: hit.score, reverse=True)[:self._similarity_top_k]
@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import threading
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+import utils.constants as const
+import utils.func
+
+SUPPORTED_EXTENSIONS = frozenset(f'.{ext.lower()}' for ext in const.SUPPORTED_FILE_TYPES)
+
+
+class FileInventory:
+    """
+    The files under a directory tree, grouped by directory and rescanned incrementally.
+
+    Each directory keeps its mtime, its matching files (name and size), the
+    count and size of the other files, and its subdirectories. A refresh stats
+    every directory and only lists again those whose mtime changed, i.e. where
+    entries were added, removed or renamed. Files rewritten in place keep their
+    old size until their directory changes. Hidden files and directories are
+    left out, as SimpleDirectoryReader does when building.
+    """
+
+    def __init__(self, root, extensions=SUPPORTED_EXTENSIONS):
+        self.root = root
+        self.extensions = frozenset(extensions)
+        self.generation = 0
+        self._dirs = {}   # relative dir ('' for the root) -> [mtime_ns, [[name, size], ...], [subdir names], skipped count, skipped bytes]
+        self._file_lists = {}
+        self._summaries = {}
+
+    def _scan_dir(self, path, mtime_ns):
+        files, subdirs = [], []
+        skipped_count, skipped_bytes = 0, 0
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.name)
+                        elif entry.is_file():
+                            size = entry.stat().st_size
+                            if os.path.splitext(entry.name)[1].lower() in self.extensions:
+                                files.append([entry.name, size])
+                            else:
+                                skipped_count += 1
+                                skipped_bytes += size
+                    except OSError:
+                        continue
+        except OSError as e:
+            logging.warning(f"!!! Cannot list {path}: {e}")
+        files.sort()
+        subdirs.sort()
+        return [mtime_ns, files, subdirs, skipped_count, skipped_bytes]
+
+    def refresh(self):
+        """
+        Bring the inventory up to date.
+
+        Returns:
+        int: Number of directories listed again (0 when nothing changed).
+        """
+        dirs = {}
+        rescanned = 0
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            path = os.path.join(self.root, rel) if rel else self.root
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            entry = self._dirs.get(rel)
+            if entry is None or entry[0] != mtime_ns:
+                entry = self._scan_dir(path, mtime_ns)
+                rescanned += 1
+            dirs[rel] = entry
+            stack.extend(os.path.join(rel, name) if rel else name for name in entry[2])
+        if rescanned or len(dirs) != len(self._dirs):
+            self._dirs = dirs
+            self._file_lists = {}
+            self._summaries = {}
+            self.generation += 1
+        return rescanned
+
+    @property
+    def num_directories(self):
+        return len(self._dirs)
+
+    def _rel_prefix(self, directory):
+        rel = os.path.relpath(directory, self.root)
+        return '' if rel == '.' else rel
+
+    def _dirs_under(self, directory):
+        prefix = self._rel_prefix(directory)
+        for rel, entry in self._dirs.items():
+            if not prefix or rel == prefix or rel.startswith(prefix + os.sep):
+                yield rel, entry
+
+    def subdirectories(self):
+        """Full paths of every directory below the root, sorted."""
+        return sorted(os.path.join(self.root, rel) for rel in self._dirs if rel)
+
+    def summary(self, directory):
+        """
+        Aggregate the files under a directory of the tree, kept until the next change.
+
+        Returns:
+        dict: num_files and total_bytes of the matching files, by_extension
+            (extension -> [count, bytes]), num_skipped and skipped_bytes of the others.
+        """
+        summary = self._summaries.get(directory)
+        if summary is not None:
+            return summary
+        by_extension = {}
+        num_files, total_bytes, num_skipped, skipped_bytes = 0, 0, 0, 0
+        for _, (_, files, _, skipped_count, skipped_size) in self._dirs_under(directory):
+            for name, size in files:
+                stats = by_extension.setdefault(os.path.splitext(name)[1].lower(), [0, 0])
+                stats[0] += 1
+                stats[1] += size
+            num_files += len(files)
+            total_bytes += sum(size for _, size in files)
+            num_skipped += skipped_count
+            skipped_bytes += skipped_size
+        summary = self._summaries[directory] = {"num_files": num_files, "total_bytes": total_bytes, "by_extension": by_extension,
+                                                "num_skipped": num_skipped, "skipped_bytes": skipped_bytes}
+        return summary
+
+    def files(self, directory):
+        """
+        The matching files under a directory of the tree, kept until the next change.
+
+        Returns:
+        list: (path relative to `directory`, size in bytes), sorted by path.
+        """
+        files = self._file_lists.get(directory)
+        if files is None:
+            prefix = self._rel_prefix(directory)
+            files = []
+            for rel, entry in self._dirs_under(directory):
+                sub = os.path.relpath(rel, prefix) if prefix else rel
+                sub = '' if sub == '.' else sub
+                files.extend((os.path.join(sub, name), size) for name, size in entry[1])
+            files.sort()
+            self._file_lists[directory] = files
+        return files
+
+    def to_dict(self):
+        return {"root": self.root, "extensions": sorted(self.extensions), "dirs": self._dirs}
+
+    @classmethod
+    def from_dict(cls, data):
+        inventory = cls(data["root"], data["extensions"])
+        inventory._dirs = data["dirs"]
+        return inventory
+
+
+def _manifest_path(root):
+    return os.path.join(const.CACHE_ROOT_PATH, f"inventory_{utils.func.make_fingerprint(root)[:16]}.json")
+
+
+def _load_manifest(root, extensions):
+    try:
+        with open(_manifest_path(root)) as f:
+            inventory = FileInventory.from_dict(json.load(f))
+    except (OSError, ValueError, KeyError):
+        return None
+    if inventory.root != root or inventory.extensions != frozenset(extensions):
+        return None
+    return inventory
+
+
+def _save_manifest(inventory):
+    path = _manifest_path(inventory.root)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(inventory.to_dict(), f, separators=(',', ':'))
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        logging.warning(f"!!! Cannot save the file inventory: {e}")
+
+
+# Shared by all sessions; the manifest on disk makes the first scan after a restart incremental too
+_inventories = {}
+_inventories_lock = threading.Lock()
+
+
+def get_inventory(root, extensions=SUPPORTED_EXTENSIONS):
+    """
+    The up-to-date inventory of a directory tree.
+
+    Parameters:
+    root (str): The directory, e.g. DOC_ROOT_PATH.
+    extensions (iterable): Lowercase extensions, with their dot, of the files to list.
+
+    Returns:
+    FileInventory: The inventory, refreshed from the directory mtimes.
+    """
+    with _inventories_lock:
+        inventory = _inventories.get(root)
+        if inventory is None or inventory.extensions != frozenset(extensions):
+            inventory = _load_manifest(root, extensions) or FileInventory(root, extensions)
+            _inventories[root] = inventory
+        start_time = time.perf_counter()
+        rescanned = inventory.refresh()
+        if rescanned:
+            logging.info(f" ### FileInventory: {rescanned} of {inventory.num_directories} directories listed in {time.perf_counter() - start_time:.2f}s")
+            _save_manifest(inventory)
+        return inventory
@@ -1,5 +1,6 @@
 import os
 import re
+import hashlib
 from urllib.parse import urlparse
 
 import logging
@@ -19,20 +20,33 @@ def list_directories(directory):
     directory (str): The path to the directory.
 
     Returns:
-    list: A list of directory names under the given directory.
+    list: A list of directory names under the given directory (hidden ones excluded).
     """
     try:
         # Get a list of all entries in the directory
         entries = os.listdir(directory)
         
-        # Filter out the directories
-        directories = [entry for entry in entries if os.path.isdir(os.path.join(directory, entry))]
+        # Filter out the directories, skipping hidden ones such as the cache directory
+        directories = [entry for entry in entries if os.path.isdir(os.path.join(directory, entry)) and not entry.startswith('.')]
         
         return directories
     except Exception as e:
         print(f"An error occurred: {e}")
         return []
 
+def make_fingerprint(*parts):
+    """
+    Build a short fingerprint from a set of configuration values.
+
+    Parameters:
+    *parts: Values (converted with str()) that together identify a configuration.
+
+    Returns:
+    str: A hex digest that changes whenever any of the values changes.
+    """
+    joined = "\x1f".join(str(part) for part in parts)
+    return hashlib.sha1(joined.encode("utf-8")).hexdigest()
+
 
 ### Below for build_index.py
 
@@ -138,33 +152,6 @@ def count_urls(text):
     # Return the number of URLs found
     return len(urls)
 
-def get_subdirectories(directory):
-    subdirs = []
-    # Walk through the directory tree
-    for root, dirs, files in os.walk(directory):
-        for dir_name in dirs:
-            # Join the root with the directory name to get the full path
-            full_path = os.path.join(root, dir_name)
-            subdirs.append(full_path)
-            # subdirs.append(full_path.replace(directory, "Documents"))
-    return subdirs
-
-def get_files_with_extensions(directory, extensions):
-    # Ensure extensions are in lowercase
-    extensions = [ext.lower() for ext in extensions]
-    
-    files_data = []
-    # Walk through the directory
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            # Check if the file ends with any of the specified extensions
-            if any(file.lower().endswith(f'.{ext}') for ext in extensions):
-                # Add the full path of the matching file to the list
-                file_path = os.path.join(root, file)
-                file_size = os.path.getsize(file_path) / 1024 # Get file size in KiB
-                files_data.append((file_path.replace(directory,""), file_size))
-    return files_data
-
 def get_total_size_mib(directory):
     """
     Calculate the total size of all files in the given directory in MiB.
@@ -209,4 +196,20 @@ def extract_urllist(multiline_text):
     # Remove any leading/trailing whitespace from each line
     urllist = [line.strip() for line in lines if line.strip()]
     
-    return urllist
\ No newline at end of file
+    return urllist
+
+def format_duration(seconds):
+    """
+    Format a duration for display, e.g. "3m05s" or "1h02m".
+
+    Parameters:
+    seconds (float): The duration, or None while unknown.
+
+    Returns:
+    str: The formatted duration, "?" if unknown.
+    """
+    if seconds is None:
+        return "?"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{seconds:02d}s"
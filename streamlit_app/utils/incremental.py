@@ -0,0 +1,202 @@
+import os
+import json
+import hashlib
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+import utils.constants as const
+
+
+def file_sha256(file_path, block_size=1024 * 1024):
+    """
+    Compute the SHA-256 of a file's content.
+
+    Parameters:
+    file_path (str): The path to the file.
+    block_size (int): Read size in bytes.
+
+    Returns:
+    str: The hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _file_entry(file_path, ref_doc_ids, sha256=None):
+    stat = os.stat(file_path)
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": sha256 or file_sha256(file_path),
+        "ref_doc_ids": ref_doc_ids,
+    }
+
+
+def write_manifest(persist_dir, docs_path, ref_doc_ids_by_file):
+    """
+    Save the file manifest of a freshly built index.
+
+    Parameters:
+    persist_dir (str): The path to the index directory.
+    docs_path (str): The document directory the index was built from.
+    ref_doc_ids_by_file (dict): {file_path: [doc_id, ...]} for the local documents in the index.
+    """
+    files = {path: _file_entry(path, ref_doc_ids)
+             for path, ref_doc_ids in ref_doc_ids_by_file.items()
+             if os.path.isfile(path)}
+    save_manifest(persist_dir, {"docs_path": docs_path, "files": files})
+
+
+def save_manifest(persist_dir, manifest):
+    manifest_path = os.path.join(persist_dir, const.FILE_MANIFEST_FNAME)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def load_manifest(persist_dir, docstore):
+    """
+    Load the file manifest of an index.
+
+    Indexes built before manifests existed get one reconstructed from the
+    docstore: their entries have no hash, and are compared using the file
+    size and modification date recorded in the document metadata instead.
+
+    Parameters:
+    persist_dir (str): The path to the index directory.
+    docstore (BaseDocumentStore): The docstore of the loaded index.
+
+    Returns:
+    dict: {"docs_path": str or None, "files": {file_path: entry}}
+    """
+    manifest_path = os.path.join(persist_dir, const.FILE_MANIFEST_FNAME)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            return json.load(f)
+
+    files = {}
+    for ref_doc_id, ref_doc_info in docstore.get_all_ref_doc_info().items():
+        metadata = ref_doc_info.metadata or {}
+        file_path = metadata.get('file_path')
+        if not file_path:
+            continue
+        entry = files.setdefault(file_path, {
+            "size": metadata.get('file_size'),
+            "mtime_ns": None,
+            "last_modified_date": metadata.get('last_modified_date'),
+            "sha256": None,
+            "ref_doc_ids": [],
+        })
+        entry["ref_doc_ids"].append(ref_doc_id)
+    return {"docs_path": None, "files": files}
+
+
+def _is_unchanged(file_path, entry):
+    stat = os.stat(file_path)
+    if entry.get("size") != stat.st_size:
+        return False
+    if entry.get("mtime_ns") == stat.st_mtime_ns:
+        return True
+    if entry.get("sha256"):
+        return entry["sha256"] == file_sha256(file_path)
+    # Legacy entry: only the date is known (as written by SimpleDirectoryReader)
+    from datetime import datetime
+    return entry.get("last_modified_date") == datetime.fromtimestamp(stat.st_mtime).strftime("%Y-%m-%d")
+
+
+def diff_directory(manifest, input_files, docs_path):
+    """
+    Compare the files of a document directory against an index manifest.
+
+    Only indexed files located under `docs_path` can be reported as removed.
+
+    Parameters:
+    manifest (dict): The manifest returned by load_manifest().
+    input_files (list): Paths of the files currently in the directory.
+    docs_path (str): The document directory that was scanned.
+
+    Returns:
+    tuple: (new files, changed files, removed files, unchanged files), as lists of paths.
+    """
+    known = manifest["files"]
+    current = set(str(path) for path in input_files)
+    new, changed, unchanged = [], [], []
+    for path in sorted(current):
+        if path not in known:
+            new.append(path)
+        elif _is_unchanged(path, known[path]):
+            unchanged.append(path)
+        else:
+            changed.append(path)
+    prefix = os.path.join(docs_path, '')
+    removed = sorted(path for path in known if path not in current and path.startswith(prefix))
+    return new, changed, removed, unchanged
+
+
+def delete_files_from_index(index, manifest, file_paths):
+    """
+    Delete every node that came from the given files from a VectorStoreIndex.
+
+    All nodes are removed from the vector store in one pass and the index
+    struct is written back once, rather than once per document.
+
+    Parameters:
+    index (VectorStoreIndex): The loaded index.
+    manifest (dict): The manifest of the index.
+    file_paths (list): Files whose nodes are to be deleted.
+
+    Returns:
+    int: The number of deleted nodes.
+    """
+    docstore = index.docstore
+    node_ids = []
+    ref_doc_ids = []
+    for path in file_paths:
+        for ref_doc_id in manifest["files"].get(path, {}).get("ref_doc_ids", []):
+            ref_doc_info = docstore.get_ref_doc_info(ref_doc_id)
+            if ref_doc_info is not None:
+                node_ids.extend(ref_doc_info.node_ids)
+            ref_doc_ids.append(ref_doc_id)
+    if not ref_doc_ids:
+        return 0
+
+    index.vector_store.delete_nodes(node_ids)
+    for node_id in node_ids:
+        index.index_struct.delete(node_id)
+    for ref_doc_id in ref_doc_ids:
+        docstore.delete_ref_doc(ref_doc_id, raise_error=False)
+    index.storage_context.index_store.add_index_struct(index.index_struct)
+    return len(node_ids)
+
+
+def update_manifest(manifest, docs_path, removed_files, ref_doc_ids_by_file, unchanged_files=()):
+    """
+    Apply the result of an incremental update to the manifest (in place).
+
+    Parameters:
+    manifest (dict): The manifest to update.
+    docs_path (str): The document directory of the index.
+    removed_files (list): Files deleted from the index (removed or changed).
+    ref_doc_ids_by_file (dict): {file_path: [doc_id, ...]} for the new and changed files.
+    unchanged_files (list): Files diff_directory() found unchanged.
+    """
+    manifest["docs_path"] = docs_path
+    for path in removed_files:
+        manifest["files"].pop(path, None)
+    for path, ref_doc_ids in ref_doc_ids_by_file.items():
+        manifest["files"][path] = _file_entry(path, ref_doc_ids)
+    # Refresh the entries of touched-but-identical and legacy files found unchanged, so the next run can skip
+    # hashing; files not compared by this run (e.g. outside docs_path) keep their entry as it is
+    for path in unchanged_files:
+        entry = manifest["files"].get(path)
+        if entry is None or not os.path.isfile(path):
+            continue
+        if entry.get("sha256"):
+            entry["mtime_ns"] = os.stat(path).st_mtime_ns
+        else:
+            manifest["files"][path] = _file_entry(path, entry["ref_doc_ids"])
@@ -0,0 +1,315 @@
+import os
+import json
+import time
+import shutil
+
+from llama_index.core import VectorStoreIndex, Settings, SimpleDirectoryReader, load_index_from_storage
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+import utils.constants as const
+import utils.func
+import utils.vector_store
+import utils.embed_pipeline
+import utils.incremental
+import utils.embed_cache
+import utils.doc_loader
+import utils.web_loader
+import utils.answer_cache
+import utils.metrics
+import utils.bm25
+import utils.chunking
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def list_input_files(docs_path):
+    try:
+        return [str(path) for path in SimpleDirectoryReader(input_dir=docs_path, recursive=True).input_files]
+    except ValueError:
+        # SimpleDirectoryReader refuses empty directories
+        return []
+
+
+def make_embed_model(spec):
+    """
+    Create the embedding model described by a job spec.
+
+    Parameters:
+    spec (dict): With "embed_backend" ('ollama' or 'openai') and "embed_model".
+
+    Returns:
+    BaseEmbedding: The model, behind the embedding cache.
+    """
+    if spec["embed_backend"] == 'openai':
+        from llama_index.embeddings.openai import OpenAIEmbedding
+        return utils.embed_cache.cached(OpenAIEmbedding(model_name=spec["embed_model"], dimensions=1024))
+    from llama_index.embeddings.ollama import OllamaEmbedding
+    return utils.embed_cache.cached(OllamaEmbedding(model_name=spec["embed_model"], base_url=const.OLLAMA_BASE_URL))
+
+
+def load_checkpoint(index_dir):
+    path = os.path.join(index_dir, const.BUILD_CHECKPOINT_FNAME)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+class IndexBuilder:
+    """
+    Build a new index, or update an existing one, as described by a build job.
+
+    The index is built under Indexes/.staging/<job id>/ (hidden from the index
+    lists) and moved into Indexes/ with a rename once it is complete, so the
+    app never sees a half-written index. Files are processed in segments of
+    BUILD_SEGMENT_FILES; after a segment, and at most every
+    BUILD_CHECKPOINT_INTERVAL_SEC, the partial index is saved with the list of
+    files already in it. A cancelled, failed or interrupted job continues
+    from there when it runs again.
+
+    Job spec keys:
+    docs_path, urls, embed_backend, embed_model, chunk_size, chunk_overlap, chunking,
+    embed_batch_size, embed_workers, loader_workers, keyword_index, and for
+    new indexes vector_dtype, ann_backend, ann_nlist, ann_nprobe.
+    """
+
+    def __init__(self, job, queue=None, cancel_event=None):
+        self.job = job
+        self.spec = job["spec"]
+        self.queue = queue
+        self.cancel_event = cancel_event
+        self.index_name = job["index_name"]
+        self.job_dir = os.path.join(const.STAGING_ROOT_PATH, job["id"])
+        self.index_dir = os.path.join(self.job_dir, 'index')
+        self.target_dir = os.path.join(const.INDEX_ROOT_PATH, self.index_name)
+        self.request_id = utils.metrics.new_request_id()
+        self._run_start = None
+        self._files_done_at_start = 0
+        self._last_report = 0.0
+        self._progress = {}
+
+    def _check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise JobCancelled()
+
+    def _report(self, force=False, **progress):
+        """Update the job progress (at most once a second) and stop here if the job was cancelled."""
+        self._progress.update(progress)
+        self._check_cancelled()
+        now = time.monotonic()
+        if self.queue is None or (not force and now - self._last_report < 1.0):
+            return
+        self._last_report = now
+        checkpoint = self.checkpoint
+        total = len(checkpoint["input_files"]) + (1 if checkpoint["urls"] else 0)
+        done = len(checkpoint["files_done"]) + self._progress.get("segment_files_done", 0) + (1 if checkpoint["urls_done"] else 0)
+        fraction = done / total if total else 0.0
+        # Estimated from the files processed by this run, at this run's pace
+        done_this_run = done - self._files_done_at_start
+        elapsed = time.time() - self._run_start
+        eta = elapsed / done_this_run * (total - done) if done_this_run > 0 else None
+        self.queue.set_progress(self.job["id"], dict(self._progress, fraction=fraction, files_done=done, files_total=total,
+                                                     eta_sec=eta, elapsed_sec=checkpoint["elapsed"] + elapsed))
+
+    def _save(self, index, final=False):
+        """
+        Save the index and the checkpoint under the job directory, replacing the previous checkpoint with renames.
+        """
+        self.checkpoint["elapsed"] += time.time() - self._checkpoint_time
+        self._checkpoint_time = time.time()
+        new_dir = self.index_dir + '.new'
+        old_dir = self.index_dir + '.old'
+        shutil.rmtree(new_dir, ignore_errors=True)
+        index.storage_context.persist(persist_dir=new_dir)
+        if not final:
+            with open(os.path.join(new_dir, const.BUILD_CHECKPOINT_FNAME), 'w') as f:
+                json.dump(self.checkpoint, f)
+        if os.path.isdir(self.index_dir):
+            os.rename(self.index_dir, old_dir)
+        os.rename(new_dir, self.index_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        logging.info(f" ### Build job {self.job['id']}: checkpoint with {len(self.checkpoint['files_done'])} files, {self.checkpoint['num_chunks']} chunks")
+
+    def _resume_or_start(self):
+        # A crash between the two renames of _save() leaves the last checkpoint in index.old
+        if not os.path.isdir(self.index_dir) and os.path.isdir(self.index_dir + '.old'):
+            os.rename(self.index_dir + '.old', self.index_dir)
+        checkpoint = load_checkpoint(self.index_dir) if os.path.isdir(self.index_dir) else None
+        if checkpoint is not None:
+            logging.info(f" ### Build job {self.job['id']}: resuming after {len(checkpoint['files_done'])} files")
+            return load_index_from_storage(utils.vector_store.load_storage_context(self.index_dir)), checkpoint
+
+        shutil.rmtree(self.job_dir, ignore_errors=True)
+        os.makedirs(self.job_dir)
+        docs_path = self.spec.get("docs_path")
+        checkpoint = {"input_files": [], "urls": self.spec.get("urls") or [], "urls_done": False, "files_done": [],
+                      "ref_doc_ids_by_file": {}, "failures": [], "num_chunks": 0, "num_documents": 0,
+                      "num_web_documents": 0, "elapsed": 0.0}
+        if self.job["kind"] == 'update':
+            shutil.copytree(self.target_dir, self.index_dir)
+            index = load_index_from_storage(utils.vector_store.load_storage_context(self.index_dir))
+            manifest = utils.incremental.load_manifest(self.index_dir, index.docstore)
+            new, changed, removed, unchanged = utils.incremental.diff_directory(manifest, list_input_files(docs_path), docs_path)
+            logging.info(f"{len(new)} new, {len(changed)} changed, {len(removed)} removed, {len(unchanged)} unchanged files.")
+            checkpoint.update(input_files=new + changed, removed_files=changed + removed, unchanged_files=unchanged, diff={
+                "new": len(new), "changed": len(changed), "removed": len(removed), "unchanged": len(unchanged)})
+            vector_store = index.vector_store
+            checkpoint["ann"] = {"backend": getattr(vector_store, "ann_backend", "exact"),
+                                 "nlist": getattr(vector_store, "ann_nlist", None),
+                                 "nprobe": getattr(vector_store, "ann_nprobe", const.ANN_DEFAULT_NPROBE)}
+            checkpoint["keyword_index"] = self.spec.get("keyword_index") or utils.bm25.has_keyword_index(self.target_dir)
+            checkpoint["num_deleted"] = utils.incremental.delete_files_from_index(index, manifest, changed + removed)
+            # Checkpoints only hold what StorageContext persists; the manifest travels in the checkpoint
+            checkpoint["manifest"] = manifest
+        else:
+            checkpoint["input_files"] = list_input_files(docs_path) if docs_path else []
+            checkpoint["keyword_index"] = self.spec.get("keyword_index", False)
+            checkpoint["ann"] = {"backend": self.spec.get("ann_backend", "exact"), "nlist": self.spec.get("ann_nlist"),
+                                 "nprobe": self.spec.get("ann_nprobe", const.ANN_DEFAULT_NPROBE)}
+            storage_context = utils.vector_store.new_storage_context(self.spec.get("vector_dtype", "float32"))
+            index = VectorStoreIndex(nodes=[], storage_context=storage_context)
+        return index, checkpoint
+
+    def _embed(self, index, documents, embed_model):
+        chunk_seconds = self.chunker.elapsed
+        nodes = self.chunker.run(documents, index.docstore)
+        pipeline = utils.embed_pipeline.EmbeddingPipeline(
+            embed_model,
+            batch_size=self.spec.get("embed_batch_size", const.EMBED_BATCH_SIZE),
+            max_workers=self.spec.get("embed_workers", const.EMBED_MAX_WORKERS),
+            progress=lambda num, rate: self._report(chunks_done=self.checkpoint["num_chunks"] + num, chunks_per_sec=rate))
+        num_chunks = utils.embed_pipeline.insert_embedded_nodes(index, pipeline.run(nodes))
+        self.checkpoint["num_chunks"] += num_chunks
+        utils.metrics.record("build_chunk_seconds", self.chunker.elapsed - chunk_seconds, self.request_id, index=self.index_name)
+        utils.metrics.record("build_embed_seconds", pipeline.elapsed, self.request_id, index=self.index_name)
+        utils.metrics.record("build_embed_chunks_per_second", pipeline.chunks_per_sec, self.request_id, index=self.index_name)
+        return pipeline
+
+    def run(self):
+        """
+        Run (or resume) the job to completion and publish the index.
+
+        Returns:
+        dict: A summary of the build, stored as the job result.
+
+        Raises:
+        JobCancelled: If the job was cancelled; the last checkpoint is kept.
+        """
+        Settings.chunk_size = self.spec.get("chunk_size", Settings.chunk_size)
+        Settings.chunk_overlap = self.spec.get("chunk_overlap", Settings.chunk_overlap)
+        self.chunker = utils.chunking.ParallelChunker(Settings.chunk_size, Settings.chunk_overlap,
+                                                      structured=self.spec.get("chunking", "structured") == "structured")
+        try:
+            return self._run()
+        finally:
+            self.chunker.close()
+
+    def _run(self):
+        embed_model = Settings.embed_model = make_embed_model(self.spec)
+        cache_stats_before = utils.embed_cache.get_cache().stats()
+
+        with utils.metrics.span("build_total", self.request_id, index=self.index_name, mode=self.job["kind"]):
+            index, self.checkpoint = self._resume_or_start()
+            checkpoint = self.checkpoint
+            # Chunks and characters per strategy, over every run of the job
+            self.chunker.stats = checkpoint.setdefault("chunk_stats", {})
+            # Approximate search structures are only trained for the published index, not for checkpoints
+            if hasattr(index.vector_store, "ann_backend"):
+                index.vector_store.ann_backend = 'exact'
+            self._run_start = self._checkpoint_time = time.time()
+            last_save = time.monotonic()
+            self._files_done_at_start = len(checkpoint["files_done"]) + (1 if checkpoint["urls_done"] else 0)
+            self._report(force=True, phase="loading")
+
+            if checkpoint["urls"] and not checkpoint["urls_done"]:
+                web_loader = utils.web_loader.ConcurrentWebLoader(
+                    checkpoint["urls"], html_to_text=True, cache=utils.web_loader.get_cache(),
+                    progress=lambda done, total, url: self._report(phase="fetching web pages"))
+                self._embed(index, web_loader, embed_model)
+                utils.metrics.record("build_load_seconds", sum(secs for _, secs, _ in web_loader.latencies),
+                                     self.request_id, index=self.index_name, source="web")
+                checkpoint["failures"] += [list(failure) for failure in web_loader.failures]
+                checkpoint["num_web_documents"] = web_loader.num_documents
+                checkpoint["urls_done"] = True
+
+            done = set(checkpoint["files_done"])
+            remaining = [path for path in checkpoint["input_files"] if path not in done]
+            for start in range(0, len(remaining), const.BUILD_SEGMENT_FILES):
+                self._check_cancelled()
+                segment = remaining[start:start + const.BUILD_SEGMENT_FILES]
+                loader = utils.doc_loader.StreamingDocumentLoader(
+                    segment, process_workers=self.spec.get("loader_workers", const.LOADER_PROCESS_WORKERS),
+                    progress=lambda done, total, path, error: self._report(phase="embedding", segment_files_done=done,
+                                                                          current_file=os.path.basename(path)))
+                self._embed(index, loader, embed_model)
+                utils.metrics.record("build_load_seconds", sum(secs for _, secs, _ in loader.timings),
+                                     self.request_id, index=self.index_name, source="local")
+                checkpoint["files_done"] += segment
+                checkpoint["ref_doc_ids_by_file"].update(loader.ref_doc_ids_by_file)
+                checkpoint["failures"] += [list(failure) for failure in loader.failures]
+                checkpoint["num_documents"] += loader.num_documents
+                self._progress["segment_files_done"] = 0
+                if time.monotonic() - last_save > const.BUILD_CHECKPOINT_INTERVAL_SEC and start + len(segment) < len(remaining):
+                    with utils.metrics.span("build_checkpoint", self.request_id, index=self.index_name):
+                        self._save(index)
+                    last_save = time.monotonic()
+
+            self._report(force=True, phase="saving")
+            self._check_cancelled()
+            ann = checkpoint["ann"]
+            vector_store = index.vector_store
+            if hasattr(vector_store, "ann_nlist"):
+                vector_store.ann_backend, vector_store.ann_nlist, vector_store.ann_nprobe = ann["backend"], ann["nlist"], ann["nprobe"]
+            with utils.metrics.span("build_persist", self.request_id, index=self.index_name):
+                self._save(index, final=True)
+                docs_path = self.spec.get("docs_path")
+                if self.job["kind"] == 'update':
+                    manifest = checkpoint["manifest"]
+                    utils.incremental.update_manifest(manifest, docs_path, checkpoint["removed_files"], checkpoint["ref_doc_ids_by_file"],
+                                                      checkpoint.get("unchanged_files", []))
+                    utils.incremental.save_manifest(self.index_dir, manifest)
+                else:
+                    utils.incremental.write_manifest(self.index_dir, docs_path, checkpoint["ref_doc_ids_by_file"])
+            if checkpoint["keyword_index"]:
+                # Rebuilt from the docstore rather than patched: tokenizing is cheap next to embedding
+                self._report(force=True, phase="building the keyword index")
+                with utils.metrics.span("build_keyword_index", self.request_id, index=self.index_name):
+                    utils.bm25.BM25Index.from_index(index).save(self.index_dir)
+            self.publish()
+
+        cache_stats = utils.embed_cache.get_cache().stats()
+        elapsed = checkpoint["elapsed"]
+        result = {
+            "num_documents": checkpoint["num_documents"],
+            "num_web_documents": checkpoint["num_web_documents"],
+            "num_chunks": checkpoint["num_chunks"],
+            "elapsed_sec": elapsed,
+            "chunks_per_sec": checkpoint["num_chunks"] / elapsed if elapsed > 0 else 0.0,
+            "avg_chunk_chars": self.chunker.avg_chunk_chars,
+            "chunks_by_strategy": checkpoint["chunk_stats"],
+            "size_mib": utils.func.get_total_size_mib(self.target_dir),
+            "failures": checkpoint["failures"][:50],
+            "embed_cache_hits": cache_stats["hits"] - cache_stats_before["hits"],
+            "embed_cache_misses": cache_stats["misses"] - cache_stats_before["misses"],
+        }
+        if self.job["kind"] == 'update':
+            result.update(diff=checkpoint["diff"], num_deleted=checkpoint["num_deleted"])
+        return result
+
+    def publish(self):
+        """Move the finished index into Indexes/, replacing the previous version of an updated index."""
+        if self.job["kind"] == 'update' and os.path.isdir(self.target_dir):
+            replaced_dir = os.path.join(self.job_dir, 'replaced')
+            os.rename(self.target_dir, replaced_dir)
+        elif os.path.exists(self.target_dir):
+            raise FileExistsError(f"'{self.target_dir}' was created while the job was running")
+        os.rename(self.index_dir, self.target_dir)
+        shutil.rmtree(self.job_dir, ignore_errors=True)
+        # The app reloads the index on its next use since its files changed (see utils/index_cache.py)
+        utils.answer_cache.get_cache().invalidate_index(self.index_name)
+        logging.info(f" ### Index '{self.index_name}' published under {self.target_dir}")
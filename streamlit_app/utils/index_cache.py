@@ -0,0 +1,133 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+import utils.constants as const
+
+
+def index_fingerprint(persist_dir):
+    """
+    Compute a fingerprint of a saved index from the names, sizes and mtimes of its files.
+
+    Parameters:
+    persist_dir (str): The path to the index directory.
+
+    Returns:
+    tuple: (fingerprint (str), total size of the files in bytes (int))
+    """
+    digest = hashlib.sha1()
+    total_size = 0
+    with os.scandir(persist_dir) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            total_size += stat.st_size
+            digest.update(f"{entry.name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return digest.hexdigest(), total_size
+
+
+class IndexRegistry:
+    """
+    Process-wide cache of loaded indexes, shared by every Streamlit session.
+
+    Entries are keyed by index name and validated against the on-disk
+    fingerprint of the index directory, so an index rebuilt in place is
+    reloaded on next use. The least recently used entries are evicted once
+    the estimated size of the loaded indexes exceeds the memory budget.
+    """
+
+    def __init__(self, root_path, budget_mib):
+        self.root_path = root_path
+        self.budget_bytes = budget_mib * 1024 * 1024
+        self._entries = OrderedDict()   # name -> (fingerprint, size_bytes, index)
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    def _fingerprint(self, name):
+        return index_fingerprint(os.path.join(self.root_path, name))
+
+    def contains(self, name):
+        """Check if an up-to-date copy of the index is already loaded."""
+        with self._lock:
+            entry = self._entries.get(name)
+        if entry is None:
+            return False
+        try:
+            return entry[0] == self._fingerprint(name)[0]
+        except OSError:
+            return False
+
+    def get(self, name, loader):
+        """
+        Get a loaded index, calling `loader(name)` only if it is not cached or is stale.
+
+        Parameters:
+        name (str): The index name (directory under the index root path).
+        loader (callable): Function loading the index by name.
+
+        Returns:
+        BaseIndex: The shared index object.
+        """
+        fingerprint, size = self._fingerprint(name)
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and entry[0] == fingerprint:
+                self._entries.move_to_end(name)
+                return entry[2]
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+
+        # Only one session loads a given index; others wait and reuse its result
+        with load_lock:
+            with self._lock:
+                entry = self._entries.get(name)
+                if entry is not None and entry[0] == fingerprint:
+                    self._entries.move_to_end(name)
+                    return entry[2]
+            logging.info(f" ### IndexRegistry: loading '{name}' ({size / 1024 / 1024:.1f} MiB on disk)")
+            index = loader(name)
+            with self._lock:
+                self._entries[name] = (fingerprint, size, index)
+                self._entries.move_to_end(name)
+                self._evict_over_budget(keep=name)
+        return index
+
+    def _evict_over_budget(self, keep):
+        total = sum(entry[1] for entry in self._entries.values())
+        for name in list(self._entries.keys()):
+            if total <= self.budget_bytes:
+                break
+            if name == keep:
+                continue
+            total -= self._entries.pop(name)[1]
+            logging.info(f" ### IndexRegistry: evicted '{name}' (over {self.budget_bytes / 1024 / 1024:.0f} MiB budget)")
+
+    def invalidate(self, name):
+        """Drop an index from the cache, e.g. after it was rebuilt."""
+        with self._lock:
+            if self._entries.pop(name, None) is not None:
+                logging.info(f" ### IndexRegistry: invalidated '{name}'")
+
+    def clear(self):
+        """Drop every loaded index."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Summarize the cache content.
+
+        Returns:
+        list: (name, size in MiB) tuples from least to most recently used.
+        """
+        with self._lock:
+            return [(name, entry[1] / 1024 / 1024) for name, entry in self._entries.items()]
+
+
+# Module state outlives Streamlit reruns and is shared by all sessions of the server process
+registry = IndexRegistry(const.INDEX_ROOT_PATH, const.INDEX_CACHE_BUDGET_MIB)
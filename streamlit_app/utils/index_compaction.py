@@ -0,0 +1,237 @@
+import os
+import gzip
+import time
+import shutil
+import hashlib
+
+import numpy as np
+
+from llama_index.core.schema import MetadataMode
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+import utils.constants as const
+import utils.answer_cache
+import utils.bm25
+import utils.build_jobs
+import utils.exact_search
+import utils.vector_store
+
+# Files of an index directory, grouped into the components reported before and after compaction
+COMPONENTS = {
+    "Vectors": [const.VECTOR_MATRIX_FNAME, const.VECTOR_SCALES_FNAME, const.VECTOR_STORE_JSON_FNAME],
+    "Vector ids and metadata": [const.VECTOR_IDS_FNAME],
+    "Docstore": [const.DOCSTORE_FNAME, const.DOCSTORE_GZ_FNAME],
+    "Index store": ['index_store.json'],
+    "Keyword index": [const.KEYWORD_INDEX_FNAME],
+    "ANN index": [const.ANN_IVF_FNAME, const.ANN_CONFIG_FNAME],
+}
+
+
+def component_sizes(persist_dir):
+    """
+    Size on disk of each component of a saved index.
+
+    Parameters:
+    persist_dir (str): The path to the index directory.
+
+    Returns:
+    dict: Component name (see COMPONENTS, plus "Other") -> bytes.
+    """
+    owner = {fname: component for component, fnames in COMPONENTS.items() for fname in fnames}
+    sizes = {component: 0 for component in COMPONENTS}
+    sizes["Other"] = 0
+    with os.scandir(persist_dir) as entries:
+        for entry in entries:
+            if entry.is_file():
+                sizes[owner.get(entry.name, "Other")] += entry.stat().st_size
+    return sizes
+
+
+def _vector_rows(vector_store):
+    # (ids, ref_doc_ids, metadata, float32 matrix) of either kind of vector store
+    if isinstance(vector_store, utils.vector_store.MmapVectorStore):
+        return (vector_store.node_ids, list(vector_store._ref_doc_ids), dict(vector_store._metadata),
+                np.asarray(vector_store.matrix, dtype=np.float32))
+    data = vector_store.data
+    ids = list(data.embedding_dict.keys())
+    metadata = data.metadata_dict or {}
+    return (ids, [data.text_id_to_ref_doc_id.get(i, "None") for i in ids], {i: metadata[i] for i in ids if i in metadata},
+            np.asarray(list(data.embedding_dict.values()), dtype=np.float32).reshape(len(ids), -1))
+
+
+def find_duplicates(docstore, node_ids):
+    """
+    Find chunks whose text is identical to an earlier one, e.g. from copies of a document.
+
+    Parameters:
+    docstore (BaseDocumentStore): The docstore of the index.
+    node_ids (list): Node ids, in the order in which the first copy is kept.
+
+    Returns:
+    dict: Duplicate node id -> id of the node kept in its place.
+    """
+    first = {}
+    duplicates = {}
+    for node in docstore.get_nodes(node_ids, raise_error=False):
+        if node is None:
+            continue
+        digest = hashlib.sha1(node.get_content(metadata_mode=MetadataMode.NONE).encode('utf-8')).digest()
+        kept = first.setdefault(digest, node.node_id)
+        if kept != node.node_id:
+            duplicates[node.node_id] = kept
+    return duplicates
+
+
+def retrieval_agreement(original_ids, original, compacted_ids, compacted, queries, top_k, exclude=None, canonical=None):
+    """
+    Compare the top-k results of the original and the compacted embeddings.
+
+    Parameters:
+    original_ids, compacted_ids (list): Node ids of the rows of each matrix.
+    original, compacted (np.ndarray): The embedding matrices, as float32.
+    queries (np.ndarray): Query embeddings, one per row.
+    top_k (int): Number of results compared per query.
+    exclude (list): For each query, a node id left out of both result lists (the held-out chunk itself), or None.
+    canonical (dict): Removed node id -> node id kept in its place.
+
+    Returns:
+    dict: recall_at_k (share of the original top-k still found), top1_agreement, and the number of queries.
+    """
+    if len(queries) == 0 or len(original_ids) == 0:
+        return {"queries": 0, "top_k": top_k, "recall_at_k": None, "top1_agreement": None}
+    canonical = canonical or {}
+    exclude = exclude or [None] * len(queries)
+    # One extra result per list makes up for the excluded node and a removed copy of it
+    depth = top_k + 2
+    before = utils.exact_search.ExactSearchIndex(original_ids, original).search_batch(queries, depth)
+    after = utils.exact_search.ExactSearchIndex(compacted_ids, compacted).search_batch(queries, depth)
+    recall, top1 = 0.0, 0
+    for (ids_before, _), (ids_after, _), skipped in zip(before, after, exclude):
+        expected = []
+        for node_id in ids_before:
+            node_id = canonical.get(node_id, node_id)
+            if node_id != skipped and node_id not in expected:
+                expected.append(node_id)
+        found = [node_id for node_id in ids_after if node_id != skipped][:top_k]
+        expected = expected[:top_k]
+        recall += len(set(expected) & set(found)) / max(1, len(expected))
+        top1 += bool(expected and found and expected[0] == found[0])
+    return {"queries": len(queries), "top_k": top_k,
+            "recall_at_k": recall / len(queries), "top1_agreement": top1 / len(queries)}
+
+
+def compact_index(persist_dir, dtype='float16', dedupe=True, compress_docstore=True, num_queries=const.COMPACT_EVAL_QUERIES,
+                  top_k=const.COMPACT_EVAL_TOP_K, query_embeddings=None, dry_run=False):
+    """
+    Shrink a saved index: quantize its embeddings, drop duplicate chunks and compress its docstore.
+
+    The compacted copy is written under the hidden `.staging` directory next
+    to the index, measured, and then swapped in place of the index (unless
+    `dry_run`). Indexes in the JSON vector format come out in the binary one.
+
+    The retrieval-quality change is measured on held-out queries: by default
+    the embeddings of `num_queries` chunks picked at random, each searched in
+    the original and the compacted embeddings with the chunk itself left out,
+    or the given `query_embeddings` (e.g. real questions, embedded).
+
+    Parameters:
+    persist_dir (str): The path to the index directory.
+    dtype (str): Storage precision of the compacted embeddings, one of VECTOR_DTYPES.
+    dedupe (bool): Remove chunks whose text is identical to another chunk's.
+    compress_docstore (bool): Keep the docstore gzipped.
+    num_queries (int): Number of held-out chunks used as queries when no `query_embeddings` are given.
+    top_k (int): Number of results compared per query.
+    query_embeddings (list): Embedded queries to measure with, instead of held-out chunks.
+    dry_run (bool): Only measure; the index is left untouched.
+
+    Returns:
+    dict: before/after (component -> bytes), num_vectors_before/after, num_duplicates,
+        dtype_before, dtype, quality (see retrieval_agreement()), elapsed_sec and applied.
+    """
+    from llama_index.core import StorageContext
+
+    if dtype not in const.VECTOR_DTYPES:
+        raise ValueError(f"Unsupported dtype '{dtype}', use one of {const.VECTOR_DTYPES}")
+    start_time = time.time()
+    persist_dir = os.path.abspath(persist_dir)
+    index_name = os.path.basename(persist_dir)
+    if not dry_run and utils.build_jobs.get_queue().is_active(index_name):
+        raise RuntimeError(f"A build job is running for '{index_name}'; compact it once the job is done")
+
+    before = component_sizes(persist_dir)
+    storage_context = utils.vector_store.load_storage_context(persist_dir)
+    docstore = storage_context.docstore
+    index_struct = storage_context.index_store.index_structs()[0]
+    old_store = storage_context.vector_store
+    ids, ref_doc_ids, metadata, original = _vector_rows(old_store)
+    dtype_before = old_store.dtype if isinstance(old_store, utils.vector_store.MmapVectorStore) else 'json'
+
+    duplicates = find_duplicates(docstore, ids) if dedupe else {}
+    for node_id in duplicates:
+        docstore.delete_document(node_id, raise_error=False)
+        if node_id in index_struct.nodes_dict:
+            index_struct.delete(node_id)
+    storage_context.index_store.add_index_struct(index_struct)
+    keep = np.array([i not in duplicates for i in ids], dtype=bool)
+
+    vector_store = utils.vector_store.MmapVectorStore(
+        dtype=dtype, ann_backend=getattr(old_store, "ann_backend", 'exact'), ann_nlist=getattr(old_store, "ann_nlist", None),
+        ann_nprobe=getattr(old_store, "ann_nprobe", const.ANN_DEFAULT_NPROBE))
+    vector_store._ids = [i for i, kept in zip(ids, keep) if kept]
+    vector_store._ref_doc_ids = [r for r, kept in zip(ref_doc_ids, keep) if kept]
+    vector_store._metadata = {i: metadata[i] for i in vector_store._ids if i in metadata}
+    vector_store._matrix = np.ascontiguousarray(original[keep]) if len(original) else None
+
+    staging_dir = os.path.join(os.path.dirname(persist_dir), os.path.basename(const.STAGING_ROOT_PATH), f"compact_{index_name}")
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    StorageContext.from_defaults(docstore=docstore, index_store=storage_context.index_store,
+                                 vector_store=vector_store).persist(persist_dir=staging_dir)
+    if os.path.isfile(os.path.join(persist_dir, const.FILE_MANIFEST_FNAME)):
+        shutil.copy2(os.path.join(persist_dir, const.FILE_MANIFEST_FNAME), staging_dir)
+    if compress_docstore:
+        docstore_path = os.path.join(staging_dir, const.DOCSTORE_FNAME)
+        with open(docstore_path, 'rb') as src, gzip.open(os.path.join(staging_dir, const.DOCSTORE_GZ_FNAME), 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(docstore_path)
+    if utils.bm25.has_keyword_index(persist_dir):
+        utils.bm25.BM25Index.from_storage(staging_dir).save(staging_dir)
+
+    compacted = utils.vector_store.MmapVectorStore.from_persist_dir(staging_dir)
+    if query_embeddings is not None:
+        queries, exclude = np.asarray(query_embeddings, dtype=np.float32), None
+    else:
+        kept_rows = np.flatnonzero(keep)
+        rows = np.sort(np.random.default_rng(0).choice(kept_rows, size=min(num_queries, len(kept_rows)), replace=False))
+        queries, exclude = original[rows], [ids[row] for row in rows]
+    quality = retrieval_agreement(ids, original, compacted.node_ids, compacted.matrix, queries, top_k, exclude, duplicates)
+    after = component_sizes(staging_dir)
+
+    if dry_run:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    else:
+        old_dir = staging_dir + '.old'
+        shutil.rmtree(old_dir, ignore_errors=True)
+        os.rename(persist_dir, old_dir)
+        os.rename(staging_dir, persist_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        # The app reloads the index on its next use since its files changed (see utils/index_cache.py)
+        utils.answer_cache.get_cache().invalidate_index(index_name)
+
+    elapsed = time.time() - start_time
+    logging.info(f" ### Compacted '{index_name}'{' (dry run)' if dry_run else ''}: {sum(before.values()) / 2**20:.1f} MiB -> "
+                 f"{sum(after.values()) / 2**20:.1f} MiB, {len(duplicates)} duplicates, recall@{top_k} {quality['recall_at_k']} in {elapsed:.1f}s")
+    return {
+        "before": before,
+        "after": after,
+        "num_vectors_before": len(ids),
+        "num_vectors_after": compacted.count,
+        "num_duplicates": len(duplicates),
+        "dtype_before": dtype_before,
+        "dtype": dtype,
+        "quality": quality,
+        "elapsed_sec": elapsed,
+        "applied": not dry_run,
+    }
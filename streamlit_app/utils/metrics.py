@@ -0,0 +1,334 @@
+import os
+import glob
+import json
+import time
+import uuid
+import threading
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+from logging import FileHandler
+
+import numpy as np
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+import utils.constants as const
+
+
+class MetricsRegistry:
+    """
+    In-process store of observations (durations, rates, counts), keyed by metric name and labels.
+
+    Keeps a count and sum per series plus a window of the most recent values
+    for percentiles, and renders everything in the Prometheus text format.
+    """
+
+    def __init__(self, window=const.METRICS_WINDOW):
+        self.window = window
+        self._series = {}   # (name, labels) -> {"count", "sum", "last", "recent"}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"count": 0, "sum": 0.0, "last": 0.0, "recent": deque(maxlen=self.window)}
+            series["count"] += 1
+            series["sum"] += value
+            series["last"] = value
+            series["recent"].append(value)
+
+    def summary(self):
+        """
+        Summarize every series.
+
+        Returns:
+        list: Dicts with name, labels, count, mean, p50, p99 and last.
+        """
+        with self._lock:
+            items = [(key, dict(series), list(series["recent"])) for key, series in self._series.items()]
+        rows = []
+        for (name, labels), series, recent in sorted(items, key=lambda item: item[0]):
+            rows.append({
+                "name": name,
+                "labels": dict(labels),
+                "count": series["count"],
+                "mean": series["sum"] / series["count"],
+                "p50": float(np.percentile(recent, 50)),
+                "p99": float(np.percentile(recent, 99)),
+                "last": series["last"],
+            })
+        return rows
+
+    def prometheus_text(self):
+        """Render the metrics as summaries in the Prometheus text exposition format."""
+        lines = []
+        declared = set()
+        for row in self.summary():
+            family = f"jetson_copilot_{row['name']}"
+            if family not in declared:
+                lines.append(f"# TYPE {family} summary")
+                declared.add(family)
+            labels = [f'{k}="{v}"' for k, v in row["labels"].items()]
+            for quantile, value in (("0.5", row["p50"]), ("0.99", row["p99"])):
+                quantile_labels = ",".join(labels + ['quantile="%s"' % quantile])
+                lines.append(f"{family}{{{quantile_labels}}} {value:.6g}")
+            suffix = f"{{{','.join(labels)}}}" if labels else ""
+            lines.append(f"{family}_sum{suffix} {row['mean'] * row['count']:.6g}")
+            lines.append(f"{family}_count{suffix} {row['count']}")
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+# Module state is shared by all sessions (and pages) of the server process
+registry = MetricsRegistry()
+
+_span_logger = None
+_span_logger_lock = threading.Lock()
+_local = threading.local()
+# Worker processes write their spans to a file of their own, which only the server process rotates into its log
+_worker_log = False
+
+
+def _get_span_logger():
+    global _span_logger
+    with _span_logger_lock:
+        if _span_logger is None:
+            _span_logger = logging.getLogger("jetson_copilot.spans")
+            _span_logger.propagate = False
+            try:
+                os.makedirs(const.LOG_ROOT_PATH, exist_ok=True)
+                if _worker_log:
+                    handler = FileHandler(os.path.join(const.LOG_ROOT_PATH, const.METRICS_WORKER_LOG_FNAME.format(pid=os.getpid())))
+                else:
+                    handler = RotatingFileHandler(os.path.join(const.LOG_ROOT_PATH, const.METRICS_LOG_FNAME),
+                                                  maxBytes=const.METRICS_LOG_MAX_MIB * 1024 * 1024,
+                                                  backupCount=const.METRICS_LOG_BACKUPS)
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                _span_logger.addHandler(handler)
+                _span_logger.setLevel(logging.INFO)
+            except OSError as e:
+                logging.warning(f"!!!!!! Span log disabled, cannot write under {const.LOG_ROOT_PATH}: {e}")
+                _span_logger.addHandler(logging.NullHandler())
+        return _span_logger
+
+
+def use_worker_log():
+    """
+    Write the spans of this process to METRICS_WORKER_LOG_FNAME instead of the shared, rotated log,
+    for the server process to collect (see collect_worker_spans()). Called first thing in build workers.
+    """
+    global _worker_log
+    _worker_log = True
+
+
+def _process_alive(pid):
+    # A worker that exited stays a zombie until the server reaps it, which it never does
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except (OSError, IndexError):
+        return False
+
+
+_collected = {}   # worker span file -> bytes already collected
+_collect_lock = threading.Lock()
+
+
+def collect_worker_spans():
+    """
+    Add the spans written by worker processes since the last call to the registry and to the
+    span log of this process; the file of a worker that exited is removed once read.
+    """
+    pattern = os.path.join(const.LOG_ROOT_PATH, const.METRICS_WORKER_LOG_FNAME.format(pid='*'))
+    with _collect_lock:
+        for path in glob.glob(pattern):
+            try:
+                pid = int(os.path.basename(path).split('.')[-2])
+            except ValueError:
+                continue
+            # Checked before reading, so that nothing the worker writes afterwards is lost
+            alive = _process_alive(pid)
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(_collected.get(path, 0))
+                    data = f.read()
+            except OSError:
+                continue
+            complete = data[:data.rfind(b'\n') + 1]
+            _collected[path] = _collected.get(path, 0) + len(complete)
+            for line in complete.decode('utf-8', errors='replace').splitlines():
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                labels = {k: v for k, v in entry.items() if k not in ("ts", "name", "value", "request_id")}
+                registry.observe(entry["name"], entry["value"], **labels)
+                _get_span_logger().info(line)
+            if not alive:
+                os.remove(path)
+                _collected.pop(path, None)
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:12]
+
+
+def record(name, value, request_id=None, **labels):
+    """
+    Record an observation: update the registry and append it to the JSON-lines log.
+
+    Parameters:
+    name (str): Metric name including its unit, e.g. 'retrieval_seconds'.
+    value (float): The observed value.
+    request_id (str): Groups the observations of one chat turn or build.
+    labels: Low-cardinality labels, e.g. model or index name.
+    """
+    registry.observe(name, value, **labels)
+    entry = {"ts": datetime.now(timezone.utc).isoformat(timespec='milliseconds'), "name": name, "value": round(value, 6)}
+    if request_id:
+        entry["request_id"] = request_id
+    entry.update(labels)
+    _get_span_logger().info(json.dumps(entry))
+
+
+@contextmanager
+def span(name, request_id=None, **labels):
+    """
+    Time a block and record its duration as `<name>_seconds`.
+
+    Usage:
+        with utils.metrics.span("build_persist", index=name):
+            ...
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(f"{name}_seconds", time.perf_counter() - start_time, request_id, **labels)
+
+
+def install_llama_index_handler():
+    """
+    Record embedding and retrieval durations from llama_index's instrumentation events.
+
+    Safe to call on every Streamlit rerun; the handler is only added once.
+    """
+    import llama_index.core.instrumentation as instrument
+    from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+    from llama_index.core.instrumentation.events.embedding import EmbeddingStartEvent, EmbeddingEndEvent
+    from llama_index.core.instrumentation.events.retrieval import RetrievalStartEvent, RetrievalEndEvent
+
+    pairs = {
+        EmbeddingStartEvent: ("embedding", True), EmbeddingEndEvent: ("embedding", False),
+        RetrievalStartEvent: ("retrieval", True), RetrievalEndEvent: ("retrieval", False),
+    }
+    # LLM events are not timed here: a streamed chat ends in another thread.
+    # Generation is timed by utils/async_generation.py instead.
+
+    class TimingEventHandler(BaseEventHandler):
+        @classmethod
+        def class_name(cls) -> str:
+            return "TimingEventHandler"
+
+        def handle(self, event, **kwargs):
+            kind = pairs.get(type(event))
+            if kind is None:
+                return
+            name, is_start = kind
+            # Only time the events of a chat turn, not the batch embeddings of index builds
+            if getattr(_local, "request_id", None) is None:
+                return
+            # Wrapped models (e.g. CachedEmbedding) nest events of the same kind;
+            # only the outermost pair is timed
+            stack = getattr(_local, "events", None)
+            if stack is None:
+                stack = _local.events = {}
+            starts = stack.setdefault(name, [])
+            if is_start:
+                starts.append(time.perf_counter())
+            elif starts:
+                start_time = starts.pop()
+                if not starts:
+                    record(f"{name}_seconds", time.perf_counter() - start_time, getattr(_local, "request_id", None))
+
+    dispatcher = instrument.get_dispatcher()
+    if not any(h.class_name() == "TimingEventHandler" for h in dispatcher.event_handlers):
+        dispatcher.add_event_handler(TimingEventHandler())
+
+
+def set_request_id(request_id):
+    """Attach the observations made by this thread (including llama_index events) to a request."""
+    _local.request_id = request_id
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port=const.METRICS_PORT):
+    """
+    Serve the registry at http://<host>:<port>/metrics in a background thread (once per process).
+
+    Returns:
+    bool: True if the server is running.
+    """
+    global _server
+    with _server_lock:
+        if _server is not None:
+            return True
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                collect_worker_spans()
+                body = registry.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            _server = ThreadingHTTPServer(('', port), MetricsHandler)
+        except OSError as e:
+            logging.warning(f"!!!!!! Metrics endpoint not started on port {port}: {e}")
+            return False
+        threading.Thread(target=_server.serve_forever, daemon=True, name="metrics-server").start()
+        logging.info(f" ### Metrics endpoint: http://0.0.0.0:{port}/metrics")
+        return True
+
+
+def read_recent_spans(limit=200):
+    """
+    Read the most recent entries of the JSON-lines span log.
+
+    Returns:
+    list: Decoded entries, newest first.
+    """
+    path = os.path.join(const.LOG_ROOT_PATH, const.METRICS_LOG_FNAME)
+    if not os.path.isfile(path):
+        return []
+    with open(path) as f:
+        lines = deque(f, maxlen=limit)
+    entries = []
+    for line in reversed(lines):
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            continue
+    return entries
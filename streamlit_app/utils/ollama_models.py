@@ -0,0 +1,537 @@
+import os
+import json
+import time
+import threading
+import collections
+
+import ollama
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+import utils.constants as const
+import utils.ollama_scheduler
+import utils.metrics
+
+
+_models = None
+_models_time = 0.0
+_models_lock = threading.Lock()
+
+
+def list_models(ttl=const.MODEL_LIST_TTL_SEC):
+    """
+    List the models hosted on Ollama, at most one `ollama.list()` call per `ttl` seconds.
+
+    Parameters:
+    ttl (float): How long a listing is reused, shared by all sessions.
+
+    Returns:
+    list: The model entries returned by `ollama.list()`.
+    """
+    global _models, _models_time
+    with _models_lock:
+        if _models is None or time.monotonic() - _models_time > ttl:
+            _models = ollama.list()["models"]
+            _models_time = time.monotonic()
+        return _models
+
+
+def list_model_names(ttl=const.MODEL_LIST_TTL_SEC):
+    return [model["name"] for model in list_models(ttl)]
+
+
+def invalidate():
+    """Forget the cached listing, e.g. after a model was pulled or deleted."""
+    global _models
+    with _models_lock:
+        _models = None
+
+
+def _canonical(name):
+    # "llama3" and "llama3:latest" are the same model to Ollama, and to the pull queue
+    name = name.strip()
+    return name if ':' in name.rsplit('/', 1)[-1] else f"{name}:latest"
+
+
+def _retryable(e):
+    # Dropped connections and digest mismatches (Ollama drops the bad layer) are worth a retry; a wrong name is not
+    if isinstance(e, ollama.ResponseError):
+        message = str(e).lower()
+        return "digest" in message or "eof" in message or "connection" in message
+    return True
+
+
+class PullJob:
+    """
+    Pull of one model from the Ollama library, run by a download thread (see start_pull()).
+
+    Attributes:
+    name (str): The model name.
+    state (str): 'queued', 'pulling', 'done', 'failed' or 'cancelled'.
+    status (str): The last status reported by Ollama, e.g. "verifying sha256 digest".
+    layers (dict): Layer digest -> (bytes downloaded, size), over every layer seen so far.
+    attempts (int): Pulls started, retries included.
+    error (str): The error message if the pull failed.
+    done (bool): True once the pull succeeded, failed or was cancelled.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.state = "queued"
+        self.status = "queued"
+        self.layers = {}
+        self.attempts = 0
+        self.error = None
+        self.done = False
+        self.started = None
+        self.finished = None
+        self._samples = collections.deque()   # (time.monotonic(), bytes downloaded), for the throughput
+        self._last_log = 0.0
+        self._cancel = threading.Event()
+
+    @property
+    def completed(self):
+        return sum(completed for completed, total in list(self.layers.values()))
+
+    @property
+    def total(self):
+        return sum(total for completed, total in list(self.layers.values()))
+
+    @property
+    def progress(self):
+        total = self.total
+        return min(self.completed / total, 1.0) if total else 0.0
+
+    def rate(self):
+        """Bytes per second over the last MODEL_PULL_RATE_WINDOW_SEC."""
+        samples = list(self._samples)
+        if self.done or len(samples) < 2 or samples[-1][0] <= samples[0][0]:
+            return 0.0
+        return max(samples[-1][1] - samples[0][1], 0) / (samples[-1][0] - samples[0][0])
+
+    def eta(self):
+        """Seconds left at the current rate, None while unknown."""
+        rate = self.rate()
+        return (self.total - self.completed) / rate if rate > 0 else None
+
+    def cancel(self):
+        """Stop the pull; Ollama keeps the layers downloaded so far, so pulling again resumes."""
+        self._cancel.set()
+
+    def _update(self, res):
+        status = res.get("status", self.status)
+        if status != self.status:
+            logging.info(f" ### Pulling {self.name}: {status}")
+            self.status = status
+        if res.get("total"):
+            self.layers[res.get("digest", status)] = (res.get("completed", 0), res["total"])
+            now = time.monotonic()
+            self._samples.append((now, self.completed))
+            while now - self._samples[0][0] > const.MODEL_PULL_RATE_WINDOW_SEC:
+                self._samples.popleft()
+            # Ollama reports progress many times a second; the log gets a line every MODEL_PULL_LOG_INTERVAL_SEC
+            if now - self._last_log > const.MODEL_PULL_LOG_INTERVAL_SEC:
+                self._last_log = now
+                rate = self.rate()
+                logging.info(f" ### Pulling {self.name}: {self.completed / 2**20:,.0f} / {self.total / 2**20:,.0f} MiB"
+                             + (f" ({rate / 2**20:,.1f} MiB/s)" if rate else ""))
+
+    def _pull(self):
+        stream = ollama.pull(self.name, stream=True)
+        try:
+            for res in stream:
+                if self._cancel.is_set():
+                    return False
+                self._update(res)
+        finally:
+            stream.close()
+        return True
+
+    def _run(self):
+        logging.info(f" ### Pulling {self.name} in the background")
+        self.started = time.monotonic()
+        self.state = "pulling"
+        self.status = "waiting for the Ollama server"
+        try:
+            while True:
+                self.attempts += 1
+                try:
+                    with utils.ollama_scheduler.slot(utils.ollama_scheduler.DOWNLOAD, kind='pull'):
+                        completed = self._pull()
+                    break
+                except Exception as e:
+                    if self._cancel.is_set():
+                        completed = False
+                        break
+                    if self.attempts > const.MODEL_PULL_RETRIES or not _retryable(e):
+                        raise
+                    logging.warning(f"!!! Pulling {self.name} failed ({e}), resuming in {const.MODEL_PULL_RETRY_SEC * self.attempts}s")
+                    utils.metrics.record("model_pull_retries", 1, model=self.name)
+                    self.status = f"retrying after: {e}"
+                    if self._cancel.wait(const.MODEL_PULL_RETRY_SEC * self.attempts):
+                        completed = False
+                        break
+            invalidate()
+            if not completed:
+                logging.info(f" ### Pulling {self.name} cancelled.")
+                self.state = "cancelled"
+            elif self.name not in list_model_names(ttl=0):
+                raise RuntimeError("Ollama reported success, but the model is not listed")
+            else:
+                utils.metrics.record("model_pull_seconds", time.monotonic() - self.started, model=self.name)
+                logging.info(f" ### Pulling {self.name} completed.")
+                self.state = "done"
+        except Exception as e:
+            logging.error(f"!!!!!! Pulling {self.name} failed: {e}")
+            self.error = str(e)
+            self.state = "failed"
+        finally:
+            invalidate()
+            self.finished = time.monotonic()
+            self.done = True
+
+
+# Shared by all sessions, so a model is only pulled once however many pages ask for it,
+# and a page that is reloaded or left finds its pulls where they are
+_pull_jobs = {}
+_pull_queue = collections.deque()
+_pull_jobs_lock = threading.Condition()
+_pull_workers = 0
+_pulls_resumed = False
+
+
+def _save_pulls():
+    # Called with _pull_jobs_lock held
+    path = os.path.join(const.CACHE_ROOT_PATH, const.MODEL_PULLS_FNAME)
+    try:
+        os.makedirs(const.CACHE_ROOT_PATH, exist_ok=True)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump([job.name for job in _pull_jobs.values() if not job.done], f)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        logging.warning(f"!!! Saving the download queue failed: {e}")
+
+
+def _pull_worker():
+    global _pull_workers
+    while True:
+        with _pull_jobs_lock:
+            if not _pull_queue:
+                _pull_workers -= 1
+                return
+            job = _pull_queue.popleft()
+        if not job.done:
+            job._run()
+        with _pull_jobs_lock:
+            _save_pulls()
+
+
+def _resume_pulls():
+    """Queue again the pulls that were not finished when the server stopped."""
+    global _pulls_resumed
+    with _pull_jobs_lock:
+        if _pulls_resumed:
+            return
+        _pulls_resumed = True
+    try:
+        with open(os.path.join(const.CACHE_ROOT_PATH, const.MODEL_PULLS_FNAME)) as f:
+            names = json.load(f)
+    except (OSError, ValueError):
+        return
+    for name in names:
+        logging.info(f" ### Resuming the download of {name}")
+        start_pull(name)
+
+
+def start_pull(name, retry_failed=True):
+    """
+    Queue a model pull unless the model is already queued or being pulled.
+
+    Parameters:
+    name (str): The model name ("llama3" stands for "llama3:latest").
+    retry_failed (bool): Start again if the last pull of this model failed or was cancelled.
+
+    Returns:
+    PullJob: The queued, running (or last) job for this model.
+    """
+    global _pull_workers
+    _resume_pulls()
+    name = _canonical(name)
+    with _pull_jobs_lock:
+        job = _pull_jobs.get(name)
+        if job is None or (job.done and (retry_failed or job.state == "done")):
+            job = _pull_jobs[name] = PullJob(name)
+            _pull_queue.append(job)
+            _save_pulls()
+            if _pull_workers < const.MODEL_PULL_WORKERS:
+                _pull_workers += 1
+                threading.Thread(target=_pull_worker, daemon=True, name="model-pulls").start()
+        return job
+
+
+def cancel_pull(name):
+    """Cancel a queued or running pull."""
+    with _pull_jobs_lock:
+        job = _pull_jobs.get(_canonical(name))
+        if job is None or job.done:
+            return
+        job.cancel()
+        if job in _pull_queue:
+            _pull_queue.remove(job)
+            job.state = job.status = "cancelled"
+            job.done = True
+            job.finished = time.monotonic()
+        _save_pulls()
+
+
+def forget_pull(name):
+    """Drop a finished pull from the list."""
+    with _pull_jobs_lock:
+        job = _pull_jobs.get(_canonical(name))
+        if job is not None and job.done:
+            del _pull_jobs[job.name]
+
+
+def pull_jobs():
+    """Every pull of this server, in the order they were queued."""
+    _resume_pulls()
+    with _pull_jobs_lock:
+        return list(_pull_jobs.values())
+
+
+def pending_pulls():
+    """The pulls queued or running."""
+    return [job for job in pull_jobs() if not job.done]
+
+
+def pull_totals():
+    """
+    Progress of the pending pulls together, for display.
+
+    Returns:
+    dict: "pending" and "queued" pulls, "completed" and "total" bytes of the layers
+        seen so far, "rate" in bytes per second and "eta" in seconds (None while unknown).
+    """
+    jobs = pending_pulls()
+    completed = sum(job.completed for job in jobs)
+    total = sum(job.total for job in jobs)
+    rate = sum(job.rate() for job in jobs)
+    return {"pending": len(jobs), "queued": sum(job.state == "queued" for job in jobs),
+            "completed": completed, "total": total, "rate": rate,
+            "eta": (total - completed) / rate if rate > 0 else None}
+
+
+def ensure_models(names=const.REQUIRED_MODELS):
+    """
+    Queue pulls for the models that are missing, without waiting for them.
+    A failed or cancelled pull is not retried here, so that reruns do not loop on it.
+
+    Returns:
+    list: The PullJob of every missing model.
+    """
+    available = list_model_names()
+    return [start_pull(name, retry_failed=False) for name in names if name not in available]
+
+
+_running = None
+_running_time = 0.0
+_running_lock = threading.Lock()
+
+
+def running_models(ttl=const.MODEL_PS_TTL_SEC):
+    """
+    List the models loaded in Ollama, at most one `ollama.ps()` call per `ttl` seconds.
+
+    Returns:
+    dict: Model name -> entry returned by `ollama.ps()` (with its size in memory).
+    """
+    global _running, _running_time
+    with _running_lock:
+        if _running is None or time.monotonic() - _running_time > ttl:
+            try:
+                _running = {model["name"]: model for model in ollama.ps()["models"]}
+            except Exception as e:
+                logging.warning(f"!!! Listing the loaded models failed: {e}")
+                _running = {}
+            _running_time = time.monotonic()
+        return _running
+
+
+def _invalidate_running():
+    global _running
+    with _running_lock:
+        _running = None
+
+
+def memory_budget():
+    """Bytes the loaded models may use together (MODEL_MEMORY_BUDGET_MIB, or a share of the RAM)."""
+    if const.MODEL_MEMORY_BUDGET_MIB is not None:
+        return const.MODEL_MEMORY_BUDGET_MIB * 1024 * 1024
+    return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * const.MODEL_MEMORY_SHARE)
+
+
+_last_used = {}   # model name -> time.monotonic() of its last use, for the LRU order
+_kinds = {}       # model name -> 'chat' or 'embed'
+_usage_lock = threading.Lock()
+
+
+def touch(name, repin=False):
+    """
+    Record a use of a model.
+
+    Parameters:
+    name (str): The model name.
+    repin (bool): Also restore its keep-alive in the background, after a request
+        that did not set it (llama_index sends none, so Ollama applies its default).
+    """
+    with _usage_lock:
+        _last_used[name] = time.monotonic()
+    if repin:
+        threading.Thread(target=_load, args=(name, _kinds.get(name, 'chat')), daemon=True, name=f"pin-{name}").start()
+
+
+def _send_load(name, kind, keep_alive):
+    # An empty prompt only loads the model (or, with keep_alive=0, unloads it)
+    if kind == 'embed':
+        ollama.embeddings(model=name, prompt="", keep_alive=keep_alive)
+    else:
+        ollama.generate(model=name, prompt="", keep_alive=keep_alive)
+
+
+def _load(name, kind, keep_alive=const.MODEL_KEEP_ALIVE):
+    if keep_alive == 0:
+        # Unloading frees memory for the requests waiting, so it does not wait for a slot itself
+        _send_load(name, kind, keep_alive)
+        return
+    with utils.ollama_scheduler.slot(kind='load'):
+        _send_load(name, kind, keep_alive)
+
+
+def unload(name):
+    """Ask Ollama to unload a model now."""
+    logging.info(f" ### Unloading {name}")
+    try:
+        _load(name, _kinds.get(name, 'chat'), keep_alive=0)
+    except Exception as e:
+        logging.warning(f"!!! Unloading {name} failed: {e}")
+    finally:
+        _invalidate_running()
+
+
+def _make_room(name):
+    """Unload the least recently used models until `name` fits in the memory budget."""
+    budget = memory_budget()
+    sizes = {model["name"]: model["size"] for model in list_models()}
+    loaded = {other: entry.get("size", 0) for other, entry in running_models(ttl=0).items() if other != name}
+    needed = sizes.get(name, 0)
+    with _usage_lock:
+        lru = sorted(loaded, key=lambda other: _last_used.get(other, 0.0))
+    busy = {job.name for job in warming()}
+    for other in lru:
+        if sum(loaded.values()) + needed <= budget:
+            break
+        if other in busy:
+            continue
+        unload(other)
+        del loaded[other]
+
+
+class WarmJob:
+    """
+    Load a model into memory in a background thread, unloading others first if needed.
+
+    Attributes:
+    name (str): The model name.
+    kind (str): 'chat' or 'embed'.
+    error (str): The error message if loading failed.
+    seconds (float): How long loading took.
+    done (bool): True once the model is loaded or loading failed.
+    """
+
+    def __init__(self, name, kind):
+        self.name = name
+        self.kind = kind
+        self.error = None
+        self.seconds = None
+        self.done = False
+        self.finished = None
+        self._thread = threading.Thread(target=self._run, daemon=True, name=f"warm-{name}")
+        self._thread.start()
+
+    def _run(self):
+        start_time = time.monotonic()
+        try:
+            _make_room(self.name)
+            logging.info(f" ### Loading {self.name} in the background")
+            _load(self.name, self.kind)
+            self.seconds = time.monotonic() - start_time
+            logging.info(f" ### Loading {self.name} completed in {self.seconds:.1f}s.")
+        except Exception as e:
+            logging.error(f"!!!!!! Loading {self.name} failed: {e}")
+            self.error = str(e)
+        finally:
+            _invalidate_running()
+            self.finished = time.monotonic()
+            self.done = True
+
+
+# Shared by all sessions, like the pulls
+_warm_jobs = {}
+_warm_jobs_lock = threading.Lock()
+
+
+def warm(name, kind='chat'):
+    """
+    Load a model in the background unless it is loaded or loading already, and pin it
+    with MODEL_KEEP_ALIVE. Meant to be called on every rerun for the selected models;
+    a failed load is retried after MODEL_WARM_RETRY_SEC.
+
+    Parameters:
+    name (str): The model name.
+    kind (str): 'chat' or 'embed'.
+
+    Returns:
+    WarmJob: The running (or last) job for this model.
+    """
+    touch(name)
+    with _usage_lock:
+        _kinds[name] = kind
+    with _warm_jobs_lock:
+        job = _warm_jobs.get(name)
+    if job is not None and (not job.done or name in running_models()):
+        return job
+    # Checked again under the lock, without calling Ollama: another session may have started a load meanwhile
+    with _warm_jobs_lock:
+        current = _warm_jobs.get(name)
+        if current is not job:
+            return current
+        if job is None or job.error is None or time.monotonic() - job.finished > const.MODEL_WARM_RETRY_SEC:
+            job = _warm_jobs[name] = WarmJob(name, kind)
+        return job
+
+
+def warming():
+    """The loads still running."""
+    with _warm_jobs_lock:
+        return [job for job in _warm_jobs.values() if not job.done]
+
+
+def model_state(name):
+    """
+    Load state of a model, for display.
+
+    Returns:
+    tuple: (state, size in bytes) where state is 'loading', 'loaded', 'failed' or 'unloaded'.
+    """
+    with _warm_jobs_lock:
+        job = _warm_jobs.get(name)
+    if job is not None and not job.done:
+        return 'loading', 0
+    entry = running_models().get(name)
+    if entry is not None:
+        return 'loaded', entry.get("size", 0)
+    if job is not None and job.error is not None:
+        return 'failed', 0
+    return 'unloaded', 0
@@ -0,0 +1,248 @@
+import os
+import time
+import uuid
+import asyncio
+import sqlite3
+import threading
+from contextlib import contextmanager, asynccontextmanager
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+import utils.constants as const
+import utils.metrics
+
+# Priority classes, best first
+INTERACTIVE = 'interactive'
+BUILD = 'build'
+DOWNLOAD = 'download'
+PRIORITIES = {INTERACTIVE: 0, BUILD: 1, DOWNLOAD: 2}
+
+
+class OllamaBusy(RuntimeError):
+    """Raised instead of queueing a request when the Ollama server is overloaded."""
+
+
+def _process_start(pid):
+    # Start time of a process (Linux), so that a reused pid is not taken for the process that died
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return int(f.read().rsplit(')', 1)[1].split()[19])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class Scheduler:
+    """
+    Admission control for the Ollama server, shared by the app and the build workers.
+
+    Every generation, embedding, model load and pull takes a slot before it
+    is sent, and gives it back once the answer is read. A request starts when
+    fewer than `max_in_flight` are running, its class is under its own limit
+    and no request of a better class is waiting for a slot it could take;
+    within a class, first come first served. Builds and downloads also leave
+    `reserved` slots to interactive requests. When too many requests of a
+    class are waiting already, or one waited too long, OllamaBusy is raised.
+
+    The slots live in a SQLite table, so the worker processes of index
+    builds share them with the Streamlit server; slots of a process that died
+    are reclaimed.
+    """
+
+    def __init__(self, path, max_in_flight=const.OLLAMA_MAX_IN_FLIGHT, class_limits=const.OLLAMA_CLASS_LIMITS,
+                 queue_limits=const.OLLAMA_QUEUE_LIMITS, reserved=const.OLLAMA_RESERVED_INTERACTIVE,
+                 timeouts=const.OLLAMA_WAIT_TIMEOUT_SEC, poll_sec=const.OLLAMA_POLL_SEC):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_in_flight = max_in_flight
+        self.class_limits = class_limits
+        self.queue_limits = queue_limits
+        self.reserved = reserved
+        self.timeouts = timeouts
+        self.poll_sec = poll_sec
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS requests (
+            id TEXT PRIMARY KEY, priority INTEGER, class TEXT, kind TEXT, state TEXT,
+            pid INTEGER, pid_start INTEGER, enqueued REAL, started REAL)""")
+        self._pid_start = _process_start(os.getpid())
+        self._last_reclaim = 0.0
+        # After a container restart this process may have the pid of one that died; its slots are not ours
+        self._conn.execute("DELETE FROM requests WHERE pid=? AND pid_start IS NOT ?", (os.getpid(), self._pid_start))
+
+    def _reclaim(self, now):
+        # Called within a transaction
+        if now - self._last_reclaim < 1.0:
+            return
+        self._last_reclaim = now
+        for pid, pid_start in self._conn.execute("SELECT DISTINCT pid, pid_start FROM requests").fetchall():
+            if (pid, pid_start) != (os.getpid(), self._pid_start) and _process_start(pid) != pid_start:
+                self._conn.execute("DELETE FROM requests WHERE pid=? AND pid_start IS ?", (pid, pid_start))
+                logging.warning(f"!!! Ollama slots of process {pid}, which exited, reclaimed")
+
+    def _enqueue(self, priority_class, kind):
+        now = time.time()
+        request_id = uuid.uuid4().hex
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._reclaim(now)
+                waiting = self._conn.execute("SELECT COUNT(*) FROM requests WHERE class=? AND state='waiting'",
+                                             (priority_class,)).fetchone()[0]
+                limit = self.queue_limits.get(priority_class)
+                if limit is not None and waiting >= limit:
+                    raise OllamaBusy(f"The Ollama server is busy ({waiting} {priority_class} requests waiting). Try again in a moment.")
+                self._conn.execute("INSERT INTO requests VALUES (?, ?, ?, ?, 'waiting', ?, ?, ?, NULL)",
+                                   (request_id, PRIORITIES[priority_class], priority_class, kind, os.getpid(), self._pid_start, now))
+            finally:
+                self._conn.execute("COMMIT")
+        return request_id
+
+    def _try_start(self, request_id, priority_class):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT enqueued FROM requests WHERE id=?", (request_id,)).fetchone()
+                if row is None:
+                    raise OllamaBusy("The request was dropped from the Ollama queue")
+                running = dict(self._conn.execute(
+                    "SELECT class, COUNT(*) FROM requests WHERE state='running' GROUP BY class").fetchall())
+                total = sum(running.values())
+                limit = self.max_in_flight if priority_class == INTERACTIVE else self.max_in_flight - self.reserved
+                if total >= limit or running.get(priority_class, 0) >= self.class_limits.get(priority_class, self.max_in_flight):
+                    return False
+                # Waiting requests served before this one: earlier ones of its class, and those of better classes with room
+                for other_class, count in self._conn.execute(
+                        "SELECT class, COUNT(*) FROM requests WHERE state='waiting' AND "
+                        "(priority<? OR (priority=? AND enqueued<?)) GROUP BY class",
+                        (PRIORITIES[priority_class], PRIORITIES[priority_class], row[0])).fetchall():
+                    if other_class == priority_class or running.get(other_class, 0) < self.class_limits.get(other_class, self.max_in_flight):
+                        return False
+                self._conn.execute("UPDATE requests SET state='running', started=? WHERE id=?", (time.time(), request_id))
+                return True
+            finally:
+                self._conn.execute("COMMIT")
+
+    def _deadline(self, priority_class, timeout):
+        timeout = self.timeouts.get(priority_class) if timeout is None else timeout
+        return None if timeout is None else time.monotonic() + timeout
+
+    def _timed_out(self, request_id, priority_class, deadline):
+        if deadline is None or time.monotonic() < deadline:
+            return False
+        self.release(request_id)
+        utils.metrics.record("ollama_rejected", 1, priority=priority_class)
+        return True
+
+    def acquire(self, priority_class, kind='', timeout=None):
+        """
+        Wait for a slot.
+
+        Parameters:
+        priority_class (str): INTERACTIVE, BUILD or DOWNLOAD.
+        kind (str): What the request is, e.g. 'chat', 'embed', 'load' or 'pull' (for reports).
+        timeout (float): Seconds to wait before giving up (default: OLLAMA_WAIT_TIMEOUT_SEC of the class).
+
+        Returns:
+        str: The slot id, to pass to release().
+
+        Raises:
+        OllamaBusy: The queue of the class is full, or the wait timed out.
+        """
+        start_time = time.perf_counter()
+        try:
+            request_id = self._enqueue(priority_class, kind)
+        except OllamaBusy:
+            utils.metrics.record("ollama_rejected", 1, priority=priority_class)
+            raise
+        deadline = self._deadline(priority_class, timeout)
+        while not self._try_start(request_id, priority_class):
+            if self._timed_out(request_id, priority_class, deadline):
+                raise OllamaBusy(f"The Ollama server is busy (no slot for a {priority_class} request). Try again in a moment.")
+            time.sleep(self.poll_sec)
+        utils.metrics.record("ollama_wait_seconds", time.perf_counter() - start_time, priority=priority_class)
+        return request_id
+
+    async def aacquire(self, priority_class, kind='', timeout=None):
+        """acquire() for coroutines: the database is polled from worker threads, the loop stays free."""
+        start_time = time.perf_counter()
+        try:
+            request_id = await asyncio.to_thread(self._enqueue, priority_class, kind)
+        except OllamaBusy:
+            utils.metrics.record("ollama_rejected", 1, priority=priority_class)
+            raise
+        deadline = self._deadline(priority_class, timeout)
+        try:
+            while not await asyncio.to_thread(self._try_start, request_id, priority_class):
+                if self._timed_out(request_id, priority_class, deadline):
+                    raise OllamaBusy(f"The Ollama server is busy (no slot for a {priority_class} request). Try again in a moment.")
+                await asyncio.sleep(self.poll_sec)
+        except asyncio.CancelledError:
+            self.release(request_id)
+            raise
+        utils.metrics.record("ollama_wait_seconds", time.perf_counter() - start_time, priority=priority_class)
+        return request_id
+
+    def release(self, request_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM requests WHERE id=?", (request_id,))
+
+    def stats(self):
+        """Requests per class: {class: {"running": n, "waiting": n}}."""
+        counts = {priority_class: {"running": 0, "waiting": 0} for priority_class in PRIORITIES}
+        with self._lock:
+            rows = self._conn.execute("SELECT class, state, COUNT(*) FROM requests GROUP BY class, state").fetchall()
+        for priority_class, state, count in rows:
+            counts.setdefault(priority_class, {"running": 0, "waiting": 0})[state] = count
+        return counts
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+# Class of the requests that do not say: builds run in worker processes of their own (see utils/build_jobs.py)
+_default_class = INTERACTIVE
+
+
+def get_scheduler():
+    """Get the process-wide Scheduler, opening its database on first use."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler(os.path.join(const.CACHE_ROOT_PATH, const.OLLAMA_SCHEDULER_FNAME))
+        return _scheduler
+
+
+def set_default_class(priority_class):
+    """Set the class of this process's requests made without one, e.g. BUILD in build workers."""
+    global _default_class
+    _default_class = priority_class
+
+
+@contextmanager
+def slot(priority_class=None, kind='', timeout=None):
+    """
+    Hold a slot of the Ollama server for the duration of a block.
+
+    Usage:
+        with utils.ollama_scheduler.slot(kind='embed'):
+            embeddings = embed_model.get_text_embedding_batch(texts)
+    """
+    scheduler = get_scheduler()
+    request_id = scheduler.acquire(priority_class or _default_class, kind, timeout)
+    try:
+        yield
+    finally:
+        scheduler.release(request_id)
+
+
+@asynccontextmanager
+async def aslot(priority_class=None, kind='', timeout=None):
+    """slot() for coroutines."""
+    scheduler = get_scheduler()
+    request_id = await scheduler.aacquire(priority_class or _default_class, kind, timeout)
+    try:
+        yield
+    finally:
+        scheduler.release(request_id)
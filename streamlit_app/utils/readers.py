@@ -0,0 +1,83 @@
+import json
+
+import pandas as pd
+
+from llama_index.core.readers.base import BaseReader
+from llama_index.core import Document
+from typing import Dict, Type
+
+# The readers keep the structure of their files as text, for the chunking strategies in utils/chunking.py
+
+
+class ExcelReader(BaseReader):
+    """One document per sheet, as CSV with its header row."""
+
+    def load_data(self, file_path: str, extra_info: dict = None):
+        sheets = pd.read_excel(file_path, sheet_name=None)
+        return [Document(text=df.to_csv(index=False), metadata=dict(extra_info or {}, sheet_name=str(sheet_name)))
+                for sheet_name, df in sheets.items() if not df.empty]
+
+
+class CSVReader(BaseReader):
+    """The file as it is, header row included (the default reader joins the values of each row without it)."""
+
+    def load_data(self, file_path: str, extra_info: dict = None):
+        with open(file_path, newline='', encoding='utf-8', errors='replace') as f:
+            return [Document(text=f.read(), metadata=extra_info or {})]
+
+
+class MarkdownReader(BaseReader):
+    """The file as one document (the default reader makes one document per heading, losing their nesting)."""
+
+    def load_data(self, file_path: str, extra_info: dict = None):
+        with open(file_path, encoding='utf-8', errors='replace') as f:
+            return [Document(text=f.read(), metadata=extra_info or {})]
+
+
+class HTMLReader(BaseReader):
+    """HTML converted to Markdown, as for web pages (see utils/web_loader.py)."""
+
+    def load_data(self, file_path: str, extra_info: dict = None):
+        import html2text
+        with open(file_path, encoding='utf-8', errors='replace') as f:
+            return [Document(text=html2text.html2text(f.read()), metadata=extra_info or {})]
+
+
+class NotebookReader(BaseReader):
+    """
+    A Jupyter notebook as a script in the "percent" format: each cell starts with a `# %%` line
+    (`# %% [markdown]` for text cells). Outputs are left out. Needs no nbconvert.
+    """
+
+    def load_data(self, file_path: str, extra_info: dict = None):
+        with open(file_path, encoding='utf-8') as f:
+            notebook = json.load(f)
+        cells = []
+        for cell in notebook.get("cells", []):
+            source = cell.get("source", "")
+            source = "".join(source) if isinstance(source, list) else source
+            if not source.strip() or cell.get("cell_type") not in ("code", "markdown"):
+                continue
+            marker = "# %% [markdown]" if cell["cell_type"] == "markdown" else "# %%"
+            cells.append(f"{marker}\n{source.strip()}\n")
+        return [Document(text="\n".join(cells), metadata=extra_info or {})]
+
+
+DEFAULT_FILE_READER_CLS: Dict[str, Type[BaseReader]] = {
+    ".xlsx": ExcelReader,
+    ".xls": ExcelReader,
+    ".csv": CSVReader,
+    ".md": MarkdownReader,
+    ".html": HTMLReader,
+    ".htm": HTMLReader,
+    ".ipynb": NotebookReader,
+}
+
+def get_file_extractor():
+    """
+    Instantiate the custom readers, to pass as `file_extractor` to SimpleDirectoryReader.
+
+    Returns:
+    dict: A mapping of file extension to reader instance.
+    """
+    return {ext: reader_cls() for ext, reader_cls in DEFAULT_FILE_READER_CLS.items()}
@@ -0,0 +1,455 @@
+import os
+import gzip
+import json
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+import utils.constants as const
+import utils.ann
+import utils.exact_search
+
+
+# Rows quantized at a time when persisting an int8 matrix, to bound the temporary float copies
+QUANTIZE_BLOCK_ROWS = 65536
+
+
+def quantize_int8(matrix):
+    """
+    Quantize embeddings to 8 bits with one symmetric scale per row.
+
+    Parameters:
+    matrix (np.ndarray): Float embeddings, one per row.
+
+    Returns:
+    tuple: (int8 codes, float32 scales) such that codes * scales[:, None] ~ matrix.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.size == 0:
+        return np.zeros(matrix.shape, dtype=np.int8), np.zeros(len(matrix), dtype=np.float32)
+    scales = np.abs(matrix).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def dequantize_int8(codes, scales):
+    """Decode int8 rows from quantize_int8() back to float32."""
+    return codes.astype(np.float32) * np.asarray(scales, dtype=np.float32)[:, None]
+
+
+class MmapVectorStore(BasePydanticVectorStore):
+    """
+    Vector store that persists embeddings as one contiguous matrix file.
+
+    The matrix is saved as a `.npy` file and opened with `numpy.memmap` on
+    load, so an index opens without parsing any float literals and its pages
+    are shared by every session through the OS page cache. Node ids, their
+    ref_doc_ids and the filterable metadata are kept in a small JSON table
+    whose row order matches the matrix.
+
+    With `dtype='int8'`, each row is stored as 8-bit codes times a per-row
+    scale (saved in a separate `.npy` file) and decoded to float32 on use.
+
+    With `ann_backend='ivf'`, queries are answered through an IVF index
+    (see utils/ann.py) that is trained when the store is persisted, and saved
+    next to the matrix. `nprobe` can be overridden per query, e.g. with
+    `as_retriever(vector_store_kwargs={"nprobe": 16})`.
+    """
+
+    stores_text: bool = False
+    dtype: str = 'float32'
+    ann_backend: str = 'exact'
+    ann_nlist: Optional[int] = None
+    ann_nprobe: int = const.ANN_DEFAULT_NPROBE
+
+    _ids: List[str] = PrivateAttr(default_factory=list)
+    _ref_doc_ids: List[str] = PrivateAttr(default_factory=list)
+    _metadata: Dict[str, dict] = PrivateAttr(default_factory=dict)
+    _matrix: Optional[np.ndarray] = PrivateAttr(default=None)
+    _scales: Optional[np.ndarray] = PrivateAttr(default=None)   # set while _matrix holds int8 codes
+    _pending: List[List[float]] = PrivateAttr(default_factory=list)
+    _ivf: Optional[utils.ann.IVFIndex] = PrivateAttr(default=None)
+    _search_index: Optional[utils.exact_search.ExactSearchIndex] = PrivateAttr(default=None)
+
+    def __init__(self, dtype: str = 'float32', ann_backend: str = 'exact', **kwargs: Any) -> None:
+        if dtype not in const.VECTOR_DTYPES:
+            raise ValueError(f"Unsupported dtype '{dtype}', use one of {const.VECTOR_DTYPES}")
+        if ann_backend not in const.ANN_BACKENDS:
+            raise ValueError(f"Unsupported ANN backend '{ann_backend}', use one of {const.ANN_BACKENDS}")
+        super().__init__(dtype=dtype, ann_backend=ann_backend, **kwargs)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MmapVectorStore"
+
+    @property
+    def client(self) -> None:
+        return None
+
+    @property
+    def count(self) -> int:
+        # Not __len__: StorageContext tests `if vector_store:` and an empty
+        # store must not be falsy.
+        return len(self._ids)
+
+    @property
+    def node_ids(self) -> List[str]:
+        return list(self._ids)
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """Embedding matrix with one row per node id (may be a read-only memmap)."""
+        self._consolidate()
+        if self._matrix is None:
+            return np.zeros((0, 0), dtype=np.float32 if self.dtype == 'int8' else self.dtype)
+        if self._scales is not None:
+            return dequantize_int8(self._matrix, self._scales)
+        return self._matrix
+
+    @property
+    def search_index(self) -> utils.exact_search.ExactSearchIndex:
+        """Pre-normalized float32 copy of the matrix, built on first query."""
+        if self._search_index is None:
+            self._search_index = utils.exact_search.ExactSearchIndex(self._ids, self.matrix)
+        return self._search_index
+
+    def _consolidate(self):
+        # Rows added since the last load/persist are buffered as lists and
+        # only stacked onto the matrix when the matrix is actually needed.
+        if not self._pending:
+            return
+        pending = np.asarray(self._pending, dtype=np.float32)
+        if self._matrix is None or len(self._matrix) == 0:
+            self._matrix = pending
+        elif self._scales is not None:
+            self._matrix = np.vstack([dequantize_int8(self._matrix, self._scales), pending])
+        else:
+            self._matrix = np.vstack([np.asarray(self._matrix, dtype=np.float32), pending])
+        self._scales = None
+        self._pending = []
+
+    def get(self, text_id: str) -> List[float]:
+        """Get the embedding of a single node."""
+        row = self._ids.index(text_id)
+        self._consolidate()
+        if self._scales is not None:
+            return (self._matrix[row].astype(np.float32) * self._scales[row]).tolist()
+        return self.matrix[row].astype(np.float32).tolist()
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        for node in nodes:
+            self._ids.append(node.node_id)
+            self._ref_doc_ids.append(node.ref_doc_id or "None")
+            self._pending.append(node.get_embedding())
+            metadata = node_to_metadata_dict(node, remove_text=True, flat_metadata=False)
+            metadata.pop("_node_content", None)
+            self._metadata[node.node_id] = metadata
+        # The IVF lists no longer cover every row; retrained on persist
+        self._ivf = None
+        self._search_index = None
+        return [node.node_id for node in nodes]
+
+    def _keep_rows(self, keep):
+        matrix = self.matrix
+        self._matrix = np.ascontiguousarray(matrix[keep]) if len(matrix) else None
+        self._scales = None
+        for node_id, kept in zip(self._ids, keep):
+            if not kept:
+                self._metadata.pop(node_id, None)
+        self._ids = [i for i, kept in zip(self._ids, keep) if kept]
+        self._ref_doc_ids = [r for r, kept in zip(self._ref_doc_ids, keep) if kept]
+        self._ivf = None
+        self._search_index = None
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        keep = np.array([r != ref_doc_id for r in self._ref_doc_ids], dtype=bool)
+        if not keep.all():
+            self._keep_rows(keep)
+
+    def delete_nodes(self, node_ids: Optional[List[str]] = None, filters=None, **delete_kwargs: Any) -> None:
+        if filters is not None:
+            raise ValueError("MmapVectorStore does not support metadata filters")
+        if node_ids is None:
+            return
+        node_id_set = set(node_ids)
+        keep = np.array([i not in node_id_set for i in self._ids], dtype=bool)
+        if not keep.all():
+            self._keep_rows(keep)
+
+    def clear(self) -> None:
+        self._ids = []
+        self._ref_doc_ids = []
+        self._metadata = {}
+        self._matrix = None
+        self._scales = None
+        self._pending = []
+        self._ivf = None
+        self._search_index = None
+
+    def build_ann(self) -> None:
+        """Train the IVF index over the current matrix (no-op for the exact backend)."""
+        if self.ann_backend != 'ivf' or self.count == 0:
+            self._ivf = None
+            return
+        self._ivf = utils.ann.IVFIndex(self.ann_nlist or utils.ann.default_nlist(self.count), self.ann_nprobe)
+        self._ivf.train(self.matrix)
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if query.filters is not None:
+            raise ValueError("MmapVectorStore does not support metadata filters")
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError(f"Invalid query mode: {query.mode}")
+
+        search_index = self.search_index
+        if query.node_ids is not None:
+            allowed = set(query.node_ids)
+            rows = np.array([n for n, i in enumerate(self._ids) if i in allowed], dtype=np.int64)
+        elif self._ivf is not None:
+            rows = np.sort(self._ivf.candidates(query.query_embedding, kwargs.get("nprobe")))
+        else:
+            rows = None
+        ids, similarities = search_index.search(query.query_embedding, query.similarity_top_k, rows)
+        return VectorStoreQueryResult(similarities=similarities, ids=ids)
+
+    def batch_query(self, query_embeddings: List[List[float]], similarity_top_k: int) -> List[VectorStoreQueryResult]:
+        """Answer several unfiltered exact queries at once (one matrix-matrix product)."""
+        return [VectorStoreQueryResult(similarities=similarities, ids=ids)
+                for ids, similarities in self.search_index.search_batch(query_embeddings, similarity_top_k)]
+
+    def persist(self, persist_path: str, fs=None) -> None:
+        """
+        Persist the matrix and id table next to `persist_path`.
+
+        StorageContext hands every vector store a `<namespace>__vector_store.json`
+        path; only its directory is used here.
+        """
+        persist_dir = os.path.dirname(persist_path)
+        os.makedirs(persist_dir, exist_ok=True)
+        matrix = self.matrix
+
+        matrix_path = os.path.join(persist_dir, const.VECTOR_MATRIX_FNAME)
+        scales_path = os.path.join(persist_dir, const.VECTOR_SCALES_FNAME)
+        tmp_path = matrix_path + '.tmp'
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=self.dtype,
+                                        shape=(len(self._ids), matrix.shape[1] if len(matrix) else 0))
+        if self.dtype == 'int8':
+            scales = np.zeros(len(self._ids), dtype=np.float32)
+            for start in range(0, len(matrix), QUANTIZE_BLOCK_ROWS):
+                block = slice(start, start + QUANTIZE_BLOCK_ROWS)
+                out[block], scales[block] = quantize_int8(matrix[block])
+            with open(scales_path + '.tmp', 'wb') as f:
+                np.save(f, scales)
+            os.replace(scales_path + '.tmp', scales_path)
+        elif len(matrix):
+            out[:] = matrix
+        out.flush()
+        del out
+        os.replace(tmp_path, matrix_path)
+        if self.dtype != 'int8' and os.path.exists(scales_path):
+            os.remove(scales_path)
+
+        ids_path = os.path.join(persist_dir, const.VECTOR_IDS_FNAME)
+        with open(ids_path + '.tmp', 'w') as f:
+            json.dump({
+                "dtype": self.dtype,
+                "ids": self._ids,
+                "ref_doc_ids": self._ref_doc_ids,
+                "metadata_dict": self._metadata,
+            }, f, separators=(',', ':'))
+        os.replace(ids_path + '.tmp', ids_path)
+
+        if self.ann_backend == 'ivf' and self._ivf is None:
+            self.build_ann()
+        utils.ann.save_ann_config(persist_dir, {
+            "backend": self.ann_backend, "nlist": self.ann_nlist, "nprobe": self.ann_nprobe})
+        ivf_path = os.path.join(persist_dir, const.ANN_IVF_FNAME)
+        if self._ivf is not None:
+            self._ivf.save(persist_dir)
+        elif os.path.exists(ivf_path):
+            os.remove(ivf_path)
+
+        # The JSON store is now stale; keep a single copy of the vectors on disk
+        json_path = os.path.join(persist_dir, const.VECTOR_STORE_JSON_FNAME)
+        if os.path.exists(json_path):
+            os.remove(json_path)
+
+        # Re-open what was just written so the in-memory copy can be released
+        self._matrix = np.load(matrix_path, mmap_mode='r')
+        self._scales = np.load(scales_path) if self.dtype == 'int8' else None
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str) -> "MmapVectorStore":
+        with open(os.path.join(persist_dir, const.VECTOR_IDS_FNAME)) as f:
+            table = json.load(f)
+        ann_config = utils.ann.load_ann_config(persist_dir)
+        store = cls(dtype=table["dtype"], ann_backend=ann_config["backend"],
+                    ann_nlist=ann_config.get("nlist"), ann_nprobe=ann_config.get("nprobe", const.ANN_DEFAULT_NPROBE))
+        store._ids = table["ids"]
+        store._ref_doc_ids = table["ref_doc_ids"]
+        store._metadata = table.get("metadata_dict", {})
+        store._matrix = np.load(os.path.join(persist_dir, const.VECTOR_MATRIX_FNAME), mmap_mode='r')
+        if len(store._matrix) != len(store._ids):
+            raise ValueError(f"Corrupted vector store under {persist_dir}: "
+                             f"{len(store._matrix)} vectors but {len(store._ids)} ids")
+        if store.dtype == 'int8':
+            store._scales = np.load(os.path.join(persist_dir, const.VECTOR_SCALES_FNAME))
+            if len(store._scales) != len(store._ids):
+                raise ValueError(f"Corrupted vector store under {persist_dir}: "
+                                 f"{len(store._scales)} scales but {len(store._ids)} ids")
+        if store.ann_backend == 'ivf' and os.path.isfile(os.path.join(persist_dir, const.ANN_IVF_FNAME)):
+            ivf = utils.ann.IVFIndex.load(persist_dir, store.ann_nprobe)
+            if ivf.num_vectors == store.count:
+                store._ivf = ivf
+            else:
+                logging.warning(f"!!!!!! Stale IVF index under {persist_dir}, falling back to exact search")
+        return store
+
+
+def has_binary_store(persist_dir):
+    """
+    Check if an index directory holds a binary (memory-mapped) vector store.
+
+    Parameters:
+    persist_dir (str): The path to the index directory.
+
+    Returns:
+    bool: True if both the matrix file and the id table exist.
+    """
+    return (os.path.isfile(os.path.join(persist_dir, const.VECTOR_MATRIX_FNAME)) and
+            os.path.isfile(os.path.join(persist_dir, const.VECTOR_IDS_FNAME)))
+
+
+def load_docstore(persist_dir):
+    """
+    Load the docstore of a saved index, from `docstore.json` or its gzipped copy.
+
+    Compacted indexes keep only the gzipped copy (see utils/index_compaction.py);
+    an index saved again, e.g. by an update, gets a plain `docstore.json`,
+    which is then the one read.
+
+    Parameters:
+    persist_dir (str): The path to the index directory.
+
+    Returns:
+    SimpleDocumentStore: The docstore.
+    """
+    from llama_index.core.storage.docstore import SimpleDocumentStore
+    from llama_index.core.storage.kvstore.simple_kvstore import SimpleKVStore
+
+    gz_path = os.path.join(persist_dir, const.DOCSTORE_GZ_FNAME)
+    if not os.path.isfile(os.path.join(persist_dir, const.DOCSTORE_FNAME)) and os.path.isfile(gz_path):
+        with gzip.open(gz_path, 'rt', encoding='utf-8') as f:
+            return SimpleDocumentStore(simple_kvstore=SimpleKVStore(json.load(f)))
+    return SimpleDocumentStore.from_persist_dir(persist_dir)
+
+
+def load_storage_context(persist_dir):
+    """
+    Create a StorageContext for a saved index, preferring the binary vector store.
+
+    Parameters:
+    persist_dir (str): The path to the index directory.
+
+    Returns:
+    StorageContext: The storage context to pass to load_index_from_storage.
+    """
+    from llama_index.core import StorageContext
+
+    docstore = load_docstore(persist_dir)
+    if has_binary_store(persist_dir):
+        vector_store = MmapVectorStore.from_persist_dir(persist_dir)
+        return StorageContext.from_defaults(persist_dir=persist_dir, docstore=docstore, vector_store=vector_store)
+    vector_store = utils.exact_search.ExactSimpleVectorStore.from_persist_path(
+        os.path.join(persist_dir, const.VECTOR_STORE_JSON_FNAME))
+    return StorageContext.from_defaults(persist_dir=persist_dir, docstore=docstore, vector_store=vector_store)
+
+
+def new_storage_context(dtype='float32', ann_backend='exact', ann_nlist=None, ann_nprobe=const.ANN_DEFAULT_NPROBE):
+    """
+    Create an empty StorageContext backed by a MmapVectorStore, for building a new index.
+
+    Parameters:
+    dtype (str): Storage precision of the embeddings.
+    ann_backend (str): 'exact' or 'ivf'.
+    ann_nlist (int): Number of IVF lists (default: derived from the number of vectors).
+    ann_nprobe (int): Number of IVF lists visited per query by default.
+    """
+    from llama_index.core import StorageContext
+
+    vector_store = MmapVectorStore(dtype=dtype, ann_backend=ann_backend, ann_nlist=ann_nlist, ann_nprobe=ann_nprobe)
+    return StorageContext.from_defaults(vector_store=vector_store)
+
+
+def convert_json_index(persist_dir, dtype='float32', remove_json=False):
+    """
+    Convert an index's `default__vector_store.json` into the binary format.
+
+    The converted store is loaded back and compared row by row against the
+    JSON source before anything is removed.
+
+    Parameters:
+    persist_dir (str): The path to the index directory.
+    dtype (str): One of VECTOR_DTYPES.
+    remove_json (bool): Delete the JSON store once the round trip is verified.
+
+    Returns:
+    int: The number of vectors converted.
+    """
+    json_path = os.path.join(persist_dir, const.VECTOR_STORE_JSON_FNAME)
+    with open(json_path) as f:
+        data = json.load(f)
+    embedding_dict = data.get("embedding_dict", {})
+    text_id_to_ref_doc_id = data.get("text_id_to_ref_doc_id", {})
+    metadata_dict = data.get("metadata_dict") or {}
+
+    store = MmapVectorStore(dtype=dtype)
+    store._ids = list(embedding_dict.keys())
+    store._ref_doc_ids = [text_id_to_ref_doc_id.get(i, "None") for i in store._ids]
+    store._metadata = {i: metadata_dict[i] for i in store._ids if i in metadata_dict}
+    store._pending = list(embedding_dict.values())
+
+    # persist() removes the JSON file, so keep it until the round trip checks out
+    backup_path = json_path + '.bak'
+    os.replace(json_path, backup_path)
+    try:
+        store.persist(json_path)
+        loaded = MmapVectorStore.from_persist_dir(persist_dir)
+        tolerance = {'float32': 1e-6, 'float16': 1e-2}.get(dtype)
+        if loaded.node_ids != store._ids:
+            raise ValueError("Node ids do not match after conversion")
+        decoded = loaded.matrix
+        for row, node_id in enumerate(loaded.node_ids):
+            expected = np.asarray(embedding_dict[node_id], dtype=np.float32)
+            # int8 codes are off by at most half a step of their row's scale
+            atol = tolerance if tolerance is not None else np.abs(expected).max() / 254 * 1.01
+            if not np.allclose(decoded[row], expected, rtol=tolerance or 0, atol=atol):
+                raise ValueError(f"Embedding of node {node_id} does not match after conversion")
+    except Exception:
+        for fname in [const.VECTOR_MATRIX_FNAME, const.VECTOR_IDS_FNAME, const.VECTOR_SCALES_FNAME,
+                      const.ANN_CONFIG_FNAME, const.ANN_IVF_FNAME]:
+            if os.path.exists(os.path.join(persist_dir, fname)):
+                os.remove(os.path.join(persist_dir, fname))
+        os.replace(backup_path, json_path)
+        raise
+
+    if remove_json:
+        os.remove(backup_path)
+    else:
+        os.replace(backup_path, json_path)
+    logging.info(f" ### Converted {store.count} vectors under '{persist_dir}' to {dtype}")
+    return store.count
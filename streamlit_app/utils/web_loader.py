@@ -0,0 +1,178 @@
+import os
+import time
+import sqlite3
+import threading
+import multiprocessing
+from urllib.parse import urlparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from llama_index.core import Document
+
+import logging
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+import utils.constants as const
+
+
+class WebPageCache:
+    """
+    On-disk cache of fetched web pages, keyed by URL.
+
+    Stores the validators (ETag, Last-Modified) sent by the server together
+    with the page text already converted from HTML, so that a page answered
+    with `304 Not Modified` is neither downloaded nor converted again.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS pages (
+            url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, html_to_text INTEGER,
+            text TEXT, fetched_at REAL)""")
+        self._conn.commit()
+
+    def get(self, url, html_to_text):
+        """
+        Look up a page.
+
+        Returns:
+        tuple: (etag, last_modified, text), or None if the page is not cached.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT etag, last_modified, text FROM pages WHERE url=? AND html_to_text=?",
+                (url, int(html_to_text))).fetchone()
+        return row
+
+    def put(self, url, html_to_text, etag, last_modified, text):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)",
+                               (url, etag, last_modified, int(html_to_text), text, time.time()))
+            self._conn.commit()
+
+
+def get_cache():
+    """Open the web page cache shared by every index build."""
+    return WebPageCache(os.path.join(const.CACHE_ROOT_PATH, const.WEB_CACHE_FNAME))
+
+
+def html_to_text(html):
+    """Convert an HTML page to Markdown text. Runs inside a conversion worker."""
+    import html2text
+    return html2text.html2text(html)
+
+
+class ConcurrentWebLoader:
+    """
+    Fetch web pages concurrently and yield them as documents as they arrive.
+
+    Requests share one pooled `requests.Session`, and at most `max_per_host`
+    requests go to the same host at a time. When a cache is given, pages are
+    revalidated with `If-None-Match` / `If-Modified-Since` and served from the
+    cache on `304 Not Modified`. HTML is converted to text in a pool of
+    `convert_workers` processes, as html2text is pure Python and would hold
+    the GIL against the other fetching threads; with `convert_workers` <= 1,
+    or a single CPU, it is converted in the fetching thread. A URL that
+    cannot be fetched is recorded in `failures` and skipped.
+
+    The documents are the same as the ones SimpleWebPageReader produces
+    (id = URL, empty metadata).
+    """
+
+    def __init__(self, urls, html_to_text=True, max_workers=const.WEB_MAX_WORKERS, max_per_host=const.WEB_MAX_PER_HOST,
+                 timeout=const.WEB_TIMEOUT_SEC, convert_workers=const.WEB_CONVERT_WORKERS, cache=None, session=None, progress=None):
+        self.urls = list(urls)
+        self.html_to_text = html_to_text
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.convert_workers = convert_workers
+        self.cache = cache
+        self.progress = progress
+        self.session = session or self._new_session()
+        self.latencies = []    # (url, seconds, 'fetched' or 'cached')
+        self.failures = []     # (url, error message)
+        self.num_documents = 0
+        self._host_slots = {}
+        self._host_lock = threading.Lock()
+        self._convert_pool = None
+        self._convert_lock = threading.Lock()
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_per_host)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _host_slot(self, url):
+        host = urlparse(url).netloc
+        with self._host_lock:
+            return self._host_slots.setdefault(host, threading.BoundedSemaphore(self.max_per_host))
+
+    def _convert(self, html):
+        if self.convert_workers <= 1 or (os.cpu_count() or 1) <= 1:
+            return html_to_text(html)
+        with self._convert_lock:
+            if self._convert_pool is None:
+                # spawn: forking the multi-threaded build worker is not safe.
+                # Started with the first page to convert: a rebuild answered with 304s starts none
+                self._convert_pool = ProcessPoolExecutor(max_workers=self.convert_workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._convert_pool.submit(html_to_text, html).result()
+
+    def _fetch(self, url):
+        start_time = time.time()
+        cached = self.cache.get(url, self.html_to_text) if self.cache is not None else None
+        headers = {}
+        if cached is not None:
+            etag, last_modified, _ = cached
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        with self._host_slot(url):
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+        if response.status_code == 304 and cached is not None:
+            return url, cached[2], time.time() - start_time, 'cached'
+        response.raise_for_status()
+
+        text = response.text
+        if self.html_to_text:
+            text = self._convert(text)
+        if self.cache is not None:
+            self.cache.put(url, self.html_to_text, response.headers.get('ETag'), response.headers.get('Last-Modified'), text)
+        return url, text, time.time() - start_time, 'fetched'
+
+    def __iter__(self):
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {executor.submit(self._fetch, url): url for url in self.urls}
+                for future in as_completed(futures):
+                    url = futures[future]
+                    try:
+                        _, text, elapsed, source = future.result()
+                    except Exception as e:
+                        self.failures.append((url, f"{type(e).__name__}: {e}"))
+                        logging.error(f"!!!!!! Failed to fetch '{url}': {e}")
+                    else:
+                        self.latencies.append((url, elapsed, source))
+                        self.num_documents += 1
+                        logging.info(f"> Fetched '{url}' in {elapsed:.2f}s ({source})")
+                        yield Document(text=text, id_=url, metadata={})
+                    if self.progress is not None:
+                        self.progress(len(self.latencies) + len(self.failures), len(self.urls), url)
+        finally:
+            if self._convert_pool is not None:
+                self._convert_pool.shutdown(wait=False, cancel_futures=True)
+                self._convert_pool = None
+
+        num_cached = sum(1 for _, _, source in self.latencies if source == 'cached')
+        logging.info(f" ### Fetched {len(self.latencies)} web pages ({num_cached} not modified, {len(self.failures)} failed)")